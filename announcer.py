@@ -0,0 +1,242 @@
+# announcer.py
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from caching import LRUCache
+from lexicon import FEMININE_SOFT, plural_category
+from tts_cache import audio_key, splice_key
+
+logger = logging.getLogger('DeasanAI')
+
+RU_UNITS = ['', 'один', 'два', 'три', 'четыре', 'пять', 'шесть', 'семь', 'восемь', 'девять']
+RU_TEENS = ['десять', 'одиннадцать', 'двенадцать', 'тринадцать', 'четырнадцать', 'пятнадцать',
+            'шестнадцать', 'семнадцать', 'восемнадцать', 'девятнадцать']
+RU_TENS = ['', '', 'двадцать', 'тридцать', 'сорок', 'пятьдесят', 'шестьдесят', 'семьдесят', 'восемьдесят',
+           'девяносто']
+RU_HUNDREDS = ['', 'сто', 'двести', 'триста', 'четыреста', 'пятьсот', 'шестьсот', 'семьсот', 'восемьсот',
+               'девятьсот']
+# «одна чашка», «две чашки», «одно окно»
+RU_GENDER_UNITS = {'f': {1: 'одна', 2: 'две'}, 'n': {1: 'одно'}}
+EN_UNITS = ['', 'one', 'two', 'three', 'four', 'five', 'six', 'seven', 'eight', 'nine', 'ten', 'eleven',
+            'twelve', 'thirteen', 'fourteen', 'fifteen', 'sixteen', 'seventeen', 'eighteen', 'nineteen']
+EN_TENS = ['', '', 'twenty', 'thirty', 'forty', 'fifty', 'sixty', 'seventy', 'eighty', 'ninety']
+
+# Окончания прилагательных перед существительным в формах словаря меток
+ADJECTIVE_ENDINGS = ('ый', 'ий', 'ой', 'ая', 'яя', 'ое', 'ее', 'ые', 'ых', 'их')
+
+# Битрейты Layer III (кбит/с) и частоты дискретизации по версии MPEG
+MP3_BITRATES = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)
+}
+MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+
+def spell_number(number, lang, gender='m'):
+    """Число словами для озвучивания: 2 -> «две» (gender='f'), 21 -> «twenty one»"""
+    if not 0 < number < 1000:
+        return str(number)
+    hundreds, rest = divmod(number, 100)
+    tens, units = divmod(rest, 10)
+    if lang == 'ru':
+        words = [RU_HUNDREDS[hundreds]]
+        if tens == 1:
+            words.append(RU_TEENS[units])
+        else:
+            words += [RU_TENS[tens], RU_GENDER_UNITS.get(gender, {}).get(units, RU_UNITS[units])]
+    else:
+        words = [f"{EN_UNITS[hundreds]} hundred" if hundreds else '']
+        words += [EN_UNITS[rest]] if rest < 20 else [EN_TENS[tens], EN_UNITS[units]]
+    return ' '.join(word for word in words if word)
+
+
+def noun_gender(form, count):
+    """Род названия ('m', 'f', 'n') для «один/одна/одно» и «два/две».
+
+    form уже согласована с count: для 2-4 род виден по окончанию («чашки» -
+    женский, «стола» - мужской), для 1, 21 - по именительному падежу.
+    """
+    words = form.lower().split()
+    head = next((word for word in words if not word.endswith(ADJECTIVE_ENDINGS)), words[-1] if words else '')
+    if plural_category(count) == 'few':
+        return 'f' if head.endswith(('ы', 'и')) else 'm'
+    if head.endswith(('а', 'я')) or head.endswith(FEMININE_SOFT):
+        return 'f'
+    if head.endswith(('о', 'е')):
+        return 'n'
+    return 'm'
+
+
+def mp3_frame_length(header):
+    """Длина кадра MPEG Layer III по 4 байтам заголовка или None"""
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version = (header[1] >> 3) & 3
+    layer = (header[1] >> 1) & 3
+    bitrate_index = header[2] >> 4
+    rate_index = (header[2] >> 2) & 3
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    bitrate = MP3_BITRATES[1 if version == 3 else 2][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+    padding = (header[2] >> 1) & 1
+    return (144 if version == 3 else 72) * bitrate // sample_rate + padding
+
+
+def mp3_frames(audio):
+    """Аудиокадры MP3 без тегов ID3 и служебного кадра Xing/Info - их можно склеивать"""
+    start, end = 0, len(audio)
+    if audio[:3] == b'ID3' and len(audio) >= 10:
+        size = (audio[6] & 0x7F) << 21 | (audio[7] & 0x7F) << 14 | (audio[8] & 0x7F) << 7 | audio[9] & 0x7F
+        start = 10 + size + (10 if audio[5] & 0x10 else 0)
+    if end - start >= 128 and audio[end - 128:end - 125] == b'TAG':
+        end -= 128
+    length = mp3_frame_length(audio[start:start + 4])
+    if length and (b'Xing' in audio[start:start + 64] or b'Info' in audio[start:start + 64]):
+        start += length
+    return audio[start:end]
+
+
+def mp3_silence(frames, duration_ms):
+    """Тишина около duration_ms в формате первого кадра frames: кадры с нулевой побочной информацией"""
+    header = frames[:4]
+    if duration_ms <= 0 or mp3_frame_length(header) is None:
+        return b''
+    # Без CRC и без байта выравнивания - все кадры одной длины
+    header = bytes((header[0], header[1] | 1, header[2] & 0xFD, header[3]))
+    version = (header[1] >> 3) & 3
+    sample_rate = MP3_SAMPLE_RATES[version][(header[2] >> 2) & 3]
+    samples = 1152 if version == 3 else 576
+    count = max(1, round(duration_ms * sample_rate / 1000 / samples))
+    return (header + bytes(mp3_frame_length(header) - 4)) * count
+
+
+class Announcer:
+    """Озвучивание результатов распознавания склейкой заранее синтезированных фрагментов.
+
+    «Обнаружены: две чашки, стол» собирается из MP3 фрагментов «Обнаружены»,
+    «две», «Чашки», «Стол». Каждый фрагмент синтезируется один раз, хранится
+    в TTS-кэше (на диске) и в памяти процесса, поэтому новая комбинация
+    объектов озвучивается без обращения к сети. После префикса и после каждого
+    объекта вставляется пауза pause_ms - кадры тишины, собранные один раз.
+    Пока какого-то фрагмента нет,
+    announce возвращает None - фраза озвучивается целиком, а недостающие
+    фрагменты синтезируются в фоне.
+    """
+
+    PREFIXES = {'ru': "Обнаружены", 'en': "Detected"}
+
+    def __init__(self, cache, render, max_fragments=4096, pause_ms=150):
+        self.cache = cache
+        self.render = render
+        self.pause_ms = pause_ms
+        self.fragments = LRUCache(max_fragments)
+        # Потоки создаются при первой фоновой задаче, то есть уже в воркере
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='announcer')
+        self.pending = set()
+        self._lock = threading.Lock()
+        self.spliced = 0
+        self.cold = 0
+
+    def groups(self, results, lang):
+        """Фрагменты фразы по группам (префикс, затем «числительное название»); между группами - пауза"""
+        groups = [[self.PREFIXES.get(lang, self.PREFIXES['en'])]]
+        for item in results:
+            count = item['count']
+            group = []
+            if count > 1:
+                group.append(spell_number(count, lang, noun_gender(item['name'], count) if lang == 'ru' else 'm'))
+            group.append(item['name'])
+            groups.append(group)
+        return groups
+
+    def parts(self, results, lang):
+        """Тексты фрагментов фразы для списка {name, count}"""
+        return [part for group in self.groups(results, lang) for part in group]
+
+    def fragment(self, text, lang):
+        """Кадры MP3 фрагмента из памяти или TTS-кэша; None, если он еще не синтезирован"""
+        frames = self.fragments.get((lang, text))
+        if frames is None:
+            audio = self.cache.peek(audio_key(text, lang))
+            if audio is not None:
+                frames = mp3_frames(audio)
+                self.fragments.set((lang, text), frames)
+        return frames
+
+    def pause(self, frames):
+        """Кадры паузы в формате frames; собираются один раз на формат"""
+        key = (None, frames[:4])
+        silence = self.fragments.get(key)
+        if silence is None:
+            silence = mp3_silence(frames, self.pause_ms)
+            self.fragments.set(key, silence)
+        return silence
+
+    def announce(self, text, results, lang, persist=False):
+        """(audio_id, аудио) фразы text или None, если фрагменты еще не готовы.
+
+        Готовое аудио всей фразы (синтезированное раньше) берется из кэша как
+        есть. Склейка получает собственный ключ splice_key - по байтам, а не по
+        тексту. persist=True временно сохраняет ее на диск TTS-кэша, чтобы ее
+        можно было отдать по ссылке /api/audio/<audio_id> из любого воркера;
+        навсегда склейки не хранятся - их дешево собрать заново из фрагментов.
+        """
+        key = audio_key(text, lang)
+        audio = self.cache.lookup(key)
+        if audio is not None:
+            return key, audio
+
+        groups = self.groups(results, lang)
+        fragments = {part: self.fragment(part, lang) for group in groups for part in group}
+        missing = [part for part, frames in fragments.items() if frames is None]
+        if missing:
+            self.cold += 1
+            self.prepare(missing, lang)
+            return None
+
+        spoken = [b''.join(fragments[part] for part in group) for group in groups]
+        audio = self.pause(spoken[0]).join(spoken)
+        key = splice_key(audio)
+        if persist:
+            self.cache.store(key, audio, transient=True)
+        self.spliced += 1
+        return key, audio
+
+    def prepare(self, parts, lang):
+        """Синтезирует недостающие фрагменты в фоне (каждый - не больше одного раза за раз)"""
+        with self._lock:
+            new = [(lang, part) for part in dict.fromkeys(parts) if (lang, part) not in self.pending]
+            self.pending.update(new)
+        if new:
+            self.executor.submit(self._synthesize, new)
+
+    def _synthesize(self, parts):
+        for lang, text in parts:
+            try:
+                _, audio = self.cache.get_or_render(text, lang, self.render)
+                self.fragments.set((lang, text), mp3_frames(audio))
+            except Exception as e:
+                logger.error(f"Announcement fragment error: {e}")
+            finally:
+                with self._lock:
+                    self.pending.discard((lang, text))
+
+    def warm_up(self, parts, synthesize=False):
+        """Поднимает фрагменты (текст, язык) с диска; synthesize=True - недостающие синтезирует сразу"""
+        missing = [(lang, text) for text, lang in parts if self.fragment(text, lang) is None]
+        if synthesize and missing:
+            self._synthesize(missing)
+            missing = [(lang, text) for lang, text in missing if self.fragment(text, lang) is None]
+        ready = len(parts) - len(missing)
+        logger.info(f"Announcement fragments ready: {ready} of {len(parts)}")
+        return ready
+
+    def stats(self):
+        return {
+            "spliced": self.spliced,
+            "cold": self.cold,
+            "fragments": len(self.fragments),
+            "pending": len(self.pending)
+        }
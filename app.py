@@ -1,21 +1,36 @@
-from flask import Flask, request, jsonify, render_template, session
+from flask import Flask, request, jsonify, render_template, session, Response, g
 import base64
 import io
+import json
 import os
 import secrets
-from PIL import Image
-import requests
-from collections import defaultdict
+from collections import defaultdict, deque
 from flask_cors import CORS
-from googletrans import Translator
-import openai
 import threading
 import time
 import re
 import logging
 import random
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from datetime import datetime
-from phrases import PHRASES, SCENARIOS
+from phrases import CORRECTION_DICT, PHRASES, SCENARIOS
+from matcher import compile_phrases
+from scenarios import ScenarioEngine
+from tts_cache import TTSCache, static_phrases
+from announcer import Announcer, spell_number
+from translation import LabelTranslator, apply_corrections
+from lexicon import open_lexicon, plural_form
+from chat_cache import ResponseCache, prompt_version
+from sentences import SentenceSplitter, split_sentences
+from frame_cache import FrameCache, image_hash
+from imaging import ImagePreprocessor, ImageTooLarge
+from http_client import HttpClient, AsyncHttpClient, record_upstream
+from metrics import Metrics
+from resilience import (CircuitBreaker, CircuitOpenError, Deadline, DeadlineExceeded, call_timeout, current_deadline,
+                        deadline_scope, submit)
+from conversation_store import create_conversation_store
+from backends import (UpstreamError, split_vision_requests, GoogleVisionBackend, GoogleTranslateBackend, GTTSBackend,
+                      OpenAIChatBackend, LocalVisionBackend, HybridVisionBackend, create_fake_backend)
 
 app = Flask(__name__, 
             template_folder='templates',
@@ -31,115 +46,226 @@ logger = logging.getLogger('DeasanAI')
 # Конфигурация
 AI_MODEL = "gpt-3.5-turbo"
 MAX_OBJECTS_TO_SPEAK = 4
+TTS_CACHE_DIR = os.environ.get('TTS_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'tts'))
+TTS_CACHE_MAX_ITEMS = int(os.environ.get('TTS_CACHE_MAX_ITEMS', 256))
+# Лимит кэша озвучивания на диске; 0 - без ограничения
+TTS_CACHE_MAX_BYTES = int(os.environ.get('TTS_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+TTS_PREWARM = os.environ.get('TTS_PREWARM', '0') == '1'
+# Озвучивание результатов распознавания склейкой готовых фрагментов (announcer.py)
+SPLICED_ANNOUNCEMENTS = os.environ.get('SPLICED_ANNOUNCEMENTS', '1') == '1'
+ANNOUNCER_MAX_FRAGMENTS = int(os.environ.get('ANNOUNCER_MAX_FRAGMENTS', 4096))
+ANNOUNCER_PAUSE_MS = int(os.environ.get('ANNOUNCER_PAUSE_MS', 150))
+# Числительные, которые озвучиваются заранее (Vision возвращает до 10 объектов)
+ANNOUNCE_MAX_COUNT = 10
+# inline - base64 внутри JSON, url - ссылка на /api/audio/<audio_id>
+AUDIO_DELIVERY = os.environ.get('AUDIO_DELIVERY', 'inline')
+AUDIO_MAX_AGE = 365 * 24 * 3600
+AUDIO_URL = '/api/audio/{audio_id}'
+TRANSLATION_CACHE_TTL = int(os.environ.get('TRANSLATION_CACHE_TTL', 24 * 3600))
+TRANSLATION_NEGATIVE_TTL = int(os.environ.get('TRANSLATION_NEGATIVE_TTL', 300))
+# Словарь меток с готовыми русскими формами (python lexicon.py lexicon/labels.tsv ...); пусто - без словаря
+LABEL_LEXICON = os.environ.get('LABEL_LEXICON', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lexicon', 'labels.lex'))
+FRAME_CACHE_MAX_DISTANCE = int(os.environ.get('FRAME_CACHE_MAX_DISTANCE', 6))
+FRAME_CACHE_TTL = float(os.environ.get('FRAME_CACHE_TTL', 10))
+FRAME_CACHE_FRAMES_PER_USER = int(os.environ.get('FRAME_CACHE_FRAMES_PER_USER', 8))
+FRAME_CACHE_MAX_USERS = int(os.environ.get('FRAME_CACHE_MAX_USERS', 1024))
+IMAGE_MAX_EDGE = int(os.environ.get('IMAGE_MAX_EDGE', 1024))
+IMAGE_PASSTHROUGH_BYTES = int(os.environ.get('IMAGE_PASSTHROUGH_BYTES', 512 * 1024))
+IMAGE_MAX_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', 40_000_000))
+IMAGE_MAX_BYTES = int(os.environ.get('IMAGE_MAX_BYTES', 10 * 1024 * 1024))
+IMAGE_JPEG_QUALITY = int(os.environ.get('IMAGE_JPEG_QUALITY', 85))
+# Пулы соединений считаются на один воркер gunicorn
+HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', 4))
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', 10))
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', 2))
+ASYNC_HTTP_POOL_LIMIT = int(os.environ.get('ASYNC_HTTP_POOL_LIMIT', 200))
+ASYNC_BLOCKING_WORKERS = int(os.environ.get('ASYNC_BLOCKING_WORKERS', 32))
+# Перевод и озвучивание после ответа Vision: размер пула и срок на перевод меток (сек)
+DETECT_FANOUT_WORKERS = int(os.environ.get('DETECT_FANOUT_WORKERS', 16))
+DETECT_TRANSLATE_DEADLINE = float(os.environ.get('DETECT_TRANSLATE_DEADLINE', 2))
+DETECT_BATCH_MAX_FRAMES = int(os.environ.get('DETECT_BATCH_MAX_FRAMES', 64))
+# Параллельный синтез предложений потокового ответа
+SPEECH_STREAM_WORKERS = int(os.environ.get('SPEECH_STREAM_WORKERS', 8))
+SERVICE_TIMEOUTS = {
+    'vision': float(os.environ.get('VISION_TIMEOUT', 15)),
+    'translate': float(os.environ.get('TRANSLATE_TIMEOUT', 5)),
+    'tts': float(os.environ.get('TTS_TIMEOUT', 10)),
+    'openai': float(os.environ.get('OPENAI_TIMEOUT', 30))
+}
+# Бэкенды внешних сервисов: real - настоящие API, fake - локальные заглушки
+DEFAULT_BACKEND = os.environ.get('DEASAN_BACKENDS', 'real')
+BACKEND_NAMES = {service: os.environ.get(f'{service.upper()}_BACKEND', DEFAULT_BACKEND)
+                 for service in ('vision', 'translate', 'tts', 'openai')}
+VISION_API_URL = os.environ.get('VISION_API_URL', 'https://vision.googleapis.com/v1/images:annotate')
+# Порог уверенности, с которым объект попадает в ответ
+OBJECT_SCORE_THRESHOLD = 0.7
+# VISION_BACKEND=local - детектор ONNX на CPU, hybrid - локально, а неуверенные кадры в Vision
+LOCAL_DETECTOR_MODEL = os.environ.get('LOCAL_DETECTOR_MODEL')
+LOCAL_DETECTOR_LABELS = os.environ.get('LOCAL_DETECTOR_LABELS')
+LOCAL_DETECTOR_MIN_SCORE = float(os.environ.get('LOCAL_DETECTOR_MIN_SCORE', 0.3))
+LOCAL_DETECTOR_BOX_FORMAT = os.environ.get('LOCAL_DETECTOR_BOX_FORMAT', 'yxyx')
+LOCAL_DETECTOR_TIMEOUT = float(os.environ.get('LOCAL_DETECTOR_TIMEOUT', 5))
+# Процессов детектора на один воркер gunicorn: по умолчанию ядра делятся между воркерами
+LOCAL_DETECTOR_PROCESSES = int(os.environ.get('LOCAL_DETECTOR_PROCESSES',
+                                              max(1, (os.cpu_count() or 1) // int(os.environ.get('WEB_CONCURRENCY', 1)))))
+# Бэкенд Vision для неуверенных кадров в режиме hybrid
+VISION_FALLBACK_BACKEND = os.environ.get('VISION_FALLBACK_BACKEND', 'real')
+# Диалоги и память пользователей: memory - в процессе, sqlite - общий файл для всех воркеров
+CONVERSATION_STORE = os.environ.get('CONVERSATION_STORE', 'memory')
+CONVERSATION_DB = os.environ.get('CONVERSATION_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'conversations.sqlite3'))
+CONVERSATION_MAX_TURNS = int(os.environ.get('CONVERSATION_MAX_TURNS', 10))
+CONVERSATION_MAX_USERS = int(os.environ.get('CONVERSATION_MAX_USERS', 10000))
+CONVERSATION_TTL = int(os.environ.get('CONVERSATION_TTL', 24 * 3600))
+# Кэш ответов OpenAI на повторяющиеся вопросы
+CHAT_CACHE_ENABLED = os.environ.get('CHAT_CACHE_ENABLED', '1') == '1'
+CHAT_CACHE_TTL = int(os.environ.get('CHAT_CACHE_TTL', 6 * 3600))
+CHAT_CACHE_MAX_ITEMS = int(os.environ.get('CHAT_CACHE_MAX_ITEMS', 2048))
+# Незавершенный сценарий (список, напоминание) сбрасывается после паузы в секундах
+SCENARIO_IDLE_TIMEOUT = int(os.environ.get('SCENARIO_IDLE_TIMEOUT', 300))
+SCENARIO_MAX_DIALOGUES = int(os.environ.get('SCENARIO_MAX_DIALOGUES', 10000))
+# Каталог для снимков метрик воркеров gunicorn (без него /metrics показывает один процесс)
+METRICS_DIR = os.environ.get('METRICS_DIR')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+STAGE_SECONDS = 'deasan_stage_seconds'
+# Общий срок обработки запроса (сек) по эндпоинтам; вызовы сервисов получают
+# долю оставшегося срока, но не больше своего SERVICE_TIMEOUTS
+REQUEST_DEADLINES = {
+    'detect_objects': float(os.environ.get('DETECT_DEADLINE', 8)),
+    'detect_batch': float(os.environ.get('DETECT_BATCH_DEADLINE', 20)),
+    'api_process_command': float(os.environ.get('COMMAND_DEADLINE', 25)),
+    'api_process_command_stream': float(os.environ.get('COMMAND_STREAM_DEADLINE', 60))
+}
+DEADLINE_SHARES = {'vision': 0.6, 'translate': 0.5, 'tts': 0.7, 'openai': 0.9}
+# Предохранители: после BREAKER_FAILURES ошибок подряд сервис не вызывается BREAKER_RESET_TIMEOUT секунд
+BREAKER_FAILURES = int(os.environ.get('BREAKER_FAILURES', 5))
+BREAKER_RESET_TIMEOUT = float(os.environ.get('BREAKER_RESET_TIMEOUT', 30))
 
 # Инициализация компонентов
-translator = Translator()
-
-# Словари для коррекции и команд
-CORRECTION_DICT = {
-    "челоек": "человек",
-    "персон": "человек",
-    "авто": "автомобиль",
-    "машина": "автомобиль",
-    "бутылк": "бутылка",
-    "телефон": "смартфон"
-}
+metrics = Metrics(METRICS_DIR, METRICS_FLUSH_INTERVAL)
+metrics.describe(STAGE_SECONDS, "Duration of request processing stages")
+metrics.describe('deasan_upstream_seconds', "Duration of calls to external services")
+metrics.describe('deasan_upstream_errors_total', "Failed calls to external services")
+metrics.describe('deasan_upstream_timeouts_total', "Timed out calls to external services")
+metrics.describe('deasan_requests_total', "HTTP requests by endpoint and status")
+metrics.describe('deasan_cache_events_total', "Cache hits and misses")
+metrics.describe('deasan_stream_dropped_frames_total', "Streamed frames dropped while another was in flight")
+metrics.describe('deasan_circuit_state', "Circuit breaker state: 0 closed, 1 half-open, 2 open")
+metrics.describe('deasan_circuit_opened_total', "Times a circuit breaker opened")
+metrics.describe('deasan_circuit_rejected_total', "Calls rejected by an open circuit breaker")
+metrics.describe('deasan_vision_frames_total', "Frames answered by the local detector or sent to Vision in hybrid mode")
+# Поток сброса метрик запускается в init_worker: в мастере gunicorn до fork потоков быть не должно
+
+http_client = HttpClient(HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE, SERVICE_TIMEOUTS, HTTP_RETRIES,
+                         metrics=metrics)
+async_http_client = AsyncHttpClient(ASYNC_HTTP_POOL_LIMIT, ASYNC_HTTP_POOL_LIMIT, SERVICE_TIMEOUTS,
+                                    HTTP_RETRIES, metrics=metrics)
 
+def create_backend(service, name=None):
+    """Создает бэкенд сервиса по конфигурации <SERVICE>_BACKEND"""
+    name = name or BACKEND_NAMES[service]
+    if service == 'vision' and name in ('local', 'hybrid'):
+        local = LocalVisionBackend(LOCAL_DETECTOR_MODEL, LOCAL_DETECTOR_LABELS, LOCAL_DETECTOR_PROCESSES,
+                                   LOCAL_DETECTOR_MIN_SCORE, timeout=LOCAL_DETECTOR_TIMEOUT,
+                                   box_format=LOCAL_DETECTOR_BOX_FORMAT)
+        if name == 'local':
+            return local
+        return HybridVisionBackend(local, create_backend('vision', VISION_FALLBACK_BACKEND), OBJECT_SCORE_THRESHOLD,
+                                   breaker=CircuitBreaker('vision_remote', BREAKER_FAILURES, BREAKER_RESET_TIMEOUT))
+    if name == 'fake':
+        prefix = f'FAKE_{service.upper()}'
+        return create_fake_backend(service,
+                                   latency=float(os.environ.get(f'{prefix}_LATENCY', 0)),
+                                   jitter=float(os.environ.get(f'{prefix}_JITTER', 0)),
+                                   error_rate=float(os.environ.get(f'{prefix}_ERROR_RATE', 0)))
+    if service == 'vision':
+        return GoogleVisionBackend(http_client, async_http_client, os.environ.get('GOOGLE_API_KEY'), VISION_API_URL)
+    if service == 'translate':
+        return GoogleTranslateBackend(http_client, SERVICE_TIMEOUTS['translate'])
+    if service == 'tts':
+        return GTTSBackend(http_client)
+    return OpenAIChatBackend(lambda: http_client.session, async_http_client.session)
+
+vision_backend = create_backend('vision')
+translate_backend = create_backend('translate')
+tts_backend = create_backend('tts')
+chat_backend = create_backend('openai')
+upstream_backends = (vision_backend, translate_backend, tts_backend, chat_backend)
+circuit_breakers = {service: CircuitBreaker(service, BREAKER_FAILURES, BREAKER_RESET_TIMEOUT)
+                    for service in ('vision', 'translate', 'tts', 'openai')}
+if isinstance(vision_backend, HybridVisionBackend):
+    circuit_breakers['vision_remote'] = vision_backend.breaker
+
+# Словари команд
 OBJECT_RECOGNITION_TRIGGERS = [
     "распознай", "что передо мной", "что видишь", "что перед камерой", "что стоит", 
     "сфоткай", "скажи что тут", "опиши окружение",
     "что вокруг", "какие предметы"
 ]
 
+conversation_store = create_conversation_store(CONVERSATION_STORE, CONVERSATION_DB,
+                                               max_turns=CONVERSATION_MAX_TURNS,
+                                               max_users=CONVERSATION_MAX_USERS,
+                                               ttl=CONVERSATION_TTL)
+
+chat_cache = ResponseCache(CHAT_CACHE_TTL, CHAT_CACHE_MAX_ITEMS, wait_timeout=SERVICE_TIMEOUTS['openai'])
+
 class ConversationManager:
-    def __init__(self):
-        self.conversation_history = defaultdict(list)
-        self.current_topics = {}
+    def __init__(self, store):
+        self.store = store
         
     def add_to_history(self, user_id, role, text):
         """Добавляет реплику в историю диалога"""
-        self.conversation_history[user_id].append({"role": role, "content": text})
-        if len(self.conversation_history[user_id]) > 10:
-            self.conversation_history[user_id].pop(0)
+        self.store.append(user_id, role, text)
             
     def get_context(self, user_id):
         """Возвращает контекст диалога"""
-        return self.conversation_history.get(user_id, [])
+        return self.store.history(user_id)
         
     def set_topic(self, user_id, topic):
         """Устанавливает текущую тему разговора"""
-        self.current_topics[user_id] = topic
+        self.store.remember(user_id, 'topic', topic)
         
     def get_topic(self, user_id):
         """Получает текущую тему разговора"""
-        return self.current_topics.get(user_id)
+        return self.store.recall(user_id, 'topic')
 
 class DeasanAI:
     def __init__(self):
         self.local_responses = PHRASES
-        self.context_scenarios = SCENARIOS
+        self.context_scenarios = ScenarioEngine(SCENARIOS, SCENARIO_IDLE_TIMEOUT, SCENARIO_MAX_DIALOGUES)
+        self.phrase_matchers = compile_phrases(PHRASES)
         
-        self.current_context = None
-        self.context_data = {}
-        self.user_memory = defaultdict(dict)
+        self.user_memory = conversation_store
     
-    def get_local_response(self, command, lang):
+    def get_local_response(self, command, lang, user_id='default'):
         """Получает локальный ответ без обращения к API"""
         command_lower = command.lower()
         
-        # 1. Проверка точных совпадений
-        for question, answers in self.local_responses[lang].items():
-            if question in command_lower:
-                if isinstance(answers, list):
-                    return random.choice(answers)
-                return answers
-                
-        # 2. Проверка частичных совпадений
-        for question, answers in self.local_responses[lang].items():
-            if any(word in command_lower for word in question.split()):
-                if isinstance(answers, list):
-                    return random.choice(answers)
-                return answers
-                
-        # 3. Контекстно-зависимые ответы
-        if self.current_context:
-            return self.handle_context(command, lang)
+        # 1. Активный или запускаемый сценарий пользователя
+        scenario_response = self.handle_context(command, user_id)
+        if scenario_response:
+            return scenario_response
+        
+        # 2-3. Точные и частичные совпадения за один проход автомата
+        question = self.phrase_matchers[lang].match(command_lower)
+        if question is not None:
+            answers = self.local_responses[lang][question]
+            if isinstance(answers, list):
+                return random.choice(answers)
+            return answers
             
         return None
     
-    def handle_context(self, command, lang):
-        """Обработка контекстных сценариев"""
-        command_lower = command.lower()
-        scenario = self.context_scenarios[self.current_context]
-        
-        if self.current_context == "list_creation":
-            if "закончи" in command_lower or "хватит" in command_lower:
-                self.current_context = None
-                count = len(self.context_data.get('items', []))
-                return random.choice(scenario['complete']).format(count=count)
-            else:
-                self.context_data.setdefault('items', []).append(command)
-                return random.choice(scenario['add_item']).format(item=command)
-                
-        elif self.current_context == "reminder":
-            if not self.context_data.get('what'):
-                self.context_data['what'] = command
-                return random.choice(scenario['when'])
-            else:
-                self.context_data['when'] = command
-                self.current_context = None
-                return random.choice(scenario['confirm']).format(
-                    text=self.context_data['what'],
-                    time=self.context_data['when']
-                )
-        return None
+    def handle_context(self, command, user_id='default'):
+        """Обработка контекстных сценариев (состояние у каждого пользователя свое)"""
+        return self.context_scenarios.respond(user_id, command)
     
     def process_personal_questions(self, command, lang, user_id):
         """Обработка персональных вопросов"""
         command_lower = command.lower()
         
         if "как меня зовут" in command_lower:
-            name = self.user_memory[user_id].get('name')
+            name = self.user_memory.recall(user_id, 'name')
             if name:
                 return f"Вы говорили, что вас зовут {name}."
             return random.choice(self.local_responses[lang]["как меня зовут"])
@@ -148,57 +274,247 @@ class DeasanAI:
             name = re.search(r'(меня зовут|мое имя) ([\w\s]+)', command_lower)
             if name:
                 name = name.group(2).strip().title()
-                self.user_memory[user_id]['name'] = name
+                self.user_memory.remember(user_id, 'name', name)
                 return f"Очень приятно, {name}! Я запомнил ваше имя."
             return "Как именно вас зовут?"
             
         return None
     
-    def process_command(self, command, lang, user_id='default'):
-        """Обрабатывает команду с максимально возможным качеством"""
-        try:
-            # 1. Проверка персональных вопросов
+    def answer_locally(self, command, lang, user_id='default'):
+        """Отвечает без обращения к API или возвращает None"""
+        # 1. Проверка персональных вопросов
+        with metrics.timer(STAGE_SECONDS, endpoint='command', stage='personal'):
             personal_response = self.process_personal_questions(command, lang, user_id)
-            if personal_response:
-                return personal_response
+        if personal_response:
+            return personal_response
+
+        # 2. Проверка локальных ответов
+        with metrics.timer(STAGE_SECONDS, endpoint='command', stage='local_match'):
+            local_response = self.get_local_response(command, lang, user_id)
+        if local_response:
+            # Заменяем динамические данные
+            if "{current_time}" in local_response:
+                current_time = datetime.now().strftime("%H:%M")
+                local_response = local_response.format(current_time=current_time)
+            elif "{current_date}" in local_response:
+                current_date = datetime.now().strftime("%d.%m.%Y")
+                local_response = local_response.format(current_date=current_date)
+            elif "{weekday}" in local_response:
+                weekdays = ["понедельник", "вторник", "среда", "четверг", "пятница", "суббота", "воскресенье"]
+                weekday = weekdays[datetime.now().weekday()]
+                local_response = local_response.format(weekday=weekday)
+            
+            return local_response
+        
+        return None
+
+    def completion_params(self, command, lang):
+        """Параметры запроса к OpenAI"""
+        return dict(
+            model=AI_MODEL,
+            messages=[
+                {"role": "system", "content": self.get_system_prompt(lang)},
+                {"role": "user", "content": command}
+            ],
+            temperature=0.7,
+            max_tokens=500,
+            request_timeout=SERVICE_TIMEOUTS['openai']
+        )
+
+    def prompt_version(self, params):
+        """Версия промпта для ключа кэша ответов"""
+        return prompt_version(params['model'], params['messages'][0]['content'],
+                              params['temperature'], params['max_tokens'])
+
+    def openai_params(self, params):
+        """Параметры с таймаутом, урезанным до оставшегося срока запроса"""
+        return dict(params, request_timeout=call_timeout('openai', params['request_timeout']))
+
+    def complete(self, params):
+        """Запрос к OpenAI с записью длительности и ошибок"""
+        with circuit_breakers['openai'].guard():
+            params = self.openai_params(params)
+            started = time.perf_counter()
+            try:
+                answer = chat_backend.complete(params)
+            except Exception as e:
+                record_upstream(metrics, 'openai', started, e)
+                raise
+        record_upstream(metrics, 'openai', started)
+        metrics.observe(STAGE_SECONDS, time.perf_counter() - started, endpoint='command', stage='openai')
+        return answer
+
+    async def acomplete(self, params):
+        """Асинхронный вариант complete"""
+        with circuit_breakers['openai'].guard():
+            params = self.openai_params(params)
+            started = time.perf_counter()
+            try:
+                answer = await chat_backend.acomplete(params)
+            except Exception as e:
+                record_upstream(metrics, 'openai', started, e)
+                raise
+        record_upstream(metrics, 'openai', started)
+        metrics.observe(STAGE_SECONDS, time.perf_counter() - started, endpoint='command', stage='openai')
+        return answer
 
-            # 2. Проверка локальных ответов
-            local_response = self.get_local_response(command, lang)
+    def process_command(self, command, lang, user_id='default', use_cache=True):
+        """Обрабатывает команду с максимально возможным качеством"""
+        try:
+            # 1-2. Персональные вопросы и локальные ответы
+            local_response = self.answer_locally(command, lang, user_id)
             if local_response:
-                # Заменяем динамические данные
-                if "{current_time}" in local_response:
-                    current_time = datetime.now().strftime("%H:%M")
-                    local_response = local_response.format(current_time=current_time)
-                elif "{current_date}" in local_response:
-                    current_date = datetime.now().strftime("%d.%m.%Y")
-                    local_response = local_response.format(current_date=current_date)
-                elif "{weekday}" in local_response:
-                    weekdays = ["понедельник", "вторник", "среда", "четверг", "пятница", "суббота", "воскресенье"]
-                    weekday = weekdays[datetime.now().weekday()]
-                    local_response = local_response.format(weekday=weekday)
-                
                 return local_response
 
             # 3. Использование OpenAI если доступно
-            if openai.api_key:
-                response = openai.ChatCompletion.create(
-                    model=AI_MODEL,
-                    messages=[
-                        {"role": "system", "content": self.get_system_prompt(lang)},
-                        {"role": "user", "content": command}
-                    ],
-                    temperature=0.7,
-                    max_tokens=500
-                )
-                return response.choices[0].message['content']
+            if chat_backend.available:
+                params = self.completion_params(command, lang)
+                return chat_cache.get_or_complete(command, lang, self.prompt_version(params),
+                                                  lambda: self.complete(params),
+                                                  use_cache and CHAT_CACHE_ENABLED)
 
             # 4. Запасной вариант
             return self.get_fallback_response(lang)
 
+        except UpstreamError as e:
+            # Предохранитель разомкнут или срок запроса исчерпан - отвечаем без OpenAI
+            logger.warning(f"AI unavailable: {e}")
+            return self.get_fallback_response(lang)
         except Exception as e:
             logger.error(f"AI processing error: {e}")
             return self.get_error_response(lang)
 
+    async def aprocess_command(self, command, lang, user_id='default', use_cache=True):
+        """Асинхронный вариант process_command: запрос к OpenAI не блокирует поток"""
+        try:
+            local_response = self.answer_locally(command, lang, user_id)
+            if local_response:
+                return local_response
+
+            if chat_backend.available:
+                params = self.completion_params(command, lang)
+                return await chat_cache.aget_or_complete(command, lang, self.prompt_version(params),
+                                                         lambda: self.acomplete(params),
+                                                         use_cache and CHAT_CACHE_ENABLED)
+
+            return self.get_fallback_response(lang)
+
+        except UpstreamError as e:
+            # Предохранитель разомкнут или срок запроса исчерпан - отвечаем без OpenAI
+            logger.warning(f"AI unavailable: {e}")
+            return self.get_fallback_response(lang)
+        except Exception as e:
+            logger.error(f"AI processing error: {e}")
+            return self.get_error_response(lang)
+
+    def stream_answer(self, command, lang, user_id='default', use_cache=True, transcript=None):
+        """Ответ по предложениям: ответ OpenAI режется на предложения по мере генерации.
+
+        transcript - список, в который складывается исходный текст ответа (фрагменты
+        модели как есть): разбиение на предложения теряет переводы строк и пробелы.
+        """
+        transcript = [] if transcript is None else transcript
+        try:
+            local_response = self.answer_locally(command, lang, user_id)
+            if local_response:
+                transcript.append(local_response)
+                yield from split_sentences(local_response)
+                return
+
+            if not chat_backend.available:
+                yield self.replace_transcript(transcript, self.get_fallback_response(lang))
+                return
+
+            params = self.completion_params(command, lang)
+            version = self.prompt_version(params)
+            use_cache = use_cache and CHAT_CACHE_ENABLED
+            cached = chat_cache.peek(command, lang, version) if use_cache else None
+            if cached:
+                transcript.append(cached)
+                yield from split_sentences(cached)
+                return
+
+            splitter = SentenceSplitter()
+            with circuit_breakers['openai'].guard():
+                params = self.openai_params(params)
+                started = time.perf_counter()
+                try:
+                    for delta in chat_backend.stream(params):
+                        transcript.append(delta)
+                        yield from splitter.feed(delta)
+                except Exception as e:
+                    record_upstream(metrics, 'openai', started, e)
+                    raise
+            record_upstream(metrics, 'openai', started)
+            metrics.observe(STAGE_SECONDS, time.perf_counter() - started, endpoint='command_stream', stage='openai')
+            yield from splitter.flush()
+            if use_cache:
+                chat_cache.put(command, lang, version, ''.join(transcript).strip())
+
+        except UpstreamError as e:
+            logger.warning(f"AI unavailable: {e}")
+            yield self.replace_transcript(transcript, self.get_fallback_response(lang))
+        except Exception as e:
+            logger.error(f"AI processing error: {e}")
+            yield self.replace_transcript(transcript, self.get_error_response(lang))
+
+    @staticmethod
+    def replace_transcript(transcript, message):
+        """Запасной ответ вместо текста модели - как в process_command"""
+        transcript[:] = [message]
+        return message
+
+    async def astream_answer(self, command, lang, user_id='default', use_cache=True, transcript=None):
+        """Асинхронный вариант stream_answer"""
+        transcript = [] if transcript is None else transcript
+        try:
+            local_response = self.answer_locally(command, lang, user_id)
+            if local_response:
+                transcript.append(local_response)
+                for sentence in split_sentences(local_response):
+                    yield sentence
+                return
+
+            if not chat_backend.available:
+                yield self.replace_transcript(transcript, self.get_fallback_response(lang))
+                return
+
+            params = self.completion_params(command, lang)
+            version = self.prompt_version(params)
+            use_cache = use_cache and CHAT_CACHE_ENABLED
+            cached = chat_cache.peek(command, lang, version) if use_cache else None
+            if cached:
+                transcript.append(cached)
+                for sentence in split_sentences(cached):
+                    yield sentence
+                return
+
+            splitter = SentenceSplitter()
+            with circuit_breakers['openai'].guard():
+                params = self.openai_params(params)
+                started = time.perf_counter()
+                try:
+                    async for delta in chat_backend.astream(params):
+                        transcript.append(delta)
+                        for sentence in splitter.feed(delta):
+                            yield sentence
+                except Exception as e:
+                    record_upstream(metrics, 'openai', started, e)
+                    raise
+            record_upstream(metrics, 'openai', started)
+            metrics.observe(STAGE_SECONDS, time.perf_counter() - started, endpoint='command_stream', stage='openai')
+            for sentence in splitter.flush():
+                yield sentence
+            if use_cache:
+                chat_cache.put(command, lang, version, ''.join(transcript).strip())
+
+        except UpstreamError as e:
+            logger.warning(f"AI unavailable: {e}")
+            yield self.replace_transcript(transcript, self.get_fallback_response(lang))
+        except Exception as e:
+            logger.error(f"AI processing error: {e}")
+            yield self.replace_transcript(transcript, self.get_error_response(lang))
+
     def get_system_prompt(self, lang):
         """Возвращает системный промпт для AI"""
         if lang == 'ru':
@@ -229,41 +545,107 @@ class DeasanAI:
             return "A technical error occurred. Please try again later."
 
 deasan_ai = DeasanAI()
-conversation_manager = ConversationManager()
+conversation_manager = ConversationManager(conversation_store)
 
-def speak(text, lang=None):
-    """Озвучивает текст с использованием gTTS (возвращает base64 аудио)"""
-    if not lang:
-        lang = session.get('language', 'ru')
-    
-    try:
-        # Очистка текста от специальных символов
-        clean_text = re.sub(r'[^\w\s.,!?-]', '', text)
-        
-        from gtts import gTTS
-        import io
-        import base64
-        
-        tts = gTTS(text=clean_text, lang='ru' if lang == 'ru' else 'en')
-        audio_bytes = io.BytesIO()
-        tts.write_to_fp(audio_bytes)
-        audio_bytes.seek(0)
-        
+tts_cache = TTSCache(TTS_CACHE_DIR or None, TTS_CACHE_MAX_ITEMS, TTS_CACHE_MAX_BYTES)
+
+def synthesize_speech(clean_text, lang):
+    """Синтезирует речь (gTTS или заглушка) и возвращает байты MP3"""
+    return circuit_breakers['tts'].call(tts_backend.synthesize, clean_text, lang)
+
+def get_audio_delivery(data=None):
+    """Способ доставки аудио: из запроса клиента или из конфигурации"""
+    if data is None:
+        data = request.get_json(silent=True) or {}
+    delivery = data.get('audio_delivery', AUDIO_DELIVERY)
+    return delivery if delivery in ('inline', 'url') else AUDIO_DELIVERY
+
+def speech_payload(audio_id, audio, text, delivery):
+    """Аудио для ответа: base64 или ссылка на /api/audio/<audio_id>"""
+    if delivery == 'url':
         return {
-            'audio': base64.b64encode(audio_bytes.read()).decode('utf-8'),
+            'audio_id': audio_id,
+            'audio_url': AUDIO_URL.format(audio_id=audio_id),
             'text': text
         }
+    return {
+        'audio': base64.b64encode(audio).decode('utf-8'),
+        'text': text
+    }
+
+def render_speech(text, lang, delivery='inline'):
+    """Озвучивает текст без обращения к контексту запроса Flask"""
+    try:
+        audio_id, audio = tts_cache.get_or_render(text, lang, synthesize_speech)
+        return speech_payload(audio_id, audio, text, delivery)
                 
     except Exception as e:
         logger.error(f"Ошибка озвучивания: {e}")
         return None
 
+def speak(text, lang=None, delivery=None):
+    """Озвучивает текст с использованием gTTS (возвращает base64 аудио или ссылку на него)"""
+    if not lang:
+        lang = session.get('language', 'ru')
+    if not delivery:
+        delivery = get_audio_delivery()
+    
+    return render_speech(text, lang, delivery)
+
+def attach_audio(response, audio_data):
+    """Добавляет в ответ аудио (base64 или ссылку) из результата speak()"""
+    if audio_data:
+        for field in ('audio', 'audio_id', 'audio_url'):
+            if field in audio_data:
+                response[field] = audio_data[field]
+    return response
+
+def speech_phrases():
+    """Статические ответы и служебные фразы, которые стоит держать озвученными"""
+    texts = list(static_phrases(PHRASES))
+    for lang in ('ru', 'en'):
+        texts.append((recognition_message(lang), lang))
+        texts.append((deasan_ai.get_error_response(lang), lang))
+        texts.append((deasan_ai.get_fallback_response(lang), lang))
+    return texts
+
+announcer = Announcer(tts_cache, synthesize_speech, ANNOUNCER_MAX_FRAGMENTS, ANNOUNCER_PAUSE_MS)
+
+def render_announcement(results, lang, delivery='inline'):
+    """Озвучивает результат распознавания: склейка готовых фрагментов или синтез фразы целиком"""
+    text = announcement_text(results, lang)
+    if SPLICED_ANNOUNCEMENTS:
+        spliced = announcer.announce(text, results[:MAX_OBJECTS_TO_SPEAK], lang, persist=delivery == 'url')
+        if spliced is not None:
+            return speech_payload(*spliced, text, delivery)
+    return render_speech(text, lang, delivery)
+
+def announcement_fragments():
+    """Фрагменты фраз распознавания: префиксы, числительные и названия из словаря меток"""
+    parts = [(prefix, lang) for lang, prefix in Announcer.PREFIXES.items()]
+    for count in range(2, ANNOUNCE_MAX_COUNT + 1):
+        parts += [(spell_number(count, 'ru', gender), 'ru') for gender in ('m', 'f')]
+        parts.append((spell_number(count, 'en'), 'en'))
+    if label_lexicon is not None:
+        for label, entry in label_lexicon.entries():
+            parts += [(form.capitalize(), 'ru') for form in (entry.one, entry.few, entry.many)]
+            parts += [(label.capitalize(), 'en'), (label.capitalize() + 's', 'en')]
+    return list(dict.fromkeys(parts))
+
+def warm_tts_cache():
+    """Заранее озвучивает все статические ответы и служебные фразы"""
+    return tts_cache.warm_up(speech_phrases(), synthesize_speech)
+
 def should_recognize_objects(command):
     """Определяет, нужно ли распознавать объекты"""
     command_lower = command.lower()
     return any(trigger in command_lower for trigger in OBJECT_RECOGNITION_TRIGGERS)
 
-def process_voice_command(command, user_id='default'):
+def recognition_message(lang):
+    """Ответ на команду распознавания объектов"""
+    return "Распознаю объекты перед вами" if lang == 'ru' else "Recognizing objects"
+
+def process_voice_command(command, user_id='default', use_cache=True):
     """Обрабатывает голосовую команду"""
     try:
         lang = session.get('language', 'ru')
@@ -271,31 +653,27 @@ def process_voice_command(command, user_id='default'):
         if should_recognize_objects(command):
             response = {
                 "type": "object_recognition",
-                "message": "Распознаю объекты перед вами" if lang == 'ru' else "Recognizing objects"
+                "message": recognition_message(lang)
             }
-            audio_data = speak(response["message"], lang)
-            if audio_data:
-                response['audio'] = audio_data['audio']
-            return response
+            with metrics.timer(STAGE_SECONDS, endpoint='command', stage='tts'):
+                audio_data = speak(response["message"], lang)
+            return attach_audio(response, audio_data)
         else:
-            ai_response = deasan_ai.process_command(command, lang, user_id)
-            audio_data = speak(ai_response, lang)
+            ai_response = deasan_ai.process_command(command, lang, user_id, use_cache)
+            with metrics.timer(STAGE_SECONDS, endpoint='command', stage='tts'):
+                audio_data = speak(ai_response, lang)
             response = {
                 "type": "ai_response",
                 "message": ai_response
             }
-            if audio_data:
-                response['audio'] = audio_data['audio']
-            return response
+            return attach_audio(response, audio_data)
     
     except Exception as e:
         logger.error(f"Error processing voice command: {e}")
         error_msg = deasan_ai.get_error_response(session.get('language', 'ru'))
         audio_data = speak(error_msg)
         response = {"error": str(e)}
-        if audio_data:
-            response['audio'] = audio_data['audio']
-        return response
+        return attach_audio(response, audio_data)
 
 @app.route('/')
 def index():
@@ -319,13 +697,14 @@ def api_process_command():
             
         data = request.json
         command = data.get('command', '')
-        user_id = data.get('user_id', 'default')
+        user_id = get_user_id(data)
         
         # Добавляем реплику пользователя в историю
         conversation_manager.add_to_history(user_id, "user", command)
         
         # Обработка команды
-        response = process_voice_command(command)
+        with metrics.timer(STAGE_SECONDS, endpoint='command', stage='total'):
+            response = process_voice_command(command, user_id, data.get('cache', True) is not False)
         response['assistant_speaking'] = True
         
         # Обновляем историю диалога
@@ -338,131 +717,490 @@ def api_process_command():
         logger.error(f"Command processing error: {e}")
         return jsonify({"error": str(e)}), 500
 
+speech_executor = ThreadPoolExecutor(max_workers=SPEECH_STREAM_WORKERS, thread_name_prefix='speech')
+
+def sentence_event(index, text, audio_data):
+    """Строка NDJSON потокового ответа: предложение и его аудио"""
+    return attach_audio({"type": "sentence", "index": index, "text": text}, audio_data)
+
+def ndjson(event):
+    return json.dumps(event, ensure_ascii=False) + '\n'
+
+def stream_command_events(command, lang, user_id, delivery, use_cache=True):
+    """События потокового ответа на команду.
+
+    Каждое законченное предложение сразу уходит на синтез в speech_executor,
+    события отдаются строго по порядку предложений. Последнее событие done
+    содержит исходный текст ответа (с переводами строк), он же попадает в
+    историю диалога.
+    """
+    started = time.perf_counter()
+    if should_recognize_objects(command):
+        message = recognition_message(lang)
+        yield attach_audio({"type": "object_recognition", "message": message},
+                           render_speech(message, lang, delivery))
+        yield {"type": "done", "message": message}
+        return
+
+    sentences = []
+    transcript = []
+    pending = deque()
+
+    def ready(wait):
+        while pending and (wait or pending[0][2].done()):
+            index, text, future = pending.popleft()
+            if index == 0:
+                metrics.observe(STAGE_SECONDS, time.perf_counter() - started,
+                                endpoint='command_stream', stage='first_sentence')
+            yield sentence_event(index, text, future.result())
+
+    for sentence in deasan_ai.stream_answer(command, lang, user_id, use_cache, transcript):
+        pending.append((len(sentences), sentence,
+                        submit(speech_executor, render_speech, sentence, lang, delivery)))
+        sentences.append(sentence)
+        yield from ready(False)
+    yield from ready(True)
+
+    metrics.observe(STAGE_SECONDS, time.perf_counter() - started, endpoint='command_stream', stage='total')
+    yield {"type": "done", "message": ''.join(transcript)}
+
+@app.route('/api/process_command/stream', methods=['POST'])
+def api_process_command_stream():
+    """Потоковый ответ на команду (NDJSON): предложения с аудио по мере готовности"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "Invalid JSON"}), 400
+    if data.get('is_voice') and not session.get('voice_input_enabled', True):
+        return jsonify({
+            "error": "Голосовой ввод отключен",
+            "message": "Пожалуйста, используйте текстовый ввод"
+        }), 403
+
+    command = data.get('command', '')
+    user_id = get_user_id(data)
+    lang = session.get('language', 'ru')
+    delivery = get_audio_delivery(data)
+    use_cache = data.get('cache', True) is not False
+    conversation_manager.add_to_history(user_id, "user", command)
+
+    def generate():
+        # Тело ответа отдается уже после teardown_request, поэтому срок задается заново
+        with deadline_scope(REQUEST_DEADLINES['api_process_command_stream'], DEADLINE_SHARES):
+            for event in stream_command_events(command, lang, user_id, delivery, use_cache):
+                if event['type'] == 'done':
+                    conversation_manager.add_to_history(user_id, "assistant", event['message'])
+                yield ndjson(event)
+
+    return Response(generate(), mimetype='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
+
+frame_cache = FrameCache(FRAME_CACHE_MAX_DISTANCE, FRAME_CACHE_TTL,
+                         FRAME_CACHE_FRAMES_PER_USER, FRAME_CACHE_MAX_USERS)
+
+image_preprocessor = ImagePreprocessor(IMAGE_MAX_EDGE, IMAGE_PASSTHROUGH_BYTES, IMAGE_MAX_PIXELS,
+                                       IMAGE_MAX_BYTES, IMAGE_JPEG_QUALITY)
+
+def elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 2)
+
+def server_timing(timings):
+    """Заголовок Server-Timing из словаря {этап: мс}"""
+    return ", ".join(f"{stage};dur={duration}" for stage, duration in timings.items())
+
+def get_user_id(data=None):
+    """Идентификатор пользователя: из запроса или из сессии"""
+    if data and data.get('user_id'):
+        return str(data['user_id'])
+    if 'user_id' not in session:
+        session['user_id'] = secrets.token_hex(8)
+    return session['user_id']
+
+def count_objects(annotation):
+    """Считает объекты и метки с уверенностью выше OBJECT_SCORE_THRESHOLD в ответе Vision"""
+    object_counts = defaultdict(int)
+    
+    for obj in annotation.get('localizedObjectAnnotations', []):
+        if obj['score'] > OBJECT_SCORE_THRESHOLD:
+            name = obj['name'].lower()
+            object_counts[name] += 1
+    
+    for label in annotation.get('labelAnnotations', []):
+        if label['score'] > OBJECT_SCORE_THRESHOLD:
+            name = label['description'].lower()
+            if name not in object_counts:
+                object_counts[name] = 1
+    
+    return dict(object_counts)
+
+def vision_request(img_base64):
+    """Тело запроса images:annotate для одного изображения"""
+    return {
+        "image": {"content": img_base64},
+        "features": [
+            {"type": "OBJECT_LOCALIZATION", "maxResults": 10},
+            {"type": "LABEL_DETECTION", "maxResults": 10}
+        ]
+    }
+
+def describe_objects(object_counts, target_lang, translations):
+    """Формирует список {name, count} с переводом, согласованным с числом
+
+    Формы меток из словаря меток берутся готовыми, остальные переводы
+    склоняются эвристикой. Метки без перевода (не успели к сроку) остаются
+    с английским названием.
+    """
+    lexicon = lexicon_for(target_lang)
+    results = []
+    for obj, count in object_counts.items():
+        entry = lexicon.get(obj) if lexicon is not None else None
+        if entry:
+            plural = entry.form(count).capitalize()
+        elif target_lang == 'en' or obj not in translations:
+            name = obj.capitalize()
+            plural = name + 's' if count > 1 else name
+        else:
+            plural = plural_form(translations[obj], count)
+        
+        results.append({"name": plural, "count": count})
+    return results
+
+def announcement_text(results, target_lang):
+    """Фраза для озвучивания первых MAX_OBJECTS_TO_SPEAK объектов"""
+    items_to_speak = results[:MAX_OBJECTS_TO_SPEAK]
+    items_text = [f"{obj['count']} {obj['name']}" if obj['count'] > 1 else obj['name'] for obj in items_to_speak]
+    return "Обнаружены: " + ", ".join(items_text) if target_lang == 'ru' else "Detected: " + ", ".join(items_text)
+
+detect_executor = ThreadPoolExecutor(max_workers=DETECT_FANOUT_WORKERS, thread_name_prefix='detect')
+
+def wait_translations(future, deadline):
+    """Переводы из future или пустой словарь, если срок запроса истек"""
+    try:
+        return future.result(timeout=max(0, deadline - time.perf_counter()))
+    except FutureTimeout:
+        logger.warning("Translation deadline exceeded, using English names")
+    except Exception as e:
+        logger.error(f"Translation error: {e}")
+    return {}
+
+def announce_objects(object_counts, target_lang, delivery, timings):
+    """Переводит и озвучивает первые MAX_OBJECTS_TO_SPEAK объектов кадра.
+
+    Перевод идет в пуле detect_executor со сроком DETECT_TRANSLATE_DEADLINE;
+    синтез речи стартует сразу, как только известны озвучиваемые названия.
+    Остальные метки в ответ не попадают, поэтому их перевод только прогревает
+    кэш в фоне и ответ не задерживает. Возвращает (results, audio_data).
+    """
+    started = time.perf_counter()
+    labels = list(object_counts)
+    spoken = {obj: object_counts[obj] for obj in labels[:MAX_OBJECTS_TO_SPEAK]}
+
+    translations = {}
+    if target_lang != 'en' and spoken:
+        # Метки из словаря меток не переводятся совсем
+        pending = unknown_labels(spoken, target_lang)
+        rest = unknown_labels(labels[len(spoken):], target_lang)
+        if rest:
+            submit(detect_executor, translate_objects, rest, target_lang)
+        if pending:
+            future = submit(detect_executor, translate_objects, pending, target_lang)
+            translations = wait_translations(future, started + DETECT_TRANSLATE_DEADLINE)
+    timings['translate'] = elapsed_ms(started)
+
+    results = describe_objects(spoken, target_lang, translations)
+    audio_data = None
+    if results:
+        started = time.perf_counter()
+        audio_data = render_announcement(results, target_lang, delivery)
+        timings['tts'] = elapsed_ms(started)
+    return results, audio_data
+
+def detection_response(results, cache_hit, timings, audio_data):
+    """Тело ответа /api/detect: словарь с аудио или просто список объектов.
+
+    Без аудио ответ остается прежним списком, который уже разбирают клиенты,
+    поэтому cache_hit в него не попадает: он есть в заголовке X-Frame-Cache
+    обоих вариантов ответа.
+    """
+    if audio_data:
+        return attach_audio({
+            "results": results[:MAX_OBJECTS_TO_SPEAK],
+            "cache_hit": cache_hit,
+            "timings": timings
+        }, audio_data)
+    return results[:MAX_OBJECTS_TO_SPEAK]
+
+def read_limited(stream, limit):
+    """Читает поток целиком, но не больше limit байт"""
+    data = stream.read(limit + 1)
+    if len(data) > limit:
+        raise ImageTooLarge(f"Image is larger than {limit} bytes")
+    return data
+
+def read_detect_upload(timings):
+    """Изображение и параметры /api/detect: (image_data или None, параметры).
+
+    Кроме JSON {"image": "<base64>"} принимает multipart/form-data с файлом image
+    и сырое тело image/jpeg (параметры - в строке запроса); в этих случаях
+    байты читаются из потока запроса без промежуточного base64.
+    """
+    started = time.perf_counter()
+    if request.mimetype.startswith('image/'):
+        image_data = read_limited(request.stream, IMAGE_MAX_BYTES)
+        data = request.args.to_dict()
+    elif request.mimetype == 'multipart/form-data':
+        upload = request.files.get('image')
+        image_data = read_limited(upload.stream, IMAGE_MAX_BYTES) if upload else None
+        data = request.form.to_dict()
+    else:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or 'image' not in data:
+            return None, {}
+        image_data = base64.b64decode(data['image'])
+        timings['decode_base64'] = elapsed_ms(started)
+        return image_data, data
+    timings['read_body'] = elapsed_ms(started)
+    return (image_data or None), data
+
 @app.route('/api/detect', methods=['POST'])
 def detect_objects():
     try:
         target_lang = session.get('language', 'ru')
+        request_started = time.perf_counter()
+        timings = {}
         
-        if not request.json or 'image' not in request.json:
-            error_msg = "No image data" if target_lang == 'en' else "Нет данных изображения"
-            return jsonify({"error": error_msg}), 400
-            
-        image_data = base64.b64decode(request.json['image'])
-        image = Image.open(io.BytesIO(image_data))
+        try:
+            image_data, data = read_detect_upload(timings)
+            if image_data is None:
+                error_msg = "No image data" if target_lang == 'en' else "Нет данных изображения"
+                return jsonify({"error": error_msg}), 400
+            prepared = image_preprocessor.prepare(image_data)
+        except ImageTooLarge as e:
+            logger.warning(f"Rejected image: {e}")
+            error_msg = "Image is too large" if target_lang == 'en' else "Изображение слишком большое"
+            return jsonify({"error": error_msg}), 413
+        timings.update(prepared.timings)
+        user_id = get_user_id(data)
         
-        buffered = io.BytesIO()
-        image.save(buffered, format="JPEG", quality=85)
-        img_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
-
-        api_key = os.environ.get('GOOGLE_API_KEY')
+        # Почти одинаковые кадры одного пользователя не отправляем в Vision повторно
+        started = time.perf_counter()
+        frame_hash = image_hash(prepared.preview)
+        object_counts = frame_cache.lookup(user_id, frame_hash)
+        cache_hit = object_counts is not None
+        timings['hash'] = elapsed_ms(started)
         
-        # Отправляем в Google Vision API
-        response = requests.post(
-            f"https://vision.googleapis.com/v1/images:annotate?key={api_key}",
-            json={
-                "requests": [{
-                    "image": {"content": img_base64},
-                    "features": [
-                        {"type": "OBJECT_LOCALIZATION", "maxResults": 10},
-                        {"type": "LABEL_DETECTION", "maxResults": 10}
-                    ]
-                }]
-            },
-            timeout=15
-        )
+        if not cache_hit:
+            started = time.perf_counter()
+            img_base64 = base64.b64encode(prepared.content).decode('utf-8')
+            timings['encode_base64'] = elapsed_ms(started)
 
-        if response.status_code == 200:
-            data = response.json()
-            object_counts = defaultdict(int)
-            
-            for obj in data.get('responses', [{}])[0].get('localizedObjectAnnotations', []):
-                if obj['score'] > 0.7:
-                    name = obj['name'].lower()
-                    object_counts[name] += 1
-            
-            for label in data.get('responses', [{}])[0].get('labelAnnotations', []):
-                if label['score'] > 0.7:
-                    name = label['description'].lower()
-                    if name not in object_counts:
-                        object_counts[name] = 1
-            
-            results = []
-            for obj, count in object_counts.items():
-                if target_lang == 'en':
-                    name = obj.capitalize()
-                    plural = name + 's' if count > 1 else name
-                else:
-                    name = translate_object(obj)
-                    if count > 1:
-                        plural = make_plural(name, count)
-                    else:
-                        plural = name
-                
-                results.append({"name": plural, "count": count})
+            # Отправляем в Google Vision API
+            started = time.perf_counter()
+            try:
+                annotation = circuit_breakers['vision'].call(vision_backend.annotate, [vision_request(img_base64)])[0]
+            except UpstreamError as e:
+                logger.error(f"Vision error: {e}")
+                return jsonify([])
+            finally:
+                timings['vision'] = elapsed_ms(started)
             
-            if results:
-                items_to_speak = results[:MAX_OBJECTS_TO_SPEAK]
-                items_text = [f"{obj['count']} {obj['name']}" if obj['count'] > 1 else obj['name'] for obj in items_to_speak]
-                speak_message = "Обнаружены: " + ", ".join(items_text) if target_lang == 'ru' else "Detected: " + ", ".join(items_text)
-                audio_data = speak(speak_message, target_lang)
-                if audio_data:
-                    return jsonify({
-                        "results": results[:MAX_OBJECTS_TO_SPEAK],
-                        "audio": audio_data['audio']
-                    })
-            
-            return jsonify(results[:MAX_OBJECTS_TO_SPEAK])
+            object_counts = count_objects(annotation)
+            frame_cache.store(user_id, frame_hash, object_counts)
+        
+        results, audio_data = announce_objects(object_counts, target_lang, get_audio_delivery(data), timings)
+        timings['total'] = elapsed_ms(request_started)
         
-        return jsonify([])
+        metrics.observe_timings(STAGE_SECONDS, timings, endpoint='detect')
+        response = jsonify(detection_response(results, cache_hit, timings, audio_data))
+        response.headers['X-Frame-Cache'] = 'hit' if cache_hit else 'miss'
+        response.headers['Server-Timing'] = server_timing(timings)
+        return response
         
     except Exception as e:
         logger.error(f"Error in detect_objects: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-def make_plural(word, count):
-    """Склоняет слово во множественное число для русского языка"""
-    if count == 1:
-        return word
-    
-    exceptions = {
-        "человек": "человека",
-        "ребенок": "ребёнка"
-    }
-    
-    if word in exceptions:
-        return exceptions[word]
-    
-    if word.endswith(('а', 'я')):
-        return word[:-1] + 'и'
-    elif word.endswith('ь'):
-        return word[:-1] + 'и'
-    elif word.endswith(('о', 'е')):
-        return word
-    else:
-        return word + 'ы'
+def annotate_batches(vision_requests):
+    """Отправляет запросы в Vision минимальным числом параллельных вызовов.
+
+    Возвращает (ответы, число вызовов); кадры неудачного вызова получают None.
+    """
+    annotations = [None] * len(vision_requests)
+    batches = split_vision_requests(vision_requests)
+    futures = [(batch, submit(detect_executor, circuit_breakers['vision'].call, vision_backend.annotate,
+                              [vision_requests[i] for i in batch]))
+               for batch in batches]
+    for batch, future in futures:
+        try:
+            responses = future.result()
+        except UpstreamError as e:
+            logger.error(f"Vision error: {e}")
+            continue
+        for index, annotation in zip(batch, responses):
+            annotations[index] = annotation
+    return annotations, len(batches)
+
+def detect_frames(frames, default_lang, default_user_id, delivery=None):
+    """Распознает пакет кадров одного или нескольких пользователей.
+
+    frames - список {"image", "id"?, "user_id"?, "language"?}. Кадры, которых нет
+    в кэше кадров, уходят в Vision пачками по VISION_MAX_IMAGES_PER_CALL, метки
+    всех кадров переводятся общим пакетом на каждый язык. Аудио синтезируется,
+    только если задан delivery.
+    """
+    request_started = time.perf_counter()
+    timings = {}
+    items = []
+    for position, frame in enumerate(frames):
+        if not isinstance(frame, dict):
+            frame = {}
+        lang = frame.get('language')
+        item = {
+            "id": frame.get('id', position),
+            "lang": lang if lang in ('en', 'ru') else default_lang,
+            "user_id": str(frame.get('user_id') or default_user_id)
+        }
+        items.append(item)
+        try:
+            prepared = image_preprocessor.prepare(base64.b64decode(frame['image']))
+        except ImageTooLarge as e:
+            logger.warning(f"Rejected image: {e}")
+            item['error'] = "image_too_large"
+            continue
+        except (KeyError, TypeError, ValueError, OSError) as e:
+            logger.warning(f"Invalid image in batch: {e}")
+            item['error'] = "invalid_image"
+            continue
+        item['hash'] = image_hash(prepared.preview)
+        item['object_counts'] = frame_cache.lookup(item['user_id'], item['hash'])
+        item['cache_hit'] = item['object_counts'] is not None
+        if not item['cache_hit']:
+            item['content'] = prepared.content
+    timings['prepare'] = elapsed_ms(request_started)
+
+    # Одинаковые кадры внутри пакета отправляем в Vision один раз
+    pending = defaultdict(list)
+    for item in items:
+        if 'content' in item:
+            pending[item.pop('content')].append(item)
+
+    started = time.perf_counter()
+    vision_calls = 0
+    if pending:
+        contents = list(pending)
+        annotations, vision_calls = annotate_batches(
+            [vision_request(base64.b64encode(content).decode('utf-8')) for content in contents])
+        for content, annotation in zip(contents, annotations):
+            for item in pending[content]:
+                if annotation is None or 'error' in annotation:
+                    item['error'] = "vision_error"
+                    continue
+                item['object_counts'] = count_objects(annotation)
+                frame_cache.store(item['user_id'], item['hash'], item['object_counts'])
+    timings['vision'] = elapsed_ms(started)
+
+    started = time.perf_counter()
+    labels = defaultdict(dict)
+    for item in items:
+        if item.get('object_counts') and item['lang'] != 'en' and 'error' not in item:
+            spoken = list(item['object_counts'])[:MAX_OBJECTS_TO_SPEAK]
+            labels[item['lang']].update(dict.fromkeys(unknown_labels(spoken, item['lang'])))
+    futures = {lang: submit(detect_executor, translate_objects, list(names), lang)
+               for lang, names in labels.items() if names}
+    translations = {lang: wait_translations(future, started + DETECT_TRANSLATE_DEADLINE)
+                    for lang, future in futures.items()}
+    timings['translate'] = elapsed_ms(started)
+
+    started = time.perf_counter()
+    frame_results = []
+    speech = []
+    for item in items:
+        entry = {"id": item['id']}
+        frame_results.append(entry)
+        if 'error' in item:
+            entry['error'] = item['error']
+            continue
+        object_counts = item['object_counts']
+        spoken = {obj: object_counts[obj] for obj in list(object_counts)[:MAX_OBJECTS_TO_SPEAK]}
+        entry['results'] = describe_objects(spoken, item['lang'], translations.get(item['lang'], {}))
+        entry['cache_hit'] = item['cache_hit']
+        if delivery and entry['results']:
+            speech.append((entry, submit(detect_executor, render_announcement, entry['results'], item['lang'], delivery)))
+    for entry, future in speech:
+        attach_audio(entry, future.result())
+    if speech:
+        timings['tts'] = elapsed_ms(started)
+    timings['total'] = elapsed_ms(request_started)
+
+    return {"frames": frame_results, "vision_calls": vision_calls, "timings": timings}
+
+def translate_batch(texts, src, dest):
+    """Переводит список строк за один запрос к сервису перевода"""
+    return circuit_breakers['translate'].call(translate_backend.translate, texts, src, dest)
+
+def correct_label(label):
+    """Возвращает перевод метки из CORRECTION_DICT без обращения к сети"""
+    return apply_corrections(label, CORRECTION_DICT)
+
+def correct_translation(text):
+    return apply_corrections(text, CORRECTION_DICT) or text
+
+label_translator = LabelTranslator(translate_batch, correct_label, correct_translation,
+                                   ttl=TRANSLATION_CACHE_TTL,
+                                   negative_ttl=TRANSLATION_NEGATIVE_TTL,
+                                   uncached_errors=(CircuitOpenError, DeadlineExceeded))
+
+# Общий для воркеров: файл отображается в память, страницы делит кэш ОС
+label_lexicon = open_lexicon(LABEL_LEXICON)
+
+def lexicon_for(target_lang):
+    """Словарь меток для языка ответа (формы есть только для русского)"""
+    return label_lexicon if target_lang == 'ru' else None
+
+def unknown_labels(labels, target_lang):
+    """Метки, которых нет в словаре меток: только их переводит сервис"""
+    lexicon = lexicon_for(target_lang)
+    return [label for label in labels if lexicon is None or label not in lexicon]
+
+def translate_objects(objects, target_lang='ru'):
+    """Переводит все метки кадра одним пакетом (словарь меток, затем кэш и сервис)"""
+    lexicon = lexicon_for(target_lang)
+    results = {}
+    for obj in objects:
+        entry = lexicon.get(obj) if lexicon is not None else None
+        if entry:
+            results[obj] = entry.one.capitalize()
+    pending = [obj for obj in objects if obj not in results]
+    if pending:
+        results.update(label_translator.translate_many(pending, target_lang))
+    return results
 
 def translate_object(obj, target_lang='ru'):
-    if target_lang == 'en':
-        return obj.capitalize()
-    
+    return translate_objects([obj], target_lang)[obj]
+
+@app.route('/api/detect_batch', methods=['POST'])
+def detect_batch():
+    """Пакетное распознавание: {"frames": [{"image", "id"?, "user_id"?, "language"?}], "audio_delivery"?}"""
     try:
-        obj_lower = obj.lower()
-        for wrong, correct in CORRECTION_DICT.items():
-            if wrong in obj_lower:
-                return correct.capitalize()
-        
-        translated = translator.translate(obj_lower, src='en', dest=target_lang).text
-        return correct_translation(translated).capitalize()
-    except Exception as e:
-        logger.error(f"Translation error: {e}")
-        return obj.capitalize()
+        target_lang = session.get('language', 'ru')
+        data = request.get_json(silent=True)
+        frames = data.get('frames') if isinstance(data, dict) else None
+        if not frames or not isinstance(frames, list):
+            error_msg = "No frames" if target_lang == 'en' else "Нет кадров"
+            return jsonify({"error": error_msg}), 400
+        if len(frames) > DETECT_BATCH_MAX_FRAMES:
+            error_msg = "Too many frames" if target_lang == 'en' else "Слишком много кадров"
+            return jsonify({"error": error_msg}), 413
 
-def correct_translation(text):
-    text_lower = text.lower()
-    for wrong, correct in CORRECTION_DICT.items():
-        if wrong in text_lower:
-            return correct
-    return text
+        delivery = data.get('audio_delivery')
+        body = detect_frames(frames, target_lang, get_user_id(data),
+                             delivery if delivery in ('inline', 'url') else None)
+        metrics.observe_timings(STAGE_SECONDS, body['timings'], endpoint='detect_batch')
+        response = jsonify(body)
+        response.headers['Server-Timing'] = server_timing(body['timings'])
+        return response
+
+    except Exception as e:
+        logger.error(f"Error in detect_batch: {str(e)}")
+        return jsonify({"error": str(e)}), 500
 
 @app.route('/set_language/<lang>')
 def set_language(lang):
@@ -470,10 +1208,220 @@ def set_language(lang):
         session['language'] = lang
     return jsonify(success=True)
 
+@app.route('/api/audio/<audio_id>')
+def get_audio(audio_id):
+    """Отдает синтезированное аудио (audio/mpeg) с поддержкой Range и кэширования"""
+    if not re.fullmatch(r'[0-9a-f]{64}', audio_id):
+        return jsonify({"error": "Invalid audio id"}), 404
+    
+    audio = tts_cache.lookup(audio_id, record=False)
+    if audio is None:
+        return jsonify({"error": "Audio not found"}), 404
+    
+    response = Response(audio, mimetype='audio/mpeg')
+    response.set_etag(audio_id)
+    response.cache_control.public = True
+    response.cache_control.max_age = AUDIO_MAX_AGE
+    response.cache_control.immutable = True
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response.make_conditional(request, accept_ranges=True, complete_length=len(audio))
+
+@app.route('/api/frame_cache/stats')
+def frame_cache_stats():
+    """Статистика кэша кадров"""
+    return jsonify(frame_cache.stats())
+
+def collect_cache_metrics(metrics):
+    """Переносит счетчики кэшей и размер хранилища диалогов в метрики"""
+    tts_stats = tts_cache.stats()
+    for result in ('memory_hits', 'disk_hits', 'misses', 'errors', 'evictions'):
+        metrics.set_counter('deasan_cache_events_total', tts_stats[result], cache='tts', result=result)
+    frame_stats = frame_cache.stats()
+    for result in ('hits', 'misses'):
+        metrics.set_counter('deasan_cache_events_total', frame_stats[result], cache='frame', result=result)
+    chat_stats = chat_cache.stats()
+    for result in ('hits', 'misses', 'coalesced', 'bypassed', 'wait_timeouts'):
+        metrics.set_counter('deasan_cache_events_total', chat_stats[result], cache='chat', result=result)
+    announcer_stats = announcer.stats()
+    for result in ('spliced', 'cold'):
+        metrics.set_counter('deasan_cache_events_total', announcer_stats[result], cache='announcer', result=result)
+    if label_lexicon is not None:
+        lexicon_stats = label_lexicon.stats()
+        for result in ('hits', 'misses'):
+            metrics.set_counter('deasan_cache_events_total', lexicon_stats[result], cache='lexicon', result=result)
+    conversation_stats = conversation_store.stats()
+    for name in ('users', 'messages', 'approx_bytes'):
+        metrics.set_gauge(f'deasan_conversation_{name}', conversation_stats[name])
+
+metrics.add_collector(collect_cache_metrics)
+
+def collect_circuit_metrics(metrics):
+    """Состояние предохранителей внешних сервисов"""
+    for service, breaker in circuit_breakers.items():
+        stats = breaker.stats()
+        metrics.set_gauge('deasan_circuit_state', CircuitBreaker.STATE_VALUES[stats['state']], service=service)
+        metrics.set_counter('deasan_circuit_opened_total', stats['opened'], service=service)
+        metrics.set_counter('deasan_circuit_rejected_total', stats['rejected'], service=service)
+
+metrics.add_collector(collect_circuit_metrics)
+
+def collect_vision_metrics(metrics):
+    """Сколько кадров гибридный режим обработал локально и сколько отправил в Vision"""
+    stats = vision_backend.stats()
+    metrics.set_counter('deasan_vision_frames_total', stats['local_frames'], source='local')
+    metrics.set_counter('deasan_vision_frames_total', stats['remote_frames'], source='vision')
+
+if isinstance(vision_backend, HybridVisionBackend):
+    metrics.add_collector(collect_vision_metrics)
+
+@app.before_request
+def start_deadline():
+    """Срок обработки запроса для эндпоинтов из REQUEST_DEADLINES"""
+    budget = REQUEST_DEADLINES.get(request.endpoint)
+    if budget is not None:
+        g.deadline_token = current_deadline.set(Deadline(budget, DEADLINE_SHARES))
+
+@app.teardown_request
+def reset_deadline(error=None):
+    token = g.pop('deadline_token', None)
+    if token is not None:
+        current_deadline.reset(token)
+
+@app.after_request
+def count_request(response):
+    metrics.inc('deasan_requests_total', endpoint=request.endpoint or 'unknown', status=response.status_code)
+    return response
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Метрики в текстовом формате Prometheus (суммарно по всем воркерам)"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/conversation_store/stats')
+def conversation_store_stats():
+    """Статистика хранилища диалогов: пользователи, реплики, объем"""
+    return jsonify(conversation_store.stats())
+
+@app.route('/api/chat_cache/stats')
+def chat_cache_stats():
+    """Статистика кэша ответов OpenAI"""
+    return jsonify(chat_cache.stats())
+
+@app.route('/api/circuit_breakers')
+def circuit_breakers_stats():
+    """Состояние предохранителей внешних сервисов"""
+    return jsonify({service: breaker.stats() for service, breaker in circuit_breakers.items()})
+
+@app.route('/api/tts_cache/stats')
+def tts_cache_stats():
+    """Статистика кэша озвучивания"""
+    return jsonify(tts_cache.stats())
+
 @app.route('/get_language')
 def get_language():
     return jsonify({'language': session.get('language', 'ru')})
 
+warm_up_done = threading.Event()
+_warm_up_lock = threading.Lock()
+_worker_pid = None
+_prewarm_lock = None
+
+def warm_up():
+    """Однократная подготовка приложения до приема запросов.
+
+    Под gunicorn с preload_app выполняется в мастере до fork (gunicorn.conf.py):
+    библиотеки бэкендов, Pillow и озвученные служебные фразы загружаются один
+    раз, и воркеры делят эти страницы памяти copy-on-write. Таблицы фраз,
+    сценарии и словари коррекции собираются еще при импорте, словарь меток
+    отображается в память и подгружается с диска здесь, как и фрагменты
+    фраз распознавания. К gTTS здесь не обращаемся: синтез недостающего
+    (TTS_PREWARM) идет в фоне после fork, см. init_worker. Потоки и
+    соединения здесь не создаются - это делает init_worker после fork.
+    """
+    with _warm_up_lock:
+        if warm_up_done.is_set():
+            return
+        started = time.perf_counter()
+        http_client.preload()
+        for backend in upstream_backends:
+            backend.preload()
+
+        # Pillow и его JPEG-плагин загружаются на пробном кадре
+        from PIL import Image
+        buffered = io.BytesIO()
+        Image.new('RGB', (32, 32)).save(buffered, format='JPEG')
+        image_hash(image_preprocessor.prepare(buffered.getvalue()).preview)
+
+        if label_lexicon is not None:
+            label_lexicon.preload()
+
+        tts_cache.preload(speech_phrases())
+        if SPLICED_ANNOUNCEMENTS:
+            announcer.warm_up(announcement_fragments())
+
+        warm_up_done.set()
+        logger.info(f"Warm-up finished in {time.perf_counter() - started:.2f}s")
+
+def claim_prewarm():
+    """True, если синтез для TTS_PREWARM достался этому процессу.
+
+    Кэш на диске общий, поэтому синтезирует один воркер - тот, что первым взял
+    блокировку файла в TTS_CACHE_DIR (она держится до конца процесса). Без
+    каталога кэша каждый процесс озвучивает фразы для себя.
+    """
+    global _prewarm_lock
+    if not TTS_CACHE_DIR:
+        return True
+    try:
+        import fcntl
+    except ImportError:
+        return True
+    os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+    lock = open(os.path.join(TTS_CACHE_DIR, '.prewarm.lock'), 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return False
+    _prewarm_lock = lock
+    return True
+
+def prewarm_speech():
+    """Синтез недостающих служебных фраз и фрагментов (TTS_PREWARM), в фоне воркера"""
+    started = time.perf_counter()
+    warm_tts_cache()
+    if SPLICED_ANNOUNCEMENTS:
+        announcer.warm_up(announcement_fragments(), synthesize=True)
+    logger.info(f"TTS prewarm finished in {time.perf_counter() - started:.2f}s")
+
+def preconnect(origins):
+    for service, origin in origins.items():
+        http_client.preconnect(service, origin)
+
+def init_worker():
+    """Запуск воркера после fork: поток сброса метрик, заранее открытые соединения и синтез TTS_PREWARM"""
+    global _worker_pid
+    if _worker_pid == os.getpid():
+        return
+    _worker_pid = os.getpid()
+    metrics.start_flusher()
+    for backend in upstream_backends:
+        backend.start()
+    origins = {backend.name: backend.origin() for backend in upstream_backends if backend.origin()}
+    if origins:
+        threading.Thread(target=preconnect, args=(origins,), name='preconnect', daemon=True).start()
+    if TTS_PREWARM and claim_prewarm():
+        threading.Thread(target=prewarm_speech, name='tts-prewarm', daemon=True).start()
+
+@app.route('/readyz')
+def readyz():
+    """Готовность к приему трафика: 200 только после warm_up"""
+    if not warm_up_done.is_set():
+        return jsonify({"ready": False}), 503
+    return jsonify({"ready": True})
+
 if __name__ == '__main__':
+    warm_up()
+    init_worker()
     port = int(os.environ.get("PORT", 5000))
     app.run(host='0.0.0.0', port=port)
\ No newline at end of file
@@ -0,0 +1,615 @@
+"""ASGI-точка входа Deasan AI.
+
+/api/detect, /api/detect_batch и /api/process_command обрабатываются корутинами:
+запросы к Vision и OpenAI ожидаются асинхронно, поэтому медленный upstream не
+занимает воркер.
+Блокирующие библиотеки (gTTS, googletrans, Pillow) выполняются в ограниченном
+пуле потоков, остальные маршруты Flask - через WSGI-мост в том же пуле.
+
+/ws/detect - потоковое распознавание кадров по WebSocket.
+
+Запуск: gunicorn -k uvicorn.workers.UvicornWorker asgi:app
+"""
+import asyncio
+import base64
+import contextvars
+import io
+import json
+import re
+import secrets
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qsl
+
+from werkzeug.formparser import parse_form_data
+
+import app as deasan
+from backends import UpstreamError
+from frame_cache import image_hash
+from imaging import ImageTooLarge
+from resilience import deadline_scope
+
+flask_app = deasan.app
+logger = deasan.logger
+
+MAX_BODY_BYTES = deasan.IMAGE_MAX_BYTES * 2
+
+# Идентификатор клиента без сессии Flask: выдается при первом обращении
+CLIENT_ID_COOKIE = 'deasan_client'
+CLIENT_ID_MAX_AGE = 365 * 24 * 3600
+CLIENT_ID_PATTERN = re.compile(r'[0-9a-f]{32}')
+
+blocking_executor = ThreadPoolExecutor(deasan.ASYNC_BLOCKING_WORKERS, thread_name_prefix='deasan-blocking')
+async_http = deasan.async_http_client
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+class Request:
+    """Минимальный HTTP-запрос ASGI с доступом к сессии Flask"""
+
+    def __init__(self, scope, body):
+        self.scope = scope
+        self.body = body
+        self.headers = {}
+        for name, value in scope.get('headers', []):
+            self.headers[name.decode('latin-1').lower()] = value.decode('latin-1')
+        self._session = None
+        self._cookies = None
+        self._client_id = None
+        self.issued_client_id = False
+
+    def json(self):
+        try:
+            return json.loads(self.body or b'null')
+        except ValueError:
+            return None
+
+    @property
+    def session(self):
+        """Сессия Flask, прочитанная из подписанной cookie (только чтение)"""
+        if self._session is None:
+            self._session = {}
+            morsel = self.cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+            serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+            if morsel is not None and serializer is not None:
+                max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+                try:
+                    self._session = serializer.loads(morsel.value, max_age=max_age)
+                except Exception:
+                    self._session = {}
+        return self._session
+
+    @property
+    def cookies(self):
+        if self._cookies is None:
+            try:
+                self._cookies = SimpleCookie(self.headers.get('cookie', ''))
+            except Exception:
+                self._cookies = SimpleCookie()
+        return self._cookies
+
+    @property
+    def client_id(self):
+        """Случайный идентификатор из cookie; если ее нет - новый, cookie ставит client_id_header.
+
+        Адрес клиента для этого не годится: за NAT и прокси у разных людей он
+        общий, и они получали бы одну историю диалога.
+        """
+        if self._client_id is None:
+            morsel = self.cookies.get(CLIENT_ID_COOKIE)
+            if morsel is not None and CLIENT_ID_PATTERN.fullmatch(morsel.value):
+                self._client_id = morsel.value
+            else:
+                self._client_id = secrets.token_hex(16)
+                self.issued_client_id = True
+        return f"anon:{self._client_id}"
+
+    def client_id_header(self):
+        """Заголовок Set-Cookie для только что выданного client_id или None"""
+        if not self.issued_client_id:
+            return None
+        cookie = (f"{CLIENT_ID_COOKIE}={self._client_id}; Max-Age={CLIENT_ID_MAX_AGE}; Path=/; "
+                  f"HttpOnly; SameSite=Lax")
+        if self.scope.get('scheme') in ('https', 'wss'):
+            cookie += '; Secure'
+        return b'set-cookie', cookie.encode('latin-1')
+
+
+async def read_body(receive, limit=MAX_BODY_BYTES):
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ConnectionError("Client disconnected")
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > limit:
+            raise BodyTooLarge()
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def send_response(send, body, status=200, headers=(), content_type='application/json'):
+    raw_headers = [(b'content-type', content_type.encode('latin-1')),
+                   (b'content-length', str(len(body)).encode('latin-1'))]
+    raw_headers += [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+    await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_json(send, payload, status=200, headers=()):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    await send_response(send, body, status, headers)
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """Выполняет блокирующий вызов в общем пуле потоков (со сроком запроса из contextvars)"""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(blocking_executor, partial(context.run, fn, *args, **kwargs))
+
+
+async def detect_image(image_data, target_lang, user_id, delivery, timings):
+    """Распознает один кадр: (results, cache_hit, audio_data).
+
+    ImageTooLarge и UpstreamError передаются вызывающему.
+    """
+    prepared = await run_blocking(deasan.image_preprocessor.prepare, image_data)
+    timings.update(prepared.timings)
+
+    started = time.perf_counter()
+    frame_hash = image_hash(prepared.preview)
+    object_counts = deasan.frame_cache.lookup(user_id, frame_hash)
+    cache_hit = object_counts is not None
+    timings['hash'] = deasan.elapsed_ms(started)
+
+    if not cache_hit:
+        img_base64 = base64.b64encode(prepared.content).decode('utf-8')
+        started = time.perf_counter()
+        try:
+            annotation = (await deasan.circuit_breakers['vision'].acall(
+                deasan.vision_backend.aannotate, [deasan.vision_request(img_base64)]))[0]
+        finally:
+            timings['vision'] = deasan.elapsed_ms(started)
+
+        object_counts = deasan.count_objects(annotation)
+        deasan.frame_cache.store(user_id, frame_hash, object_counts)
+
+    results, audio_data = await run_blocking(deasan.announce_objects, object_counts, target_lang,
+                                             delivery, timings)
+    return results, cache_hit, audio_data
+
+
+def read_detect_upload(request, timings):
+    """Асинхронный вариант app.read_detect_upload (тело уже прочитано)"""
+    started = time.perf_counter()
+    mimetype = request.headers.get('content-type', '').split(';', 1)[0].strip().lower()
+    if mimetype.startswith('image/'):
+        image_data = request.body
+        data = dict(parse_qsl(request.scope.get('query_string', b'').decode('latin-1')))
+    elif mimetype == 'multipart/form-data':
+        _, form, files = parse_form_data(build_environ(request.scope, request.body))
+        upload = files.get('image')
+        image_data = upload.read() if upload else None
+        data = form.to_dict()
+    else:
+        data = request.json()
+        if not isinstance(data, dict) or 'image' not in data:
+            return None, {}
+        image_data = base64.b64decode(data['image'])
+        timings['decode_base64'] = deasan.elapsed_ms(started)
+        return image_data, data
+    timings['read_body'] = deasan.elapsed_ms(started)
+    return (image_data or None), data
+
+
+async def detect_objects(request, send):
+    """Асинхронный вариант app.detect_objects"""
+    target_lang = request.session.get('language', 'ru')
+    request_started = time.perf_counter()
+    timings = {}
+
+    image_data, data = read_detect_upload(request, timings)
+    if image_data is None:
+        error_msg = "No image data" if target_lang == 'en' else "Нет данных изображения"
+        return await send_json(send, {"error": error_msg}, 400)
+    user_id = str(data.get('user_id') or request.session.get('user_id') or request.client_id)
+
+    try:
+        results, cache_hit, audio_data = await detect_image(image_data, target_lang, user_id,
+                                                            deasan.get_audio_delivery(data), timings)
+    except ImageTooLarge as e:
+        logger.warning(f"Rejected image: {e}")
+        error_msg = "Image is too large" if target_lang == 'en' else "Изображение слишком большое"
+        return await send_json(send, {"error": error_msg}, 413)
+    except UpstreamError as e:
+        logger.error(f"Vision error: {e}")
+        return await send_json(send, [])
+    timings['total'] = deasan.elapsed_ms(request_started)
+
+    deasan.metrics.observe_timings(deasan.STAGE_SECONDS, timings, endpoint='detect')
+    await send_json(send, deasan.detection_response(results, cache_hit, timings, audio_data), headers=[
+        ('X-Frame-Cache', 'hit' if cache_hit else 'miss'),
+        ('Server-Timing', deasan.server_timing(timings))
+    ])
+
+
+async def process_voice_command(command, lang, user_id, delivery, use_cache=True):
+    """Асинхронный вариант app.process_voice_command"""
+    try:
+        if deasan.should_recognize_objects(command):
+            response = {
+                "type": "object_recognition",
+                "message": deasan.recognition_message(lang)
+            }
+        else:
+            ai_response = await deasan.deasan_ai.aprocess_command(command, lang, user_id, use_cache)
+            response = {
+                "type": "ai_response",
+                "message": ai_response
+            }
+        with deasan.metrics.timer(deasan.STAGE_SECONDS, endpoint='command', stage='tts'):
+            audio_data = await run_blocking(deasan.render_speech, response["message"], lang, delivery)
+        return deasan.attach_audio(response, audio_data)
+
+    except Exception as e:
+        logger.error(f"Error processing voice command: {e}")
+        error_msg = deasan.deasan_ai.get_error_response(lang)
+        audio_data = await run_blocking(deasan.render_speech, error_msg, lang, delivery)
+        return deasan.attach_audio({"error": str(e)}, audio_data)
+
+
+async def api_process_command(request, send):
+    """Асинхронный вариант app.api_process_command"""
+    data = request.json()
+    if not isinstance(data, dict):
+        return await send_json(send, {"error": "Invalid JSON"}, 400)
+
+    if data.get('is_voice') and not request.session.get('voice_input_enabled', True):
+        return await send_json(send, {
+            "error": "Голосовой ввод отключен",
+            "message": "Пожалуйста, используйте текстовый ввод"
+        }, 403)
+
+    command = data.get('command', '')
+    user_id = str(data.get('user_id') or request.session.get('user_id') or request.client_id)
+    lang = request.session.get('language', 'ru')
+
+    deasan.conversation_manager.add_to_history(user_id, "user", command)
+
+    with deasan.metrics.timer(deasan.STAGE_SECONDS, endpoint='command', stage='total'):
+        response = await process_voice_command(command, lang, user_id, deasan.get_audio_delivery(data),
+                                               data.get('cache', True) is not False)
+    response['assistant_speaking'] = True
+
+    if 'message' in response:
+        deasan.conversation_manager.add_to_history(user_id, "assistant", response['message'])
+
+    await send_json(send, response)
+
+
+async def api_process_command_stream(request, send):
+    """Асинхронный вариант app.api_process_command_stream"""
+    data = request.json()
+    if not isinstance(data, dict):
+        return await send_json(send, {"error": "Invalid JSON"}, 400)
+    if data.get('is_voice') and not request.session.get('voice_input_enabled', True):
+        return await send_json(send, {
+            "error": "Голосовой ввод отключен",
+            "message": "Пожалуйста, используйте текстовый ввод"
+        }, 403)
+
+    command = data.get('command', '')
+    user_id = str(data.get('user_id') or request.session.get('user_id') or request.client_id)
+    lang = request.session.get('language', 'ru')
+    delivery = deasan.get_audio_delivery(data)
+    deasan.conversation_manager.add_to_history(user_id, "user", command)
+
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [
+        (b'content-type', b'application/x-ndjson'),
+        (b'x-accel-buffering', b'no')
+    ]})
+
+    async def emit(event):
+        await send({'type': 'http.response.body', 'body': deasan.ndjson(event).encode('utf-8'), 'more_body': True})
+
+    started = time.perf_counter()
+    if deasan.should_recognize_objects(command):
+        message = deasan.recognition_message(lang)
+        audio_data = await run_blocking(deasan.render_speech, message, lang, delivery)
+        await emit(deasan.attach_audio({"type": "object_recognition", "message": message}, audio_data))
+        full_text = message
+    else:
+        sentences = []
+        transcript = []
+        pending = deque()
+
+        async def flush(wait):
+            while pending and (wait or pending[0][1].done()):
+                index, task = pending.popleft()
+                audio_data = await task
+                if index == 0:
+                    deasan.metrics.observe(deasan.STAGE_SECONDS, time.perf_counter() - started,
+                                           endpoint='command_stream', stage='first_sentence')
+                await emit(deasan.sentence_event(index, sentences[index], audio_data))
+
+        async for sentence in deasan.deasan_ai.astream_answer(command, lang, user_id,
+                                                               data.get('cache', True) is not False,
+                                                               transcript):
+            task = asyncio.ensure_future(run_blocking(deasan.render_speech, sentence, lang, delivery))
+            pending.append((len(sentences), task))
+            sentences.append(sentence)
+            await flush(False)
+        await flush(True)
+        full_text = ''.join(transcript)
+        deasan.metrics.observe(deasan.STAGE_SECONDS, time.perf_counter() - started,
+                               endpoint='command_stream', stage='total')
+
+    deasan.conversation_manager.add_to_history(user_id, "assistant", full_text)
+    await emit({"type": "done", "message": full_text})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def detect_batch(request, send):
+    """Асинхронный вариант app.detect_batch"""
+    target_lang = request.session.get('language', 'ru')
+    data = request.json()
+    frames = data.get('frames') if isinstance(data, dict) else None
+    if not frames or not isinstance(frames, list):
+        error_msg = "No frames" if target_lang == 'en' else "Нет кадров"
+        return await send_json(send, {"error": error_msg}, 400)
+    if len(frames) > deasan.DETECT_BATCH_MAX_FRAMES:
+        error_msg = "Too many frames" if target_lang == 'en' else "Слишком много кадров"
+        return await send_json(send, {"error": error_msg}, 413)
+
+    user_id = str(data.get('user_id') or request.session.get('user_id') or request.client_id)
+    delivery = data.get('audio_delivery')
+    body = await run_blocking(deasan.detect_frames, frames, target_lang, user_id,
+                              delivery if delivery in ('inline', 'url') else None)
+    deasan.metrics.observe_timings(deasan.STAGE_SECONDS, body['timings'], endpoint='detect_batch')
+    await send_json(send, body, headers=[('Server-Timing', deasan.server_timing(body['timings']))])
+
+
+async def stream_detect(scope, receive, send):
+    """Непрерывное распознавание по WebSocket.
+
+    Клиент шлет кадры JPEG бинарными сообщениями и настройки текстовыми
+    ({"language", "audio_delivery", "user_id"}), сервер отвечает JSON с
+    результатами и ссылками на аудио. Кадр, пришедший, пока предыдущий еще
+    обрабатывается, отбрасывается, чтобы задержка не накапливалась.
+    """
+    request = Request(scope, b'')
+    if (await receive())['type'] != 'websocket.connect':
+        return
+    options = {
+        'language': request.session.get('language', 'ru'),
+        'audio_delivery': 'url',
+        'user_id': str(request.session.get('user_id') or request.client_id)
+    }
+    cookie_header = request.client_id_header()
+    await send({'type': 'websocket.accept', 'headers': [cookie_header] if cookie_header else []})
+
+    sequence = 0
+    dropped = 0
+    in_flight = None
+
+    async def process(frame, frame_seq):
+        request_started = time.perf_counter()
+        timings = {}
+        target_lang = options['language']
+        try:
+            # Каждый кадр получает тот же срок, что и /api/detect
+            with deadline_scope(deasan.REQUEST_DEADLINES['detect_objects'], deasan.DEADLINE_SHARES):
+                results, cache_hit, audio_data = await detect_image(frame, target_lang, options['user_id'],
+                                                                    options['audio_delivery'], timings)
+        except ImageTooLarge as e:
+            logger.warning(f"Rejected image: {e}")
+            error_msg = "Image is too large" if target_lang == 'en' else "Изображение слишком большое"
+            return await send_text(send, {"type": "error", "seq": frame_seq, "error": error_msg})
+        except UpstreamError as e:
+            logger.error(f"Vision error: {e}")
+            results, cache_hit, audio_data = [], False, None
+        except Exception as e:
+            logger.error(f"Error in stream_detect: {e}")
+            return await send_text(send, {"type": "error", "seq": frame_seq, "error": str(e)})
+        timings['total'] = deasan.elapsed_ms(request_started)
+
+        deasan.metrics.observe_timings(deasan.STAGE_SECONDS, timings, endpoint='stream')
+        await send_text(send, deasan.attach_audio({
+            "type": "detection",
+            "seq": frame_seq,
+            "results": results[:deasan.MAX_OBJECTS_TO_SPEAK],
+            "cache_hit": cache_hit,
+            "dropped": dropped,
+            "timings": timings
+        }, audio_data))
+
+    try:
+        while True:
+            message = await receive()
+            if message['type'] == 'websocket.disconnect':
+                break
+            if message.get('bytes'):
+                if in_flight is not None and not in_flight.done():
+                    dropped += 1
+                    deasan.metrics.inc('deasan_stream_dropped_frames_total')
+                    continue
+                sequence += 1
+                in_flight = asyncio.create_task(process(message['bytes'], sequence))
+            elif message.get('text'):
+                try:
+                    control = json.loads(message['text'])
+                except ValueError:
+                    continue
+                if control.get('language') in ('en', 'ru'):
+                    options['language'] = control['language']
+                if control.get('audio_delivery') in ('inline', 'url'):
+                    options['audio_delivery'] = control['audio_delivery']
+                if control.get('user_id'):
+                    options['user_id'] = str(control['user_id'])
+    finally:
+        if in_flight is not None and not in_flight.done():
+            in_flight.cancel()
+
+
+async def send_text(send, payload):
+    try:
+        await send({'type': 'websocket.send', 'text': json.dumps(payload, ensure_ascii=False)})
+    except Exception as e:
+        # Клиент уже отключился
+        logger.debug(f"WebSocket send failed: {e}")
+
+
+WEBSOCKET_ROUTES = {
+    '/ws/detect': stream_detect,
+}
+
+
+ASYNC_ROUTES = {
+    ('POST', '/api/detect'): ('detect_objects', detect_objects),
+    ('POST', '/api/detect_batch'): ('detect_batch', detect_batch),
+    ('POST', '/api/process_command'): ('api_process_command', api_process_command),
+    ('POST', '/api/process_command/stream'): ('api_process_command_stream', api_process_command_stream),
+}
+
+
+def build_environ(scope, body):
+    """WSGI environ из ASGI scope"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for raw_name, raw_value in scope.get('headers', []):
+        name = raw_name.decode('latin-1').upper().replace('-', '_')
+        value = raw_value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'CONTENT_LENGTH':
+            environ['CONTENT_LENGTH'] = value
+        else:
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def run_wsgi(environ):
+    """Выполняет приложение Flask и собирает ответ целиком"""
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = headers
+
+    result = flask_app.wsgi_app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return started['status'], started['headers'], body
+
+
+async def call_flask(scope, body, send):
+    status, headers, body = await run_blocking(run_wsgi, build_environ(scope, body))
+    raw_headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+    await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # Под gunicorn с preload_app warm_up уже выполнен в мастере
+            try:
+                await run_blocking(deasan.warm_up)
+                deasan.init_worker()
+            except Exception as e:
+                logger.error(f"Warm-up failed: {e}")
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await async_http.close()
+            blocking_executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI-приложение"""
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] == 'websocket':
+        handler = WEBSOCKET_ROUTES.get(scope['path'])
+        if handler is None:
+            return await send({'type': 'websocket.close', 'code': 1008})
+        return await handler(scope, receive, send)
+    if scope['type'] != 'http':
+        return
+
+    try:
+        body = await read_body(receive)
+    except BodyTooLarge:
+        return await send_json(send, {"error": "Request body is too large"}, 413)
+    except ConnectionError:
+        return
+
+    route = ASYNC_ROUTES.get((scope['method'], scope['path']))
+    if route is None:
+        return await call_flask(scope, body, send)
+
+    endpoint, handler = route
+    status = {}
+    request = Request(scope, body)
+
+    async def send_and_count(message):
+        if message['type'] == 'http.response.start':
+            status['code'] = message['status']
+            cookie_header = request.client_id_header()
+            if cookie_header:
+                message = dict(message, headers=list(message.get('headers', [])) + [cookie_header])
+        elif message['type'] == 'http.response.body' and not message.get('more_body'):
+            status['complete'] = True
+        await send(message)
+
+    try:
+        with deadline_scope(deasan.REQUEST_DEADLINES.get(endpoint), deasan.DEADLINE_SHARES):
+            await handler(request, send_and_count)
+    except Exception as e:
+        logger.error(f"Error in {scope['path']}: {e}")
+        if 'code' not in status:
+            await send_json(send_and_count, {"error": str(e)}, 500)
+        elif 'complete' not in status:
+            # Заголовки уже ушли (например, посреди потока NDJSON) - только завершаем тело
+            try:
+                await send_and_count({'type': 'http.response.body', 'body': b''})
+            except Exception as send_error:
+                logger.debug(f"Response close failed: {send_error}")
+    finally:
+        deasan.metrics.inc('deasan_requests_total', endpoint=endpoint, status=status.get('code', 500))
@@ -0,0 +1,636 @@
+# backends.py
+import asyncio
+import base64
+import hashlib
+import io
+import logging
+import os
+import random
+import re
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from urllib.parse import urlsplit
+
+logger = logging.getLogger('DeasanAI')
+
+
+def url_origin(url):
+    """Схема и хост адреса: https://vision.googleapis.com"""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+class UpstreamError(Exception):
+    """Внешний сервис вернул ошибку"""
+
+    def __init__(self, service, status=None, message=None):
+        self.service = service
+        self.status = status
+        super().__init__(message or f"{service} returned {status}")
+
+
+class Backend(ABC):
+    """Общее для бэкендов: подготовка в мастере до fork и адрес для заранее открытых соединений"""
+
+    name = None
+
+    def preload(self):
+        """Загружает библиотеки бэкенда (в мастере gunicorn их страницы общие для воркеров)"""
+
+    def start(self):
+        """Запускает ресурсы воркера после fork (пулы процессов и т.п.)"""
+
+    def origin(self):
+        """https://host сервиса для соединений, открываемых после fork, или None"""
+        return None
+
+
+class VisionBackend(Backend):
+    """Распознавание: annotate(requests) -> список ответов images:annotate (по одному на запрос)"""
+
+    name = 'vision'
+
+    @abstractmethod
+    def annotate(self, requests):
+        """Ответы images:annotate по одному на запрос"""
+
+    async def aannotate(self, requests):
+        return await asyncio.get_running_loop().run_in_executor(None, self.annotate, requests)
+
+
+# Ограничения images:annotate на один вызов
+VISION_MAX_IMAGES_PER_CALL = 16
+VISION_MAX_REQUEST_BYTES = 10 * 1024 * 1024
+
+
+def split_vision_requests(requests, max_images=VISION_MAX_IMAGES_PER_CALL, max_bytes=VISION_MAX_REQUEST_BYTES):
+    """Делит запросы images:annotate на минимальное число вызовов в пределах лимитов API.
+
+    Возвращает списки индексов исходных запросов; порядок сохраняется.
+    """
+    batches = []
+    current = []
+    current_bytes = 0
+    for index, request in enumerate(requests):
+        size = len(request.get('image', {}).get('content', '')) + 256
+        if current and (len(current) >= max_images or current_bytes + size > max_bytes):
+            batches.append(current)
+            current = []
+            current_bytes = 0
+        current.append(index)
+        current_bytes += size
+    if current:
+        batches.append(current)
+    return batches
+
+
+class TranslateBackend(Backend):
+    """Перевод: translate(texts, src, dest) -> список переводов"""
+
+    name = 'translate'
+
+    @abstractmethod
+    def translate(self, texts, src, dest):
+        """Переводы texts в том же порядке"""
+
+
+class TTSBackend(Backend):
+    """Синтез речи: synthesize(text, lang) -> байты MP3"""
+
+    name = 'tts'
+
+    @abstractmethod
+    def synthesize(self, text, lang):
+        """Байты MP3 для text"""
+
+
+class ChatBackend(Backend):
+    """Языковая модель: complete(params) -> текст ответа, stream(params) -> фрагменты текста"""
+
+    name = 'openai'
+
+    @property
+    def available(self):
+        return True
+
+    @abstractmethod
+    def complete(self, params):
+        """Текст ответа модели на params (аргументы ChatCompletion.create)"""
+
+    async def acomplete(self, params):
+        return await asyncio.get_running_loop().run_in_executor(None, self.complete, params)
+
+    def stream(self, params):
+        yield self.complete(params)
+
+    async def astream(self, params):
+        yield await self.acomplete(params)
+
+
+# Реальные сервисы
+
+class GoogleVisionBackend(VisionBackend):
+    def __init__(self, http_client, async_http_client=None, api_key=None,
+                 url='https://vision.googleapis.com/v1/images:annotate'):
+        self.http_client = http_client
+        self.async_http_client = async_http_client
+        self.api_key = api_key
+        self.url = url
+
+    def endpoint(self):
+        return f"{self.url}?key={self.api_key}" if self.api_key else self.url
+
+    def origin(self):
+        return url_origin(self.url)
+
+    def annotate(self, requests):
+        """Ответы Vision; сетевые ошибки и таймауты после повторов - UpstreamError"""
+        from requests import RequestException
+
+        try:
+            response = self.http_client.post(self.name, self.endpoint(), idempotent=True,
+                                             json={"requests": requests})
+            if response.status_code != 200:
+                raise UpstreamError(self.name, response.status_code)
+            return response.json().get('responses', [{}] * len(requests))
+        except (RequestException, ValueError) as e:
+            raise UpstreamError(self.name, message=f"{self.name} request failed: {e!r}") from e
+
+    async def aannotate(self, requests):
+        if self.async_http_client is None:
+            return await super().aannotate(requests)
+        import aiohttp
+
+        try:
+            status, data = await self.async_http_client.post_json(self.name, self.endpoint(),
+                                                                  {"requests": requests}, idempotent=True)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            raise UpstreamError(self.name, message=f"{self.name} request failed: {e!r}") from e
+        if status != 200:
+            raise UpstreamError(self.name, status)
+        return data.get('responses', [{}] * len(requests))
+
+
+class LocalVisionBackend(VisionBackend):
+    """Детектор объектов на CPU (local_detector) в пуле процессов воркера.
+
+    Пул создается после fork и запускается методом spawn: процессы не наследуют
+    потоки и блокировки воркера. Кандидаты со score ниже min_score отбрасываются.
+    """
+
+    def __init__(self, model_path, labels_path, processes=None, min_score=0.3, max_results=10,
+                 timeout=10, box_format='yxyx'):
+        self.model_path = model_path
+        self.labels_path = labels_path
+        self.processes = processes or os.cpu_count() or 1
+        self.min_score = min_score
+        self.max_results = max_results
+        self.timeout = timeout
+        self.box_format = box_format
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def preload(self):
+        from local_detector import check_model
+        check_model(self.model_path, self.labels_path)
+
+    def start(self):
+        import local_detector
+        executor = self.executor()
+        for _ in range(self.processes):
+            executor.submit(local_detector.ping)
+
+    def executor(self):
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    import multiprocessing
+                    from concurrent.futures import ProcessPoolExecutor
+                    import local_detector
+
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.processes, mp_context=multiprocessing.get_context('spawn'),
+                        initializer=local_detector.init_process,
+                        initargs=(self.model_path, self.labels_path, self.box_format))
+                    self._pid = os.getpid()
+        return self._executor
+
+    def submit(self, requests):
+        import local_detector
+        executor = self.executor()
+        return [executor.submit(local_detector.detect, base64.b64decode(request['image']['content']),
+                                self.min_score, self.max_results)
+                for request in requests]
+
+    def results(self, futures, timeout):
+        """Ответы кадров; ошибка отдельного кадра - {"error": ...}, как у images:annotate"""
+        from concurrent.futures import CancelledError, TimeoutError as FutureTimeout
+        from concurrent.futures.process import BrokenProcessPool
+
+        deadline = time.monotonic() + timeout
+        annotations = []
+        try:
+            for future in futures:
+                try:
+                    annotations.append(future.result(max(0, deadline - time.monotonic())))
+                except (FutureTimeout, CancelledError):
+                    raise UpstreamError(self.name, message="Local detector timed out")
+                except BrokenProcessPool:
+                    self._executor = None
+                    raise UpstreamError(self.name, message="Local detector process pool is broken")
+                except Exception as e:
+                    annotations.append({"error": {"message": str(e)}})
+        except UpstreamError:
+            for future in futures:
+                future.cancel()
+            raise
+        return annotations
+
+    def annotate(self, requests):
+        from resilience import call_timeout
+
+        timeout = call_timeout(self.name, self.timeout)
+        return self.results(self.submit(requests), timeout)
+
+    async def aannotate(self, requests):
+        from resilience import call_timeout
+
+        timeout = call_timeout(self.name, self.timeout)
+        futures = self.submit(requests)
+        if futures:
+            # Ждем без блокировки event loop; результаты и ошибки разбирает results
+            done, pending = await asyncio.wait([asyncio.wrap_future(future) for future in futures],
+                                               timeout=timeout)
+            for waiter in pending:
+                waiter.cancel()
+            for waiter in done:
+                waiter.exception()
+        return self.results(futures, 0)
+
+
+class HybridVisionBackend(VisionBackend):
+    """Сначала локальный детектор; в Vision уходят только кадры, где он не уверен.
+
+    Кадр считается неуверенным, если локальный детектор ничего на нем не нашел,
+    если у него есть кандидат со score не выше threshold (того же порога 0.7,
+    что отбирает объекты для ответа) или детектор на нем ошибся. Если Vision
+    недоступен, остается локальный ответ.
+    """
+
+    def __init__(self, local, remote, threshold=0.7, breaker=None):
+        self.local = local
+        self.remote = remote
+        self.threshold = threshold
+        # Ошибки Vision здесь не выходят наружу, поэтому у него свой предохранитель
+        self.breaker = breaker
+        self.local_frames = 0
+        self.remote_frames = 0
+
+    def preload(self):
+        self.local.preload()
+        self.remote.preload()
+
+    def start(self):
+        self.local.start()
+        self.remote.start()
+
+    def origin(self):
+        return self.remote.origin()
+
+    def uncertain(self, annotation):
+        if 'error' in annotation:
+            return True
+        objects = annotation.get('localizedObjectAnnotations', [])
+        # Пустой кадр - то, что модель не знает или не разглядела
+        return not objects or any(obj['score'] <= self.threshold for obj in objects)
+
+    def split(self, requests, annotations):
+        escalate = [i for i, annotation in enumerate(annotations) if self.uncertain(annotation)]
+        self.local_frames += len(requests) - len(escalate)
+        self.remote_frames += len(escalate)
+        return escalate
+
+    def merge(self, annotations, escalate, remote_annotations):
+        for index, annotation in zip(escalate, remote_annotations):
+            annotations[index] = annotation
+        return annotations
+
+    def annotate(self, requests):
+        annotations = self.local.annotate(requests)
+        escalate = self.split(requests, annotations)
+        if not escalate:
+            return annotations
+        try:
+            remote_requests = [requests[i] for i in escalate]
+            if self.breaker is not None:
+                remote_annotations = self.breaker.call(self.remote.annotate, remote_requests)
+            else:
+                remote_annotations = self.remote.annotate(remote_requests)
+        except UpstreamError as e:
+            logger.warning(f"Vision unavailable, keeping local detections: {e}")
+            return annotations
+        return self.merge(annotations, escalate, remote_annotations)
+
+    async def aannotate(self, requests):
+        annotations = await self.local.aannotate(requests)
+        escalate = self.split(requests, annotations)
+        if not escalate:
+            return annotations
+        try:
+            remote_requests = [requests[i] for i in escalate]
+            if self.breaker is not None:
+                remote_annotations = await self.breaker.acall(self.remote.aannotate, remote_requests)
+            else:
+                remote_annotations = await self.remote.aannotate(remote_requests)
+        except UpstreamError as e:
+            logger.warning(f"Vision unavailable, keeping local detections: {e}")
+            return annotations
+        return self.merge(annotations, escalate, remote_annotations)
+
+    def stats(self):
+        return {"local_frames": self.local_frames, "remote_frames": self.remote_frames}
+
+
+class GoogleTranslateBackend(TranslateBackend):
+    """googletrans; несколько строк склеиваются в один запрос"""
+
+    def __init__(self, http_client, timeout=None):
+        self.http_client = http_client
+        self.timeout = timeout
+        self._translator = None
+
+    def preload(self):
+        # Translator не создается: его пул httpx должен открываться уже в воркере
+        import googletrans
+
+    @property
+    def translator(self):
+        if self._translator is None:
+            from googletrans import Translator
+            self._translator = Translator(timeout=self.timeout)
+        return self._translator
+
+    def translate_one(self, text, src, dest):
+        return self.http_client.call(self.name, self.translator.translate, text, src=src, dest=dest).text
+
+    def translate(self, texts, src, dest):
+        from translation import join_batch
+        return join_batch(self.translate_one, texts, src, dest)
+
+
+class GTTSBackend(TTSBackend):
+    """gTTS; запросы фрагментов идут через общий пул соединений.
+
+    Для этого используется внутренний gTTS._prepare_requests() и разбор ответа
+    по образцу gTTS.stream() - они проверены на версии из requirements.txt.
+    Если в другой версии их нет или формат ответа изменился, синтез идет через
+    публичный gTTS.write_to_fp (со своей сессией gTTS).
+    """
+
+    def __init__(self, http_client, url='https://translate.google.com'):
+        self.http_client = http_client
+        self.url = url
+        self.pooled = True
+
+    def preload(self):
+        import gtts
+
+    def origin(self):
+        return url_origin(self.url)
+
+    @staticmethod
+    def extract_audio(text):
+        """Достает MP3 из ответа batchexecute, как это делает gTTS.stream()"""
+        for line in text.splitlines():
+            if "jQ1olc" in line:
+                audio_search = re.search(r'jQ1olc","\[\\"(.*)\\"]', line)
+                if audio_search:
+                    return base64.b64decode(audio_search.group(1).encode("ascii"))
+        raise ValueError("No audio stream in TTS response")
+
+    def synthesize(self, text, lang):
+        from gtts import gTTS
+
+        tts = gTTS(text=text, lang='ru' if lang == 'ru' else 'en')
+        if self.pooled:
+            try:
+                return self.synthesize_pooled(tts)
+            except (AttributeError, TypeError) as e:
+                # Внутреннего API нет в этой версии gTTS - больше его не пробуем
+                logger.warning(f"gTTS internals changed, using write_to_fp: {e!r}")
+                self.pooled = False
+            except ValueError as e:
+                logger.warning(f"Unexpected gTTS response, retrying with write_to_fp: {e}")
+
+        buffer = io.BytesIO()
+        self.http_client.call(self.name, tts.write_to_fp, buffer)
+        return buffer.getvalue()
+
+    def synthesize_pooled(self, tts):
+        chunks = []
+        # gTTS открывает новую сессию на каждый фрагмент - отправляем его запросы через общий пул
+        for prepared in tts._prepare_requests():
+            response = self.http_client.call(self.name, self.http_client.send, self.name, prepared)
+            response.raise_for_status()
+            chunks.append(self.extract_audio(response.text))
+        return b''.join(chunks)
+
+
+class OpenAIChatBackend(ChatBackend):
+    """openai загружается при первом вызове (вместе с aiohttp это заметная часть запуска воркера).
+
+    session() и async_session() возвращают общие пулы соединений HttpClient и
+    AsyncHttpClient.
+    """
+
+    def __init__(self, session=None, async_session=None):
+        self.session = session
+        self.async_session = async_session
+
+    def _openai(self, use_async=False):
+        import openai
+        if self.session is not None:
+            openai.requestssession = self.session
+        if use_async and self.async_session is not None:
+            # aiosession - ContextVar, устанавливается в контексте текущей задачи
+            openai.aiosession.set(self.async_session())
+        return openai
+
+    def preload(self):
+        self._openai()
+
+    def origin(self):
+        return url_origin(self._openai().api_base)
+
+    @property
+    def available(self):
+        return bool(self._openai().api_key)
+
+    def complete(self, params):
+        response = self._openai().ChatCompletion.create(**params)
+        return response.choices[0].message['content']
+
+    async def acomplete(self, params):
+        response = await self._openai(use_async=True).ChatCompletion.acreate(**params)
+        return response.choices[0].message['content']
+
+    def stream(self, params):
+        for chunk in self._openai().ChatCompletion.create(stream=True, **params):
+            content = chunk.choices[0].delta.get('content')
+            if content:
+                yield content
+
+    async def astream(self, params):
+        openai = self._openai(use_async=True)
+        async for chunk in await openai.ChatCompletion.acreate(stream=True, **params):
+            content = chunk.choices[0].delta.get('content')
+            if content:
+                yield content
+
+
+# Локальные заглушки для нагрузочных тестов без сети
+
+class FakeUpstream:
+    """Настраиваемые задержка и доля ошибок локальной заглушки"""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+
+    def delay(self):
+        return max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+
+    def maybe_fail(self):
+        if self.error_rate and self.random.random() < self.error_rate:
+            raise UpstreamError(self.name, 503, f"{self.name} stand-in injected failure")
+
+    def wait(self):
+        time.sleep(self.delay())
+        self.maybe_fail()
+
+    async def await_(self):
+        await asyncio.sleep(self.delay())
+        self.maybe_fail()
+
+
+# (name, mid, перевод) - типичные метки Vision
+FAKE_VOCABULARY = [
+    ("Person", "/m/01g317", "человек"), ("Cup", "/m/02p5f1q", "чашка"),
+    ("Chair", "/m/01mzpv", "стул"), ("Table", "/m/04bcr3", "стол"),
+    ("Bottle", "/m/04dr76w", "бутылка"), ("Laptop", "/m/01c648", "ноутбук"),
+    ("Mobile phone", "/m/050k8", "мобильный телефон"), ("Book", "/m/0bt_c3", "книга"),
+    ("Door", "/m/02dgv", "дверь"), ("Window", "/m/0d4v4", "окно"),
+    ("Car", "/m/0k4j", "машина"), ("Dog", "/m/0bt9lr", "собака"),
+    ("Cat", "/m/01yrx", "кошка"), ("Bag", "/m/0hf58v5", "сумка"),
+    ("Glasses", "/m/0jyfg", "очки"), ("Clock", "/m/01x3z", "часы"),
+    ("Plant", "/m/05s2s", "растение"), ("Television", "/m/07c52", "телевизор"),
+    ("Shoe", "/m/06rrc", "туфля"), ("Furniture", "/m/0c_jw", "мебель"),
+]
+FAKE_TRANSLATIONS = {name.lower(): translation for name, _, translation in FAKE_VOCABULARY}
+
+
+class FakeVisionBackend(FakeUpstream, VisionBackend):
+    """Возвращает правдоподобные localizedObjectAnnotations/labelAnnotations.
+
+    Результат детерминирован по содержимому изображения: одинаковые кадры дают
+    одинаковые ответы, как у настоящего Vision.
+    """
+
+    def annotate(self, requests):
+        self.wait()
+        return [self.fake_response(request) for request in requests]
+
+    async def aannotate(self, requests):
+        await self.await_()
+        return [self.fake_response(request) for request in requests]
+
+    @staticmethod
+    def fake_response(request):
+        content = request.get('image', {}).get('content', '')
+        rng = random.Random(zlib.crc32(content.encode('ascii', 'ignore')))
+        objects = []
+        for name, mid, _ in rng.sample(FAKE_VOCABULARY, rng.randint(0, 5)):
+            for _ in range(rng.choice((1, 1, 1, 2, 3))):
+                x, y = rng.uniform(0, 0.7), rng.uniform(0, 0.7)
+                w, h = rng.uniform(0.1, 0.3), rng.uniform(0.1, 0.3)
+                objects.append({
+                    "mid": mid,
+                    "name": name,
+                    "score": round(rng.uniform(0.5, 0.98), 6),
+                    "boundingPoly": {"normalizedVertices": [
+                        {"x": x, "y": y}, {"x": x + w, "y": y},
+                        {"x": x + w, "y": y + h}, {"x": x, "y": y + h}
+                    ]}
+                })
+        labels = []
+        for name, mid, _ in rng.sample(FAKE_VOCABULARY, rng.randint(1, 6)):
+            score = round(rng.uniform(0.55, 0.97), 6)
+            labels.append({"mid": mid, "description": name, "score": score, "topicality": score})
+        labels.sort(key=lambda label: label["score"], reverse=True)
+        return {"localizedObjectAnnotations": objects, "labelAnnotations": labels}
+
+
+class FakeTranslateBackend(FakeUpstream, TranslateBackend):
+    def translate(self, texts, src, dest):
+        self.wait()
+        return [FAKE_TRANSLATIONS.get(text.lower(), text) for text in texts]
+
+
+# Кадр MPEG-1 Layer III 128 кбит/с 44.1 кГц без звука (417 байт)
+SILENT_MP3_FRAME = b'\xff\xfb\x90\x64' + b'\x00' * 413
+
+
+class FakeTTSBackend(FakeUpstream, TTSBackend):
+    """Возвращает тишину длительностью, пропорциональной длине текста"""
+
+    def synthesize(self, text, lang):
+        self.wait()
+        # ~26 мс на кадр, ~70 мс на символ речи
+        return SILENT_MP3_FRAME * max(1, len(text) * 70 // 26)
+
+
+class FakeChatBackend(FakeUpstream, ChatBackend):
+    def answer(self, params):
+        question = params['messages'][-1]['content']
+        digest = hashlib.md5(question.encode('utf-8')).hexdigest()[:6]
+        return (f"Это тестовый ответ на вопрос «{question}». "
+                f"Он сгенерирован локальной заглушкой ({digest}). "
+                f"Настоящая модель ответила бы подробнее.")
+
+    def complete(self, params):
+        self.wait()
+        return self.answer(params)
+
+    async def acomplete(self, params):
+        await self.await_()
+        return self.answer(params)
+
+    def stream(self, params):
+        # Задержка - до первого фрагмента, дальше слова идут с интервалом ~20 мс
+        self.wait()
+        for word in re.findall(r'\S+\s*', self.answer(params)):
+            yield word
+            time.sleep(0.02)
+
+    async def astream(self, params):
+        await self.await_()
+        for word in re.findall(r'\S+\s*', self.answer(params)):
+            yield word
+            await asyncio.sleep(0.02)
+
+
+FAKE_BACKENDS = {
+    'vision': FakeVisionBackend,
+    'translate': FakeTranslateBackend,
+    'tts': FakeTTSBackend,
+    'openai': FakeChatBackend,
+}
+
+
+def create_fake_backend(service, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+    return FAKE_BACKENDS[service](latency, jitter, error_rate, seed)
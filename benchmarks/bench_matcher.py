@@ -0,0 +1,84 @@
+"""Микро-бенчмарк: автомат PhraseMatcher против прежнего линейного перебора PHRASES.
+
+Запуск: python benchmarks/bench_matcher.py [--sizes 55,500,2000,5000] [--commands 2000]
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from matcher import PhraseMatcher  # noqa: E402
+from phrases import PHRASES  # noqa: E402
+
+ALPHABET = "абвгдеёжзийклмнопрстуфхцчшщъыьэюя"
+
+
+def linear_match(table, command_lower):
+    """Прежний алгоритм DeasanAI.get_local_response (два прохода по таблице)"""
+    for question in table:
+        if question in command_lower:
+            return question
+    for question in table:
+        if any(word in command_lower for word in question.split()):
+            return question
+    return None
+
+
+def random_word(rng):
+    return "".join(rng.choice(ALPHABET) for _ in range(rng.randint(5, 10)))
+
+
+def build_table(size, rng):
+    """Реальные фразы плюс синтетические до нужного размера"""
+    table = dict(PHRASES['ru'])
+    while len(table) < size:
+        phrase = " ".join(random_word(rng) for _ in range(rng.randint(2, 4)))
+        table[phrase] = "ответ"
+    return table
+
+
+def build_commands(table, count, rng):
+    """Смесь команд: с точным совпадением, с совпадением по слову и без совпадений"""
+    phrases = list(table)
+    commands = []
+    for i in range(count):
+        kind = i % 3
+        if kind == 0:
+            commands.append(f"скажи пожалуйста {rng.choice(phrases)} сейчас")
+        elif kind == 1:
+            commands.append(f"{rng.choice(rng.choice(phrases).split())} {random_word(rng)}")
+        else:
+            commands.append(" ".join(random_word(rng) for _ in range(4)))
+    return commands
+
+
+def run(sizes, command_count, repeat):
+    rng = random.Random(42)
+    print(f"{'phrases':>8} {'linear, us':>12} {'automaton, us':>14} {'speedup':>8}")
+    for size in sizes:
+        table = build_table(size, rng)
+        commands = build_commands(table, command_count, rng)
+        matcher = PhraseMatcher(table)
+
+        for command in commands:
+            assert matcher.match(command) == linear_match(table, command), command
+
+        linear = min(timeit.repeat(lambda: [linear_match(table, c) for c in commands],
+                                   number=1, repeat=repeat))
+        automaton = min(timeit.repeat(lambda: [matcher.match(c) for c in commands],
+                                      number=1, repeat=repeat))
+        per_linear = linear / len(commands) * 1e6
+        per_automaton = automaton / len(commands) * 1e6
+        print(f"{size:>8} {per_linear:>12.1f} {per_automaton:>14.1f} {per_linear / per_automaton:>7.1f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='55,500,2000,5000')
+    parser.add_argument('--commands', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    run([int(s) for s in args.sizes.split(',')], args.commands, args.repeat)
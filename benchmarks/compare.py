@@ -0,0 +1,37 @@
+"""Сравнение двух JSON-результатов benchmarks/load.py.
+
+Запуск: python benchmarks/compare.py old.json new.json
+"""
+import json
+import sys
+
+METRICS = ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'errors')
+
+
+def delta(old, new):
+    if old in (None, 0) or new is None:
+        return ''
+    return f"{(new - old) / old * 100:+.1f}%"
+
+
+def main(old_path, new_path):
+    with open(old_path, encoding='utf-8') as f:
+        old = json.load(f)
+    with open(new_path, encoding='utf-8') as f:
+        new = json.load(f)
+
+    print(f"{old_path} ({old.get('git_revision')}) -> {new_path} ({new.get('git_revision')})")
+    for section in ('endpoints', 'kinds'):
+        for name in sorted(set(old.get(section, {})) | set(new.get(section, {}))):
+            before = old.get(section, {}).get(name, {})
+            after = new.get(section, {}).get(name, {})
+            print(f"\n{name}")
+            for metric in METRICS:
+                a, b = before.get(metric), after.get(metric)
+                print(f"  {metric:<15} {str(a):>10} -> {str(b):>10} {delta(a, b):>9}")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        raise SystemExit(__doc__)
+    main(sys.argv[1], sys.argv[2])
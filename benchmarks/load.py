@@ -0,0 +1,284 @@
+"""Нагрузочный тест /api/detect и /api/process_command.
+
+Работает либо внутри процесса (Flask test client, по умолчанию с локальными
+заглушками сервисов), либо против запущенного сервера (gunicorn/uvicorn).
+Печатает пропускную способность и p50/p95/p99 по эндпоинтам и видам запросов
+и сохраняет результаты в JSON для сравнения запусков (benchmarks/compare.py).
+
+Примеры:
+    python benchmarks/load.py --duration 30 --concurrency 16
+    python benchmarks/load.py --target http://127.0.0.1:5000 --mix detect=1
+    python benchmarks/load.py --frame-sizes 640x480,1920x1080 --jpeg-qualities 60,90
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Вопросы, на которые нет локального ответа - уходят в языковую модель
+LLM_QUESTIONS = [
+    "объясни теорию относительности простыми словами",
+    "какие витамины полезны зимой",
+    "сколько километров до луны",
+    "как приготовить борщ",
+    "почему небо голубое",
+    "посоветуй книгу про космос",
+]
+# Реплики сценариев: запуск и последующие ответы пользователя
+SCENARIO_TURNS = [
+    "составь список", "молоко", "хлеб", "хватит",
+    "напомни мне", "позвонить врачу", "завтра в десять",
+]
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(q / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def make_frames(sizes, qualities, count, seed):
+    """Синтетические JPEG-кадры с фигурами и шумом"""
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    frames = []
+    for i in range(count):
+        width, height = sizes[i % len(sizes)]
+        quality = qualities[i % len(qualities)]
+        image = Image.effect_noise((width, height), rng.randint(20, 60)).convert('RGB')
+        draw = ImageDraw.Draw(image)
+        for _ in range(rng.randint(3, 8)):
+            x, y = rng.randrange(width), rng.randrange(height)
+            color = tuple(rng.randrange(256) for _ in range(3))
+            draw.rectangle((x, y, x + rng.randint(20, width // 3), y + rng.randint(20, height // 3)), fill=color)
+        buffered = io.BytesIO()
+        image.save(buffered, format='JPEG', quality=quality)
+        frames.append((f"{width}x{height}@q{quality}", base64.b64encode(buffered.getvalue()).decode('ascii')))
+    return frames
+
+
+def make_commands(seed):
+    """Смесь команд по видам: local, scenario, llm"""
+    from phrases import PHRASES
+
+    rng = random.Random(seed)
+    local = [rng.choice(list(PHRASES['ru'])) for _ in range(50)]
+    return {'local': local, 'scenario': SCENARIO_TURNS, 'llm': LLM_QUESTIONS}
+
+
+class InProcessTarget:
+    def __init__(self):
+        import app
+        self.app = app.app
+
+    def client(self):
+        return self.app.test_client()
+
+    def post(self, client, path, payload):
+        response = client.post(path, json=payload)
+        return response.status_code, len(response.data)
+
+
+class HttpTarget:
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def client(self):
+        import requests
+        return requests.Session()
+
+    def post(self, client, path, payload):
+        response = client.post(self.base_url + path, json=payload, timeout=self.timeout)
+        return response.status_code, len(response.content)
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.bytes = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, key, latency, ok, size):
+        with self._lock:
+            self.samples[key].append(latency)
+            self.bytes[key] += size
+            if not ok:
+                self.errors[key] += 1
+
+    def summary(self, elapsed):
+        def stats(latencies, errors, size):
+            latencies = sorted(latencies)
+            return {
+                'requests': len(latencies),
+                'errors': errors,
+                'throughput_rps': round(len(latencies) / elapsed, 2),
+                'p50_ms': _ms(percentile(latencies, 50)),
+                'p95_ms': _ms(percentile(latencies, 95)),
+                'p99_ms': _ms(percentile(latencies, 99)),
+                'max_ms': _ms(latencies[-1] if latencies else None),
+                'response_bytes': size,
+            }
+
+        by_endpoint = defaultdict(lambda: ([], 0, 0))
+        by_kind = {}
+        for (endpoint, kind), latencies in self.samples.items():
+            errors = self.errors[(endpoint, kind)]
+            size = self.bytes[(endpoint, kind)]
+            by_kind[f"{endpoint} [{kind}]"] = stats(latencies, errors, size)
+            all_latencies, all_errors, all_size = by_endpoint[endpoint]
+            by_endpoint[endpoint] = (all_latencies + latencies, all_errors + errors, all_size + size)
+
+        total = sum(len(latencies) for latencies in self.samples.values())
+        return {
+            'elapsed_s': round(elapsed, 3),
+            'requests': total,
+            'throughput_rps': round(total / elapsed, 2),
+            'endpoints': {endpoint: stats(*values) for endpoint, values in by_endpoint.items()},
+            'kinds': by_kind,
+        }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def worker(target, mix, frames, commands, recorder, stop_at, max_requests, counter, seed):
+    rng = random.Random(seed)
+    client = target.client()
+    user_id = f"bench-{seed}"
+    endpoints, weights = zip(*mix.items())
+    command_kinds = list(commands)
+
+    while time.perf_counter() < stop_at:
+        with counter['lock']:
+            if max_requests and counter['sent'] >= max_requests:
+                return
+            counter['sent'] += 1
+
+        endpoint = rng.choices(endpoints, weights)[0]
+        if endpoint == 'detect':
+            kind, image = rng.choice(frames)
+            path, payload = '/api/detect', {'image': image, 'user_id': user_id, 'audio_delivery': 'url'}
+        else:
+            kind = rng.choice(command_kinds)
+            path = '/api/process_command'
+            payload = {'command': rng.choice(commands[kind]), 'user_id': user_id, 'audio_delivery': 'url'}
+
+        started = time.perf_counter()
+        try:
+            status, size = target.post(client, path, payload)
+            ok = status < 400
+        except Exception:
+            size, ok = 0, False
+        recorder.record((path, kind), time.perf_counter() - started, ok, size)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        mix[name.strip()] = float(weight or 1)
+    unknown = set(mix) - {'detect', 'command'}
+    if unknown:
+        raise SystemExit(f"Unknown mix entries: {', '.join(sorted(unknown))}")
+    return mix
+
+
+def print_report(result):
+    print(f"\n{result['requests']} requests in {result['elapsed_s']} s, {result['throughput_rps']} req/s")
+    header = f"{'endpoint':<42} {'req':>6} {'err':>5} {'rps':>8} {'p50':>9} {'p95':>9} {'p99':>9}"
+    for title, section in (('By endpoint', 'endpoints'), ('By request kind', 'kinds')):
+        print(f"\n{title}\n{header}")
+        for name, stats in sorted(result[section].items()):
+            print(f"{name:<42} {stats['requests']:>6} {stats['errors']:>5} {stats['throughput_rps']:>8} "
+                  f"{stats['p50_ms']:>9} {stats['p95_ms']:>9} {stats['p99_ms']:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--target', default='inprocess', help='inprocess или URL запущенного сервера')
+    parser.add_argument('--real-backends', action='store_true',
+                        help='внутри процесса использовать настоящие сервисы вместо заглушек')
+    parser.add_argument('--duration', type=float, default=20, help='длительность теста, с')
+    parser.add_argument('--requests', type=int, default=0, help='ограничить число запросов')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--mix', default='detect=0.6,command=0.4')
+    parser.add_argument('--frame-sizes', default='320x240,640x480,1280x720,1920x1080')
+    parser.add_argument('--jpeg-qualities', default='60,80,95')
+    parser.add_argument('--frames', type=int, default=24, help='число разных кадров')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='путь к JSON с результатами')
+    args = parser.parse_args()
+
+    if args.target == 'inprocess':
+        if not args.real_backends:
+            os.environ.setdefault('DEASAN_BACKENDS', 'fake')
+        target = InProcessTarget()
+    else:
+        target = HttpTarget(args.target, args.timeout)
+
+    sizes = [tuple(int(v) for v in size.split('x')) for size in args.frame_sizes.split(',')]
+    qualities = [int(q) for q in args.jpeg_qualities.split(',')]
+    mix = parse_mix(args.mix)
+    frames = make_frames(sizes, qualities, args.frames, args.seed)
+    commands = make_commands(args.seed)
+
+    recorder = Recorder()
+    counter = {'sent': 0, 'lock': threading.Lock()}
+    started = time.perf_counter()
+    stop_at = started + args.duration
+    threads = [threading.Thread(target=worker, args=(target, mix, frames, commands, recorder, stop_at,
+                                                     args.requests, counter, args.seed * 1000 + i))
+               for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    result = recorder.summary(time.perf_counter() - started)
+    result['config'] = {
+        'target': args.target,
+        'concurrency': args.concurrency,
+        'mix': mix,
+        'frame_sizes': args.frame_sizes,
+        'jpeg_qualities': args.jpeg_qualities,
+        'backends': os.environ.get('DEASAN_BACKENDS', 'real') if args.target == 'inprocess' else None,
+    }
+    result['timestamp'] = datetime.now().isoformat(timespec='seconds')
+    result['git_revision'] = git_revision()
+    print_report(result)
+
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results',
+                                         f"load-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"\nResults written to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""Время запуска воркера: импорт wsgi:app в чистом процессе.
+
+Запускает `python -X importtime -c "import wsgi"` несколько раз, печатает
+медиану времени и самые дорогие модули и проверяет, что тяжелые зависимости
+(openai, aiohttp, requests, Pillow, googletrans, gTTS) не загружаются при
+импорте. Код возврата 1, если медиана больше --target секунд или тяжелая
+зависимость загружена заранее.
+
+Примеры:
+    python benchmarks/startup.py
+    python benchmarks/startup.py --runs 10 --target 0.4
+    python benchmarks/startup.py --report benchmarks/startup_profile.md
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Загружаются при первом использовании, а не при импорте приложения
+LAZY_MODULES = ('openai', 'aiohttp', 'requests', 'PIL', 'googletrans', 'gtts', 'numpy')
+DEFAULT_TARGET = 0.5
+
+
+def parse_importtime(stderr):
+    """[(модуль, собственное время мкс, накопленное мкс, глубина)] из вывода -X importtime"""
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules.append((name.strip(), int(self_us), int(cumulative), depth))
+    return modules
+
+
+def subtree(profile, module):
+    """Модули, загруженные импортом module (в выводе importtime дети идут перед родителем)"""
+    pending = []
+    for entry in profile:
+        if entry[3] == 0:
+            if entry[0] == module:
+                return pending
+            pending = []
+        else:
+            pending.append(entry)
+    return []
+
+
+def run_once(module, env):
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=ROOT, env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - started
+    if result.returncode != 0:
+        sys.exit(f"import {module} failed:\n{result.stderr[-2000:]}")
+    return elapsed, parse_importtime(result.stderr)
+
+
+def measure(module, runs):
+    env = dict(os.environ)
+    # Без прогрева TTS и фоновых потоков - меряется только импорт
+    env.setdefault('TTS_PREWARM', '0')
+    env['PYTHONDONTWRITEBYTECODE'] = '1'
+    timings = []
+    profile = None
+    for _ in range(runs):
+        elapsed, modules = run_once(module, env)
+        timings.append(elapsed)
+        profile = modules
+    return timings, profile
+
+
+def report(module, timings, profile, top, target):
+    median = statistics.median(timings)
+    loaded = {name.split('.')[0] for name, _, _, _ in profile}
+    eager = [name for name in LAZY_MODULES if name in loaded]
+    tree = subtree(profile, module)
+    top_level = sorted((m for m in tree if m[3] <= 2), key=lambda m: -m[2])[:top]
+    slowest = sorted(tree, key=lambda m: -m[1])[:top]
+
+    lines = [
+        f"# Запуск воркера: import {module}",
+        "",
+        f"Python {sys.version.split()[0]}, запусков: {len(timings)}, "
+        f"медиана {median:.3f} с (мин. {min(timings):.3f}, макс. {max(timings):.3f}), цель {target:.2f} с.",
+        "",
+        "Тяжелые зависимости при импорте: " + (", ".join(eager) if eager else "не загружаются"),
+        "",
+        "## Импорты приложения до второго уровня (накопленное время)",
+        "",
+        "| модуль | мс |",
+        "|---|---:|",
+    ]
+    lines += [f"| {name} | {cumulative / 1000:.1f} |" for name, _, cumulative, _ in top_level]
+    lines += [
+        "",
+        "## Самые медленные модули (собственное время)",
+        "",
+        "| модуль | мс |",
+        "|---|---:|",
+    ]
+    lines += [f"| {name} | {self_us / 1000:.1f} |" for name, self_us, _, _ in slowest]
+    return median, eager, "\n".join(lines) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--module', default='wsgi')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--target', type=float, default=float(os.environ.get('STARTUP_TARGET', DEFAULT_TARGET)))
+    parser.add_argument('--report', help="сохранить отчет в Markdown")
+    args = parser.parse_args()
+
+    timings, profile = measure(args.module, args.runs)
+    median, eager, text = report(args.module, timings, profile, args.top, args.target)
+    print(text)
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+    failed = False
+    if eager:
+        print(f"FAIL: loaded at import time: {', '.join(eager)}")
+        failed = True
+    if median > args.target:
+        print(f"FAIL: median startup {median:.3f}s is above target {args.target:.2f}s")
+        failed = True
+    if not failed:
+        print(f"OK: median startup {median:.3f}s, target {args.target:.2f}s")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
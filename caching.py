@@ -0,0 +1,107 @@
+# caching.py
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Потокобезопасный LRU-кэш с ограничением по числу элементов"""
+
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_items:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TTLCache(LRUCache):
+    """LRU-кэш, записи которого устаревают через заданное время"""
+
+    def __init__(self, max_items, ttl):
+        super().__init__(max_items)
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        entry = super().get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            with self._lock:
+                self._data.pop(key, None)
+            return default
+        return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        super().set(key, (expires_at, value))
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+
+class SingleFlight:
+    """Склеивает одновременные запросы одного ключа в один вызов"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def claim(self, key):
+        """Возвращает (лидер ли вызывающий, Future с результатом)"""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                return False, future
+            future = Future()
+            self._calls[key] = future
+            return True, future
+
+    def resolve(self, key, value=None, error=None):
+        """Завершает вызов лидера и будит всех ожидающих"""
+        with self._lock:
+            future = self._calls.pop(key, None)
+        if future is None:
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(value)
+
+    def do(self, key, fn, timeout=None):
+        """Выполняет fn() один раз на ключ среди всех одновременных вызывающих"""
+        leader, future = self.claim(key)
+        if leader:
+            try:
+                value = fn()
+            except BaseException as e:
+                # Ожидающие не должны висеть до таймаута и при отмене/выходе лидера
+                self.resolve(key, error=e if isinstance(e, Exception) else RuntimeError("Cancelled"))
+                raise
+            self.resolve(key, value)
+            return value
+        return future.result(timeout)
@@ -0,0 +1,164 @@
+# chat_cache.py
+import asyncio
+import hashlib
+import logging
+import re
+import threading
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from caching import SingleFlight, TTLCache
+
+logger = logging.getLogger('DeasanAI')
+
+# Вопросы о самом пользователе и о текущем моменте не кэшируются
+BYPASS_WORDS = (
+    'я', 'меня', 'мне', 'мой', 'моя', 'мое', 'мои', 'сегодня', 'сейчас', 'завтра', 'вчера',
+    'погода', 'погоду', 'новости', 'курс', 'время', 'дата',
+    'i', 'me', 'my', 'today', 'now', 'tomorrow', 'yesterday', 'weather', 'news', 'time', 'date'
+)
+
+
+def normalize_command(command):
+    """Приводит вопрос к каноническому виду: регистр, ё, пунктуация, пробелы"""
+    text = command.lower().replace('ё', 'е')
+    text = re.sub(r'[^\w\s]', ' ', text)
+    return ' '.join(text.split())
+
+
+def prompt_version(*parts):
+    """Короткий отпечаток системного промпта и параметров модели"""
+    return hashlib.sha256('\0'.join(map(str, parts)).encode('utf-8')).hexdigest()[:12]
+
+
+class ResponseCache:
+    """Кэш ответов языковой модели с TTL и склейкой одинаковых запросов
+
+    Ключ - нормализованный вопрос, язык и версия промпта, поэтому смена
+    системного промпта или модели не отдает старые ответы. Пока один вызов
+    к модели выполняется, одинаковые вопросы ждут его результат, но не дольше
+    wait_timeout: потом спрашивают модель сами.
+    """
+
+    def __init__(self, ttl=6 * 3600, max_items=2048, wait_timeout=60, bypass_words=BYPASS_WORDS):
+        self.cache = TTLCache(max_items, ttl)
+        self.inflight = SingleFlight()
+        self.wait_timeout = wait_timeout
+        self.bypass_words = frozenset(bypass_words)
+        self._lock = threading.Lock()
+        self.counters = {
+            'hits': 0,
+            'misses': 0,
+            'coalesced': 0,
+            'bypassed': 0,
+            'wait_timeouts': 0
+        }
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def cacheable(self, command):
+        """Персональные и зависящие от времени вопросы идут мимо кэша"""
+        return not self.bypass_words.intersection(normalize_command(command).split())
+
+    def key(self, command, lang, version):
+        return (normalize_command(command), lang, version)
+
+    def get_or_complete(self, command, lang, version, complete, use_cache=True):
+        """Ответ из кэша или complete(); одинаковые одновременные вопросы - один вызов"""
+        if not use_cache or not self.cacheable(command):
+            self._count('bypassed')
+            return complete()
+
+        key = self.key(command, lang, version)
+        cached = self.cache.get(key)
+        if cached is not None:
+            self._count('hits')
+            return cached
+
+        leader, future = self.inflight.claim(key)
+        if not leader:
+            self._count('coalesced')
+            try:
+                return future.result(self.wait_timeout)
+            except FutureTimeout:
+                self._wait_timed_out(command)
+                return self._complete_alone(key, complete())
+
+        self._count('misses')
+        try:
+            answer = complete()
+        except BaseException as e:
+            self.inflight.resolve(key, error=e if isinstance(e, Exception) else RuntimeError("Cancelled"))
+            raise
+        self._store(key, answer)
+        return answer
+
+    async def aget_or_complete(self, command, lang, version, acomplete, use_cache=True):
+        """Асинхронный вариант get_or_complete"""
+        if not use_cache or not self.cacheable(command):
+            self._count('bypassed')
+            return await acomplete()
+
+        key = self.key(command, lang, version)
+        cached = self.cache.get(key)
+        if cached is not None:
+            self._count('hits')
+            return cached
+
+        leader, future = self.inflight.claim(key)
+        if not leader:
+            self._count('coalesced')
+            try:
+                # shield: таймаут ожидающего не должен отменять общий future
+                return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), self.wait_timeout)
+            except asyncio.TimeoutError:
+                self._wait_timed_out(command)
+                return self._complete_alone(key, await acomplete())
+
+        self._count('misses')
+        try:
+            answer = await acomplete()
+        except BaseException as e:
+            self.inflight.resolve(key, error=e if isinstance(e, Exception) else RuntimeError("Cancelled"))
+            raise
+        self._store(key, answer)
+        return answer
+
+    def peek(self, command, lang, version):
+        """Готовый ответ из кэша без обращения к модели (для потокового режима)"""
+        if not self.cacheable(command):
+            self._count('bypassed')
+            return None
+        answer = self.cache.get(self.key(command, lang, version))
+        if answer is not None:
+            self._count('hits')
+        else:
+            self._count('misses')
+        return answer
+
+    def put(self, command, lang, version, answer):
+        """Сохраняет ответ, полученный в обход get_or_complete"""
+        if answer and self.cacheable(command):
+            self.cache.set(self.key(command, lang, version), answer)
+
+    def _wait_timed_out(self, command):
+        self._count('wait_timeouts')
+        logger.warning(f"Chat cache: no answer from the leading call in {self.wait_timeout}s, asking the model again")
+
+    def _complete_alone(self, key, answer):
+        """Ответ ожидающего, который не дождался ведущего вызова и спросил модель сам"""
+        if answer:
+            self.cache.set(key, answer)
+        return answer
+
+    def _store(self, key, answer):
+        if answer:
+            self.cache.set(key, answer)
+        self.inflight.resolve(key, answer)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats['items'] = len(self.cache)
+        return stats
@@ -0,0 +1,265 @@
+# conversation_store.py
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+
+logger = logging.getLogger('DeasanAI')
+
+
+class ConversationStore(ABC):
+    """Хранилище диалогов и памяти пользователей.
+
+    append(user_id, role, text) - реплика в историю (хранится max_turns последних),
+    history(user_id) - список {"role", "content"},
+    remember(user_id, key, value) / recall(user_id, key) - имя, тема и т.п.
+    Пользователи, не писавшие дольше ttl секунд, и самые давние сверх max_users
+    удаляются.
+    """
+
+    def __init__(self, max_turns=10, max_users=10000, ttl=24 * 3600):
+        self.max_turns = max_turns
+        self.max_users = max_users
+        self.ttl = ttl
+
+    @abstractmethod
+    def append(self, user_id, role, text):
+        """Добавляет реплику, оставляя max_turns последних"""
+
+    @abstractmethod
+    def history(self, user_id):
+        """Реплики пользователя [{"role", "content"}] от старых к новым"""
+
+    @abstractmethod
+    def remember(self, user_id, key, value):
+        """Запоминает значение о пользователе (имя, тема)"""
+
+    @abstractmethod
+    def recall(self, user_id, key, default=None):
+        """Запомненное значение или default"""
+
+    @abstractmethod
+    def stats(self):
+        """Число пользователей и прочие показатели для /metrics"""
+
+
+class _UserState:
+    __slots__ = ('messages', 'values', 'touched')
+
+    def __init__(self, max_turns):
+        # deque с maxlen отбрасывает старые реплики за O(1)
+        self.messages = deque(maxlen=max_turns)
+        self.values = {}
+        self.touched = time.monotonic()
+
+
+class MemoryConversationStore(ConversationStore):
+    """Хранилище в памяти процесса: кольцевые буферы, TTL и LRU по пользователям"""
+
+    def __init__(self, max_turns=10, max_users=10000, ttl=24 * 3600):
+        super().__init__(max_turns, max_users, ttl)
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+        self.evicted = 0
+
+    def _get(self, user_id, create=False):
+        state = self._users.get(user_id)
+        now = time.monotonic()
+        if state is not None and now - state.touched > self.ttl:
+            del self._users[user_id]
+            self.evicted += 1
+            state = None
+        if state is None:
+            if not create:
+                return None
+            state = self._users[user_id] = _UserState(self.max_turns)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+                self.evicted += 1
+        state.touched = now
+        self._users.move_to_end(user_id)
+        return state
+
+    def append(self, user_id, role, text):
+        with self._lock:
+            self._get(user_id, create=True).messages.append({"role": role, "content": text})
+
+    def history(self, user_id):
+        with self._lock:
+            state = self._get(user_id)
+            return list(state.messages) if state else []
+
+    def remember(self, user_id, key, value):
+        with self._lock:
+            self._get(user_id, create=True).values[key] = value
+
+    def recall(self, user_id, key, default=None):
+        with self._lock:
+            state = self._get(user_id)
+            return state.values.get(key, default) if state else default
+
+    def stats(self):
+        with self._lock:
+            messages = sum(len(state.messages) for state in self._users.values())
+            size = sum(sys.getsizeof(message['content'])
+                       for state in self._users.values() for message in state.messages)
+            return {
+                "backend": "memory",
+                "users": len(self._users),
+                "messages": messages,
+                "approx_bytes": size,
+                "evicted": self.evicted
+            }
+
+
+class SQLiteConversationStore(ConversationStore):
+    """Общее для всех воркеров узла хранилище в SQLite (режим WAL).
+
+    Соединение свое у каждого потока и процесса; устаревшие пользователи
+    удаляются не чаще раза в prune_interval секунд.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id TEXT PRIMARY KEY,
+            touched REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS users_touched ON users (touched);
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS messages_user ON messages (user_id, id);
+        CREATE TABLE IF NOT EXISTS user_values (
+            user_id TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (user_id, key)
+        );
+    """
+
+    def __init__(self, path, max_turns=10, max_users=10000, ttl=24 * 3600, prune_interval=60):
+        super().__init__(max_turns, max_users, ttl)
+        self.path = path
+        self.prune_interval = prune_interval
+        self._local = threading.local()
+        self._last_prune = 0.0
+        self.evicted = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as db:
+            db.executescript(self.SCHEMA)
+
+    def _connect(self):
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def _touch(self, db, user_id):
+        db.execute('INSERT INTO users (user_id, touched) VALUES (?, ?) '
+                   'ON CONFLICT(user_id) DO UPDATE SET touched = excluded.touched',
+                   (user_id, time.time()))
+
+    def _alive(self, db, user_id):
+        row = db.execute('SELECT touched FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        return row is not None and time.time() - row[0] <= self.ttl
+
+    def append(self, user_id, role, text):
+        db = self._connect()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            self._touch(db, user_id)
+            db.execute('INSERT INTO messages (user_id, role, content) VALUES (?, ?, ?)', (user_id, role, text))
+            db.execute('DELETE FROM messages WHERE user_id = ? AND id NOT IN '
+                       '(SELECT id FROM messages WHERE user_id = ? ORDER BY id DESC LIMIT ?)',
+                       (user_id, user_id, self.max_turns))
+        self._maybe_prune(db)
+
+    def history(self, user_id):
+        db = self._connect()
+        if not self._alive(db, user_id):
+            return []
+        rows = db.execute('SELECT role, content FROM messages WHERE user_id = ? ORDER BY id',
+                          (user_id,)).fetchall()
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def remember(self, user_id, key, value):
+        db = self._connect()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            self._touch(db, user_id)
+            db.execute('INSERT OR REPLACE INTO user_values (user_id, key, value) VALUES (?, ?, ?)',
+                       (user_id, key, json.dumps(value, ensure_ascii=False)))
+        self._maybe_prune(db)
+
+    def recall(self, user_id, key, default=None):
+        db = self._connect()
+        if not self._alive(db, user_id):
+            return default
+        row = db.execute('SELECT value FROM user_values WHERE user_id = ? AND key = ?',
+                         (user_id, key)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def _maybe_prune(self, db):
+        now = time.monotonic()
+        if now - self._last_prune < self.prune_interval:
+            return
+        self._last_prune = now
+        try:
+            self.prune(db)
+        except sqlite3.Error as e:
+            logger.error(f"Conversation store prune error: {e}")
+
+    def prune(self, db=None):
+        """Удаляет устаревших пользователей и самых давних сверх max_users"""
+        db = db or self._connect()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            expired = db.execute('DELETE FROM users WHERE touched < ?', (time.time() - self.ttl,)).rowcount
+            overflow = db.execute('DELETE FROM users WHERE user_id IN '
+                                  '(SELECT user_id FROM users ORDER BY touched DESC LIMIT -1 OFFSET ?)',
+                                  (self.max_users,)).rowcount
+            db.execute('DELETE FROM messages WHERE user_id NOT IN (SELECT user_id FROM users)')
+            db.execute('DELETE FROM user_values WHERE user_id NOT IN (SELECT user_id FROM users)')
+        self.evicted += expired + overflow
+
+    def stats(self):
+        db = self._connect()
+        users = db.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+        messages, size = db.execute('SELECT COUNT(*), COALESCE(SUM(LENGTH(content)), 0) FROM messages').fetchone()
+        file_size = 0
+        for suffix in ('', '-wal'):
+            try:
+                file_size += os.path.getsize(self.path + suffix)
+            except OSError:
+                pass
+        return {
+            "backend": "sqlite",
+            "users": users,
+            "messages": messages,
+            "approx_bytes": size,
+            "file_bytes": file_size,
+            "evicted": self.evicted
+        }
+
+
+def create_conversation_store(kind, path=None, **options):
+    """memory - в памяти процесса, sqlite - общий файл для всех воркеров узла"""
+    if kind == 'sqlite':
+        return SQLiteConversationStore(path, **options)
+    if kind != 'memory':
+        raise ValueError(f"Unknown conversation store: {kind}")
+    return MemoryConversationStore(**options)
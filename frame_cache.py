@@ -0,0 +1,73 @@
+# frame_cache.py
+import threading
+import time
+from collections import OrderedDict, deque
+
+HASH_SIZE = 8
+
+
+def image_hash(image, size=HASH_SIZE):
+    """Разностный перцептивный хэш (dHash) изображения: 64 бита для size=8"""
+    from PIL import Image
+
+    small = image.convert('L').resize((size + 1, size), Image.BILINEAR, reducing_gap=2.0)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class FrameCache:
+    """Кэш результатов Vision по перцептивному хэшу кадра, отдельно для каждого пользователя"""
+
+    def __init__(self, max_distance=6, ttl=10, frames_per_user=8, max_users=1024):
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self.frames_per_user = frames_per_user
+        self.max_users = max_users
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, user_id, frame_hash):
+        """Возвращает результат похожего недавнего кадра или None"""
+        deadline = time.monotonic() - self.ttl
+        with self._lock:
+            frames = self._users.get(user_id)
+            if frames:
+                self._users.move_to_end(user_id)
+                while frames and frames[0][0] < deadline:
+                    frames.popleft()
+                for _, cached_hash, result in reversed(frames):
+                    if hamming_distance(cached_hash, frame_hash) <= self.max_distance:
+                        self.hits += 1
+                        return result
+            self.misses += 1
+            return None
+
+    def store(self, user_id, frame_hash, result):
+        """Запоминает результат кадра, вытесняя самых давних пользователей"""
+        with self._lock:
+            frames = self._users.get(user_id)
+            if frames is None:
+                frames = self._users[user_id] = deque(maxlen=self.frames_per_user)
+            self._users.move_to_end(user_id)
+            frames.append((time.monotonic(), frame_hash, result))
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'users': len(self._users)
+            }
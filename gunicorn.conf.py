@@ -0,0 +1,33 @@
+# gunicorn.conf.py
+# Приложение загружается и прогревается один раз в мастере, воркеры получают
+# его память через fork (copy-on-write). Число воркеров - WEB_CONCURRENCY.
+import gc
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+preload_app = True
+
+
+def when_ready(server):
+    """Мастер: прогрев до запуска воркеров"""
+    import app
+
+    app.warm_up()
+    # Объекты, созданные при загрузке, уходят из-под сборщика мусора: его обход
+    # не пишет в их заголовки, и общие страницы не копируются в каждом воркере
+    gc.collect()
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    """Воркер: собственные потоки и соединения"""
+    import app
+
+    app.init_worker()
+
+
+def child_exit(server, worker):
+    """Мастер: итоги завершившегося воркера остаются в /metrics, его gauge - нет"""
+    import app
+
+    app.metrics.retire(worker.pid)
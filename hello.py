@@ -3,18 +3,8 @@ import base64
 import io
 import os
 import secrets
-from PIL import Image
-import requests
 from collections import defaultdict
 from flask_cors import CORS
-from googletrans import Translator
-import openai
-import threading
-import time
-from gtts import gTTS
-import pygame
-import tempfile
-import re
 import logging
 
 app = Flask(__name__, 
@@ -32,10 +22,17 @@ logger = logging.getLogger('DeasanAI')
 AI_MODEL = "gpt-3.5-turbo"
 MAX_OBJECTS_TO_SPEAK = 4
 
-# Инициализация компонентов
-translator = Translator()
+# Инициализация компонентов (googletrans, openai, Pillow и requests загружаются при первом использовании)
+_translator = None
 listening = False
 
+def get_translator():
+    global _translator
+    if _translator is None:
+        from googletrans import Translator
+        _translator = Translator()
+    return _translator
+
 # Словари для коррекции и команд
 CORRECTION_DICT = {
     "челоек": "человек",
@@ -165,6 +162,7 @@ class DeasanAI:
                 return local_response
 
             # 2. Использование OpenAI если доступно
+            import openai
             if openai.api_key:
                 response = openai.ChatCompletion.create(
                     model=AI_MODEL,
@@ -272,6 +270,9 @@ def detect_objects():
             error_msg = "No image data" if target_lang == 'en' else "Нет данных изображения"
             return jsonify({"error": error_msg}), 400
             
+        import requests
+        from PIL import Image
+
         image_data = base64.b64decode(request.json['image'])
         image = Image.open(io.BytesIO(image_data))
         
@@ -370,7 +371,7 @@ def translate_object(obj, target_lang='ru'):
             if wrong in obj_lower:
                 return correct.capitalize()
         
-        translated = translator.translate(obj_lower, src='en', dest=target_lang).text
+        translated = get_translator().translate(obj_lower, src='en', dest=target_lang).text
         return correct_translation(translated).capitalize()
     except Exception as e:
         logger.error(f"Translation error: {e}")
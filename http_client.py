@@ -0,0 +1,224 @@
+# http_client.py
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+
+from resilience import call_timeout
+
+logger = logging.getLogger('DeasanAI')
+
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+def backoff_delay(attempt, base, cap):
+    """Экспоненциальная задержка с полным джиттером"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def is_timeout(error):
+    """Отличает таймауты от прочих ошибок (requests, openai, gtts - по имени класса)"""
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError)):
+        return True
+    return 'Timeout' in type(error).__name__
+
+
+def record_upstream(metrics, service, started, error=None, status=None):
+    """Записывает длительность вызова внешнего сервиса и его ошибки"""
+    if metrics is None:
+        return
+    metrics.observe('deasan_upstream_seconds', time.perf_counter() - started, service=service)
+    if error is not None:
+        name = 'deasan_upstream_timeouts_total' if is_timeout(error) else 'deasan_upstream_errors_total'
+        metrics.inc(name, service=service)
+    elif status is not None and status >= 400:
+        metrics.inc('deasan_upstream_errors_total', service=service)
+
+
+class HttpClient:
+    """Общий слой исходящих HTTP-запросов.
+
+    Один requests.Session на процесс с пулами keep-alive соединений по хостам,
+    таймауты для каждого сервиса и повторы с джиттером для идемпотентных
+    вызовов. После fork сессия создается заново - сокеты мастера не наследуются.
+    """
+
+    def __init__(self, pool_connections=4, pool_maxsize=10, timeouts=None, retries=2,
+                 backoff=0.2, backoff_max=2.0, default_timeout=10, metrics=None):
+        self.metrics = metrics
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.timeouts = dict(timeouts or {})
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.default_timeout = default_timeout
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        """requests.Session текущего процесса"""
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    self._session = self._create_session()
+                    self._pid = os.getpid()
+        return self._session
+
+    def _create_session(self):
+        # requests загружается вместе с первой сессией, а не при импорте приложения
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                              pool_maxsize=self.pool_maxsize)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def timeout(self, service):
+        return self.timeouts.get(service, self.default_timeout)
+
+    def preload(self):
+        """Загружает requests заранее (в мастере gunicorn до fork), не открывая сессию"""
+        import requests
+        from requests.adapters import HTTPAdapter
+        return requests, HTTPAdapter
+
+    def preconnect(self, service, url):
+        """Открывает соединение с сервисом заранее, чтобы первый запрос воркера не ждал TLS"""
+        started = time.perf_counter()
+        try:
+            self.session.head(url, timeout=self.timeout(service), allow_redirects=False)
+        except Exception as e:
+            logger.warning(f"Preconnect to {service} failed: {e}")
+            return False
+        logger.info(f"Preconnected to {service} in {(time.perf_counter() - started) * 1000:.0f} ms")
+        return True
+
+    def sleep_before_retry(self, attempt):
+        time.sleep(backoff_delay(attempt, self.backoff, self.backoff_max))
+
+    def request(self, service, method, url, idempotent=None, **kwargs):
+        """Выполняет запрос к сервису; идемпотентные запросы повторяются при сбоях
+
+        Таймаут каждой попытки ограничен оставшимся сроком запроса.
+        """
+        import requests
+
+        limit = kwargs.pop('timeout', self.timeout(service))
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        attempts = self.retries + 1 if idempotent else 1
+
+        for attempt in range(attempts):
+            last_attempt = attempt == attempts - 1
+            timeout = call_timeout(service, limit)
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                record_upstream(self.metrics, service, started, e)
+                if last_attempt:
+                    raise
+                logger.warning(f"{service} request failed ({e}), retrying")
+            else:
+                record_upstream(self.metrics, service, started, status=response.status_code)
+                if response.status_code not in RETRY_STATUSES or last_attempt:
+                    return response
+                logger.warning(f"{service} returned {response.status_code}, retrying")
+            self.sleep_before_retry(attempt)
+
+    def get(self, service, url, **kwargs):
+        return self.request(service, 'GET', url, **kwargs)
+
+    def post(self, service, url, **kwargs):
+        return self.request(service, 'POST', url, **kwargs)
+
+    def send(self, service, prepared, **kwargs):
+        """Отправляет заранее подготовленный requests.PreparedRequest через общий пул"""
+        kwargs['timeout'] = call_timeout(service, kwargs.get('timeout', self.timeout(service)))
+        return self.session.send(prepared, **kwargs)
+
+    def call(self, service, fn, *args, **kwargs):
+        """Повторяет идемпотентный вызов сторонней библиотеки с джиттером"""
+        for attempt in range(self.retries + 1):
+            # Таймаут библиотеки задан заранее, поэтому только проверяем срок запроса
+            call_timeout(service, self.timeout(service))
+            started = time.perf_counter()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                record_upstream(self.metrics, service, started, e)
+                if attempt == self.retries:
+                    raise
+                logger.warning(f"{service} call failed ({e}), retrying")
+            else:
+                record_upstream(self.metrics, service, started)
+                return result
+            self.sleep_before_retry(attempt)
+
+
+class AsyncHttpClient:
+    """Асинхронный вариант HttpClient на aiohttp: один ClientSession на event loop"""
+
+    def __init__(self, pool_limit=100, pool_per_host=10, timeouts=None, retries=2,
+                 backoff=0.2, backoff_max=2.0, default_timeout=10, metrics=None):
+        self.metrics = metrics
+        self.pool_limit = pool_limit
+        self.pool_per_host = pool_per_host
+        self.timeouts = dict(timeouts or {})
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.default_timeout = default_timeout
+        self._session = None
+        self._loop = None
+
+    def timeout(self, service):
+        return self.timeouts.get(service, self.default_timeout)
+
+    def session(self):
+        """aiohttp.ClientSession текущего event loop (вызывать внутри корутины)"""
+        import aiohttp
+
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            connector = aiohttp.TCPConnector(limit=self.pool_limit, limit_per_host=self.pool_per_host)
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._loop = loop
+        return self._session
+
+    async def post_json(self, service, url, payload, idempotent=False):
+        """POST с JSON; возвращает (статус, разобранный JSON при статусе 200)"""
+        import aiohttp
+
+        attempts = self.retries + 1 if idempotent else 1
+        for attempt in range(attempts):
+            last_attempt = attempt == attempts - 1
+            timeout = aiohttp.ClientTimeout(total=call_timeout(service, self.timeout(service)))
+            started = time.perf_counter()
+            try:
+                async with self.session().post(url, json=payload, timeout=timeout) as response:
+                    record_upstream(self.metrics, service, started, status=response.status)
+                    if response.status not in RETRY_STATUSES or last_attempt:
+                        data = await response.json(content_type=None) if response.status == 200 else None
+                        return response.status, data
+                    logger.warning(f"{service} returned {response.status}, retrying")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                record_upstream(self.metrics, service, started, e)
+                if last_attempt:
+                    raise
+                logger.warning(f"{service} request failed ({e!r}), retrying")
+            await asyncio.sleep(backoff_delay(attempt, self.backoff, self.backoff_max))
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
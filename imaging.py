@@ -0,0 +1,96 @@
+# imaging.py
+import io
+import time
+
+
+class ImageTooLarge(ValueError):
+    """Изображение превышает допустимый размер в байтах или пикселях"""
+
+
+class PreparedImage:
+    """Результат предобработки кадра перед отправкой в Vision"""
+
+    __slots__ = ('content', 'preview', 'size', 'passthrough', 'timings')
+
+    def __init__(self, content, preview, size, passthrough, timings):
+        self.content = content
+        self.preview = preview
+        self.size = size
+        self.passthrough = passthrough
+        self.timings = timings
+
+
+class ImagePreprocessor:
+    """Уменьшает кадр до нужного размера и не перекодирует то, что уже подходит.
+
+    JPEG, который уже меньше max_edge по длинной стороне и не больше
+    passthrough_bytes, отправляется в Vision как есть. Большие JPEG декодируются
+    сразу в уменьшенном масштабе через Image.draft, так что полный битмап не
+    строится. preview - маленькая копия кадра для перцептивного хэша.
+    """
+
+    def __init__(self, max_edge=1024, passthrough_bytes=512 * 1024, max_pixels=40_000_000,
+                 max_bytes=10 * 1024 * 1024, quality=85, preview_edge=64):
+        self.max_edge = max_edge
+        self.passthrough_bytes = passthrough_bytes
+        self.max_pixels = max_pixels
+        self.max_bytes = max_bytes
+        self.quality = quality
+        self.preview_edge = preview_edge
+
+    def prepare(self, image_data):
+        # Pillow загружается при первом кадре, а не при запуске воркера
+        from PIL import Image
+
+        timings = {}
+        started = time.perf_counter()
+
+        if len(image_data) > self.max_bytes:
+            raise ImageTooLarge(f"Image is {len(image_data)} bytes, limit is {self.max_bytes}")
+
+        # Image.open читает только заголовок - размеры известны без декодирования
+        image = Image.open(io.BytesIO(image_data))
+        width, height = image.size
+        if width * height > self.max_pixels:
+            raise ImageTooLarge(f"Image is {width}x{height}, limit is {self.max_pixels} pixels")
+        timings['open'] = _elapsed_ms(started)
+
+        if (image.format == 'JPEG' and max(width, height) <= self.max_edge
+                and len(image_data) <= self.passthrough_bytes):
+            started = time.perf_counter()
+            preview = self._preview(image)
+            timings['preview'] = _elapsed_ms(started)
+            return PreparedImage(image_data, preview, (width, height), True, timings)
+
+        started = time.perf_counter()
+        scale = min(1.0, self.max_edge / max(width, height))
+        target = (max(1, round(width * scale)), max(1, round(height * scale)))
+        if image.format == 'JPEG':
+            # Декодер JPEG сам уменьшает изображение в 2/4/8 раз при чтении
+            image.draft('RGB', target)
+        image = image.convert('RGB')
+        if image.size != target:
+            image.thumbnail(target, Image.BILINEAR, reducing_gap=2.0)
+        timings['decode_resize'] = _elapsed_ms(started)
+
+        started = time.perf_counter()
+        buffered = io.BytesIO()
+        image.save(buffered, format="JPEG", quality=self.quality)
+        timings['encode'] = _elapsed_ms(started)
+
+        started = time.perf_counter()
+        preview = image.copy()
+        preview.thumbnail((self.preview_edge, self.preview_edge), Image.BILINEAR)
+        timings['preview'] = _elapsed_ms(started)
+        return PreparedImage(buffered.getvalue(), preview, image.size, False, timings)
+
+    def _preview(self, image):
+        """Декодирует JPEG в масштабе 1/8 - этого достаточно для хэша"""
+        width, height = image.size
+        image.draft('L', (max(1, width // 8), max(1, height // 8)))
+        image.load()
+        return image
+
+
+def _elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 2)
@@ -0,0 +1,344 @@
+# lexicon.py
+"""Словарь меток Vision с готовыми русскими формами для числительных.
+
+Файл собирается заранее из списка меток (lexicon/labels.tsv):
+
+    python lexicon.py lexicon/labels.tsv lexicon/labels.lex
+
+Для каждой метки в нем хранится перевод, исправленная форма (CORRECTION_DICT)
+и три формы согласования с числом: «1 чашка», «2 чашки», «5 чашек». Приложение
+отображает файл в память (mmap): поиск метки - одно обращение к хеш-таблице
+с открытой адресацией без разбора файла при запуске, а страницы файла общие
+для всех воркеров через кэш страниц ОС.
+
+Формат (little-endian):
+    заголовок  '<4sHHII': b'DLEX', версия, 0, число слотов (степень двойки), число записей
+    слоты      '<II' на слот: crc32 ключа, смещение записи (0 - пустой слот)
+    записи     ключ, перевод, формы для 1, 2-4 и 5+ - каждая строка '<H' длина + UTF-8
+"""
+import argparse
+import csv
+import logging
+import mmap
+import os
+import struct
+import zlib
+from collections import namedtuple
+
+logger = logging.getLogger('DeasanAI')
+
+MAGIC = b'DLEX'
+VERSION = 1
+HEADER = struct.Struct('<4sHHII')
+SLOT = struct.Struct('<II')
+LENGTH = struct.Struct('<H')
+FIELDS = 5
+
+# После этих согласных пишется «и», а не «ы»
+HUSHING = 'гкхжшщч'
+VOWELS = 'аеёиоуыэюя'
+# Окончания существительных женского рода на «ь»
+FEMININE_SOFT = ('сть', 'чь', 'шь', 'жь', 'щь', 'ать', 'адь', 'овь')
+
+
+def plural_category(count):
+    """'one' (1, 21, 101), 'few' (2-4, 22-24) или 'many' (0, 5-20, 25...)"""
+    count = abs(count) % 100
+    if 11 <= count <= 14:
+        return 'many'
+    if count % 10 == 1:
+        return 'one'
+    if 2 <= count % 10 <= 4:
+        return 'few'
+    return 'many'
+
+
+def _genitive_plural_a(stem):
+    """Родительный падеж мн. ч. слов на -а: книга -> книг, чашка -> чашек, бутылка -> бутылок"""
+    if len(stem) > 2 and stem[-1] == 'к' and stem[-2] not in VOWELS:
+        if stem[-2] in 'йь':
+            # чайка -> чаек
+            return stem[:-2] + 'ек'
+        return stem[:-1] + ('е' if stem[-2] in 'жшщч' else 'о') + 'к'
+    return stem
+
+
+def _noun_forms(word):
+    """(форма для 2-4, форма для 5+) существительного в именительном падеже ед. ч."""
+    stem, last = word[:-1], word[-1]
+    if last == 'а':
+        return stem + ('и' if stem and stem[-1] in HUSHING else 'ы'), _genitive_plural_a(stem)
+    if last == 'я':
+        return stem + 'и', stem + ('й' if stem and stem[-1] in VOWELS else 'ь')
+    if last == 'ь':
+        if word.endswith(FEMININE_SOFT):
+            return stem + 'и', stem + 'ей'
+        return stem + 'я', stem + 'ей'
+    if last == 'й':
+        return stem + 'я', stem + 'ев'
+    if last == 'о':
+        return stem + 'а', stem
+    if last == 'е' and stem.endswith('и'):
+        return stem + 'я', stem + 'й'
+    if last in VOWELS:
+        # Несклоняемые: кофе, пальто, метро
+        return word, word
+    if len(word) > 4 and word.endswith('ок') and word[-3] not in VOWELS:
+        # Беглая гласная: цветок -> цветка, цветков
+        return word[:-2] + 'ка', word[:-2] + 'ков'
+    if len(word) > 3 and word.endswith('ец'):
+        return word[:-2] + 'ца', word[:-2] + 'цов'
+    if last in 'жшщч':
+        return word + 'а', word + 'ей'
+    return word + 'а', word + 'ов'
+
+
+def _adjective_plural(word):
+    """Родительный падеж мн. ч. прилагательного или None, если это не прилагательное"""
+    for ending in ('ый', 'ой', 'ий', 'ая', 'яя', 'ое', 'ее'):
+        if word.endswith(ending) and len(word) > 3:
+            stem = word[:-2]
+            soft = ending in ('ий', 'яя', 'ее') or stem[-1] in HUSHING
+            return stem + ('их' if soft else 'ых')
+    return None
+
+
+def russian_forms(phrase):
+    """(1, 2-4, 5+) для названия в именительном падеже: «мобильный телефон» ->
+    («мобильный телефон», «мобильных телефона», «мобильных телефонов»).
+
+    Эвристика для слов, которых нет в словаре: прилагательные перед
+    существительным ставятся в родительный падеж мн. ч., слова после
+    существительного («чашка кофе») не меняются.
+    """
+    words = phrase.split()
+    few, many = [], []
+    for position, word in enumerate(words):
+        lowered = word.lower()
+        adjective = _adjective_plural(lowered) if position < len(words) - 1 and _cyrillic(lowered[-1:]) else None
+        if adjective:
+            few.append(_restore_case(word, adjective))
+            many.append(_restore_case(word, adjective))
+            continue
+        # Латиница (метка без перевода), цифры и знаки не склоняются
+        noun_few, noun_many = _noun_forms(lowered) if _cyrillic(lowered[-1:]) else (lowered, lowered)
+        rest = words[position + 1:]
+        few += [_restore_case(word, noun_few)] + rest
+        many += [_restore_case(word, noun_many)] + rest
+        break
+    return phrase, ' '.join(few), ' '.join(many)
+
+
+def _cyrillic(char):
+    return 'а' <= char <= 'я' or char == 'ё'
+
+
+def _restore_case(original, form):
+    return form.capitalize() if original[:1].isupper() else form
+
+
+def plural_form(word, count):
+    """Форма названия, согласованная с числом, по эвристике russian_forms"""
+    return russian_forms(word)[('one', 'few', 'many').index(plural_category(count))]
+
+
+class LexiconEntry(namedtuple('LexiconEntry', 'translation one few many')):
+    """Запись словаря: перевод сервиса и формы для 1, 2-4 и 5+"""
+
+    def form(self, count):
+        return getattr(self, plural_category(count))
+
+
+def _pack(text):
+    encoded = text.encode('utf-8')
+    return LENGTH.pack(len(encoded)) + encoded
+
+
+def write_lexicon(path, entries):
+    """Записывает {метка: (перевод, 1, 2-4, 5+)} в файл словаря.
+
+    Файл заменяется атомарно: воркеры, отобразившие старую версию, дочитывают ее.
+    """
+    slots = 8
+    while slots < len(entries) * 2:
+        slots *= 2
+    mask = slots - 1
+    table = [(0, 0)] * slots
+    records = bytearray()
+    base = HEADER.size + slots * SLOT.size
+
+    for label, values in entries.items():
+        key = label.lower()
+        digest = zlib.crc32(key.encode('utf-8'))
+        index = digest & mask
+        while table[index][1]:
+            index = (index + 1) & mask
+        table[index] = (digest, base + len(records))
+        for text in (key, *values):
+            records += _pack(text)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, 0, slots, len(entries)))
+        for digest, offset in table:
+            f.write(SLOT.pack(digest, offset))
+        f.write(records)
+    os.replace(tmp_path, path)
+
+
+class LabelLexicon:
+    """Словарь меток, отображенный в память; get(label) - LexiconEntry или None"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, self.slots, self.size = HEADER.unpack_from(self.data)
+        if magic != MAGIC or version != VERSION:
+            self.data.close()
+            raise ValueError(f"Unsupported lexicon file: {path}")
+        self.path = path
+        self.mask = self.slots - 1
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, label):
+        return self._find(label.lower().encode('utf-8')) is not None
+
+    def _find(self, key):
+        """Смещение записи после ключа или None"""
+        digest = zlib.crc32(key)
+        index = digest & self.mask
+        for _ in range(self.slots):
+            slot_digest, offset = SLOT.unpack_from(self.data, HEADER.size + index * SLOT.size)
+            if not offset:
+                return None
+            if slot_digest == digest:
+                (length,) = LENGTH.unpack_from(self.data, offset)
+                start = offset + LENGTH.size
+                if self.data[start:start + length] == key:
+                    return start + length
+            index = (index + 1) & self.mask
+        return None
+
+    def _read(self, offset, count):
+        values = []
+        for _ in range(count):
+            (length,) = LENGTH.unpack_from(self.data, offset)
+            offset += LENGTH.size
+            values.append(self.data[offset:offset + length].decode('utf-8'))
+            offset += length
+        return values
+
+    def get(self, label):
+        offset = self._find(label.lower().encode('utf-8'))
+        if offset is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return LexiconEntry(*self._read(offset, FIELDS - 1))
+
+    def entries(self):
+        """Все записи словаря: (метка, LexiconEntry)"""
+        for index in range(self.slots):
+            _, offset = SLOT.unpack_from(self.data, HEADER.size + index * SLOT.size)
+            if offset:
+                label, *values = self._read(offset, FIELDS)
+                yield label, LexiconEntry(*values)
+
+    def preload(self):
+        """Просит ОС заранее прочитать файл, чтобы первый кадр не ждал диска"""
+        if hasattr(mmap, 'MADV_WILLNEED'):
+            self.data.madvise(mmap.MADV_WILLNEED)
+
+    def stats(self):
+        return {"entries": self.size, "hits": self.hits, "misses": self.misses}
+
+
+def open_lexicon(path):
+    """LabelLexicon или None, если файла нет (метки переводятся через сервис)"""
+    if not path:
+        return None
+    try:
+        return LabelLexicon(path)
+    except FileNotFoundError:
+        logger.warning(f"Label lexicon {path} not found, labels will be translated online "
+                       f"(build it with: python lexicon.py lexicon/labels.tsv {path})")
+    except (OSError, ValueError, struct.error) as e:
+        logger.error(f"Failed to open label lexicon {path}: {e}")
+    return None
+
+
+def read_source(path):
+    """Строки labels.tsv: [(метка, перевод, [1, 2-4, 5+])]; пустые формы - по эвристике"""
+    rows = []
+    with open(path, encoding='utf-8', newline='') as f:
+        for row in csv.reader(f, delimiter='\t'):
+            if not row or not row[0].strip() or row[0].startswith('#'):
+                continue
+            cells = [cell.strip() for cell in row] + [''] * FIELDS
+            rows.append((cells[0], cells[1], cells[2:5]))
+    return rows
+
+
+def translate_missing(rows, dest='ru'):
+    """Переводит метки без перевода через googletrans (только при сборке)"""
+    from googletrans import Translator
+
+    from translation import join_batch
+
+    translator = Translator()
+    missing = [label for label, translation, _ in rows if not translation]
+    translated = {}
+    for start in range(0, len(missing), 50):
+        chunk = missing[start:start + 50]
+        texts = join_batch(lambda text, src, dest: translator.translate(text, src=src, dest=dest).text,
+                           [label.lower() for label in chunk], 'en', dest)
+        translated.update(zip(chunk, texts))
+    return [(label, translation or translated[label], forms) for label, translation, forms in rows]
+
+
+def build(source, output, translate=False):
+    """Собирает словарь из labels.tsv; возвращает число записей"""
+    from phrases import CORRECTION_DICT
+    from translation import apply_corrections
+
+    rows = read_source(source)
+    if translate:
+        rows = translate_missing(rows)
+
+    entries = {}
+    for label, translation, forms in rows:
+        if not translation:
+            logger.warning(f"Skipping {label!r}: no translation (use --translate)")
+            continue
+        corrected = forms[0] or apply_corrections(translation, CORRECTION_DICT) or translation.lower()
+        _, few, many = russian_forms(corrected)
+        entries[label] = (translation, corrected, forms[1] or few, forms[2] or many)
+    write_lexicon(output, entries)
+    return len(entries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сборка словаря меток Vision")
+    parser.add_argument('source', help="labels.tsv: метка, перевод, формы для 1, 2-4, 5+ (необязательно)")
+    parser.add_argument('output', help="файл словаря, например lexicon/labels.lex")
+    parser.add_argument('--translate', action='store_true', help="перевести метки без перевода через googletrans")
+    parser.add_argument('--show', action='store_true', help="напечатать записи собранного словаря")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    count = build(args.source, args.output, args.translate)
+    print(f"{args.output}: {count} labels")
+    if args.show:
+        lexicon = LabelLexicon(args.output)
+        for label, _, _ in read_source(args.source):
+            entry = lexicon.get(label)
+            if entry:
+                print(f"{label}\t{entry.translation}\t1 {entry.one}\t2 {entry.few}\t5 {entry.many}")
+
+
+if __name__ == '__main__':
+    main()
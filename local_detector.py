@@ -0,0 +1,129 @@
+# local_detector.py
+"""Локальный детектор объектов на CPU (ONNX Runtime).
+
+Модель выполняется в отдельных процессах: инференс не держит GIL потоков,
+обслуживающих запросы. Результат приводится к формату localizedObjectAnnotations
+Google Vision, поэтому дальше кадр обрабатывается так же, как ответ Vision.
+
+Поддерживаются детекторы с выходами boxes/classes/scores (экспорт TensorFlow
+Object Detection API, SSD/SSDLite из torchvision и т.п.): выходы ищутся по
+именам, а без имен берутся по порядку boxes, classes, scores. Файл меток -
+одна метка на строку, номер строки равен номеру класса модели.
+"""
+import io
+import os
+
+# Состояние процесса пула: модель загружается один раз в initializer
+_detector = None
+
+
+class Detector:
+    def __init__(self, model_path, labels, threads=1, box_format='yxyx'):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        # Параллелизм дают процессы пула, внутри процесса - один поток
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input = self.session.get_inputs()[0]
+        self.outputs = [output.name for output in self.session.get_outputs()]
+        self.labels = labels
+        self.box_format = box_format
+
+        shape = self.input.shape
+        self.channels_first = len(shape) == 4 and shape[1] == 3
+        size = shape[2:4] if self.channels_first else shape[1:3]
+        self.size = tuple(size) if all(isinstance(side, int) for side in size) else None
+        self.uint8 = 'uint8' in self.input.type
+
+    def preprocess(self, image_data):
+        import numpy as np
+        from PIL import Image
+
+        image = Image.open(io.BytesIO(image_data)).convert('RGB')
+        if self.size:
+            height, width = self.size
+            image = image.resize((width, height), Image.BILINEAR)
+        tensor = np.asarray(image)
+        if not self.uint8:
+            tensor = tensor.astype(np.float32) / 255.0
+        if self.channels_first:
+            tensor = tensor.transpose(2, 0, 1)
+        return tensor[np.newaxis], image.size
+
+    def split_outputs(self, outputs):
+        """(boxes, classes, scores) для одного изображения"""
+        by_name = {}
+        for name, value in zip(self.outputs, outputs):
+            lowered = name.lower()
+            for key, words in (('boxes', ('box',)), ('scores', ('score',)), ('classes', ('class', 'label'))):
+                if key not in by_name and any(word in lowered for word in words):
+                    by_name[key] = value
+        if len(by_name) == 3:
+            boxes, classes, scores = by_name['boxes'], by_name['classes'], by_name['scores']
+        else:
+            boxes, classes, scores = outputs[:3]
+        # Выходы с размерностью пакета [1, N, ...] -> [N, ...]
+        if boxes.ndim == 3:
+            boxes, classes, scores = boxes[0], classes[0], scores[0]
+        return boxes, classes, scores
+
+    def normalized_box(self, box, size):
+        if self.box_format == 'yxyx':
+            y1, x1, y2, x2 = (float(v) for v in box)
+        else:
+            x1, y1, x2, y2 = (float(v) for v in box)
+        if max(x1, y1, x2, y2) > 1.5:
+            # Координаты в пикселях входа модели
+            width, height = size
+            x1, x2, y1, y2 = x1 / width, x2 / width, y1 / height, y2 / height
+        return [{"x": x1, "y": y1}, {"x": x2, "y": y1}, {"x": x2, "y": y2}, {"x": x1, "y": y2}]
+
+    def detect(self, image_data, min_score=0.3, max_results=10):
+        """Ответ в формате images:annotate: {"localizedObjectAnnotations": [...]}"""
+        tensor, size = self.preprocess(image_data)
+        boxes, classes, scores = self.split_outputs(self.session.run(None, {self.input.name: tensor}))
+        objects = []
+        for box, class_id, score in zip(boxes, classes, scores):
+            score = float(score)
+            class_id = int(class_id)
+            if score < min_score or not 0 <= class_id < len(self.labels) or not self.labels[class_id]:
+                continue
+            objects.append({
+                "name": self.labels[class_id],
+                "score": round(score, 6),
+                "boundingPoly": {"normalizedVertices": self.normalized_box(box, size)}
+            })
+        objects.sort(key=lambda obj: obj['score'], reverse=True)
+        return {"localizedObjectAnnotations": objects[:max_results]}
+
+
+def load_labels(path):
+    """Метки классов; пустые строки и '???' - классы без названия"""
+    with open(path, encoding='utf-8') as f:
+        return [line.strip() if line.strip() != '???' else '' for line in f]
+
+
+def check_model(model_path, labels_path):
+    """Проверка конфигурации до запуска пула (в мастере gunicorn)"""
+    # Отсутствие onnxruntime обнаруживается при запуске, а не на первом кадре
+    import onnxruntime
+
+    for path in (model_path, labels_path):
+        if not path or not os.path.isfile(path):
+            raise FileNotFoundError(f"Local detector file not found: {path}")
+
+
+def init_process(model_path, labels_path, box_format):
+    global _detector
+    _detector = Detector(model_path, load_labels(labels_path), box_format=box_format)
+
+
+def detect(image_data, min_score, max_results):
+    return _detector.detect(image_data, min_score, max_results)
+
+
+def ping():
+    """Пустая задача: заставляет пул запустить процессы и загрузить модель"""
+    return _detector is not None
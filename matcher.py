@@ -0,0 +1,121 @@
+# matcher.py
+from collections import deque
+
+INF = float('inf')
+
+
+class PhraseMatcher:
+    """Автомат Ахо-Корасик над таблицей фраз PHRASES[lang].
+
+    Ищет за один проход по команде и полные фразы, и отдельные слова фраз.
+    Приоритет совпадает с прежним линейным перебором: сначала первая (в порядке
+    словаря) фраза, целиком входящая в команду, затем первая фраза, любое слово
+    которой входит в команду.
+    """
+
+    def __init__(self, table):
+        self.phrases = list(table)
+        self._goto = [{}]
+        self._fail = [0]
+        # Лучшие (минимальные) индексы фраз с учетом суффиксных ссылок
+        self._best_exact = [INF]
+        self._best_word = [INF]
+        # Все индексы фраз, заканчивающиеся в узле (с учетом суффиксных ссылок)
+        self._exact = [()]
+        self._word = [()]
+
+        for index, phrase in enumerate(self.phrases):
+            self._add(phrase, index, exact=True)
+            for word in phrase.split():
+                self._add(word, index, exact=False)
+        self._build_links()
+
+    def _add(self, pattern, index, exact):
+        """Добавляет образец в бор"""
+        node = 0
+        for char in pattern:
+            child = self._goto[node].get(char)
+            if child is None:
+                child = len(self._goto)
+                self._goto[node][char] = child
+                self._goto.append({})
+                self._fail.append(0)
+                self._best_exact.append(INF)
+                self._best_word.append(INF)
+                self._exact.append(())
+                self._word.append(())
+            node = child
+
+        if exact:
+            if index not in self._exact[node]:
+                self._exact[node] += (index,)
+            self._best_exact[node] = min(self._best_exact[node], index)
+        else:
+            if index not in self._word[node]:
+                self._word[node] += (index,)
+            self._best_word[node] = min(self._best_word[node], index)
+
+    def _build_links(self):
+        """Строит суффиксные ссылки и сливает выходы по ним (обход в ширину)"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            fail = self._fail[node]
+            self._best_exact[node] = min(self._best_exact[node], self._best_exact[fail])
+            self._best_word[node] = min(self._best_word[node], self._best_word[fail])
+            if self._exact[fail]:
+                self._exact[node] = tuple(sorted(set(self._exact[node] + self._exact[fail])))
+            if self._word[fail]:
+                self._word[node] = tuple(sorted(set(self._word[node] + self._word[fail])))
+
+            for char, child in self._goto[node].items():
+                state = fail
+                while state and char not in self._goto[state]:
+                    state = self._fail[state]
+                target = self._goto[state].get(char, 0)
+                self._fail[child] = target if target != child else 0
+                queue.append(child)
+
+    def _walk(self, text):
+        """Проходит по тексту и отдает посещенные узлы"""
+        goto = self._goto
+        fail = self._fail
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            yield node
+
+    def match(self, text):
+        """Возвращает фразу с наивысшим приоритетом или None"""
+        best_exact = INF
+        best_word = INF
+        exact = self._best_exact
+        word = self._best_word
+        for node in self._walk(text):
+            if exact[node] < best_exact:
+                best_exact = exact[node]
+            if word[node] < best_word:
+                best_word = word[node]
+
+        if best_exact != INF:
+            return self.phrases[best_exact]
+        if best_word != INF:
+            return self.phrases[best_word]
+        return None
+
+    def find_all(self, text):
+        """Возвращает все совпавшие фразы: (полные совпадения, совпадения по словам)"""
+        exact = set()
+        partial = set()
+        for node in self._walk(text):
+            exact.update(self._exact[node])
+            partial.update(self._word[node])
+        return ([self.phrases[i] for i in sorted(exact)],
+                [self.phrases[i] for i in sorted(partial)])
+
+
+def compile_phrases(phrases):
+    """Компилирует автоматы для всех языков таблицы фраз"""
+    return {lang: PhraseMatcher(table) for lang, table in phrases.items()}
@@ -0,0 +1,289 @@
+# metrics.py
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+logger = logging.getLogger('DeasanAI')
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def _format_labels(key, extra=None):
+    pairs = list(key) + (list(extra) if extra else [])
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _pid_alive(pid):
+    """Жив ли процесс pid (на Windows os.kill(pid, 0) завершает процесс, там не проверяем)"""
+    if os.name == 'nt':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+class Metrics:
+    """Счетчики, гистограммы и gauge с выдачей в текстовом формате Prometheus.
+
+    Каждый процесс копит значения в памяти. Если задан directory, процесс
+    периодически сбрасывает свой снимок в файл <directory>/worker-<pid>.json,
+    а render() суммирует снимки всех воркеров gunicorn, так что /metrics
+    показывает одно и то же, на какой бы воркер ни попал запрос.
+
+    Снимки завершившихся воркеров в сумму не попадают. Мастер gunicorn
+    (child_exit) переносит их счетчики и гистограммы в retired.json, чтобы
+    итоги не уменьшались, а gauge мертвого воркера просто исчезают. Файлы,
+    которые никто не перенес, удаляются через STALE_FLUSHES интервалов сброса.
+    """
+
+    STALE_FLUSHES = 12
+
+    def __init__(self, directory=None, flush_interval=5.0, buckets=DEFAULT_BUCKETS):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.buckets = tuple(buckets)
+        self.help = {}
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+        # Сброс идет и из потока metrics-flush, и из запросов /metrics
+        self._flush_lock = threading.Lock()
+        self._flusher = None
+        self._flusher_pid = None
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set_counter(self, name, value, **labels):
+        """Задает абсолютное значение счетчика, который ведется в другом месте"""
+        with self._lock:
+            self._counters.setdefault(name, {})[_labels_key(labels)] = value
+
+    def set_gauge(self, name, value, **labels):
+        with self._lock:
+            self._gauges.setdefault(name, {})[_labels_key(labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        key = _labels_key(labels)
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][index] += 1
+            histogram[1] += seconds
+
+    def observe_timings(self, name, timings_ms, **labels):
+        """Записывает словарь {этап: мс} в гистограмму с меткой stage"""
+        for stage, duration in timings_ms.items():
+            self.observe(name, duration / 1000, stage=stage, **labels)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def add_collector(self, collector):
+        """collector(metrics) вызывается перед снимком и обновляет gauge/счетчики"""
+        self._collectors.append(collector)
+
+    def snapshot(self):
+        for collector in self._collectors:
+            try:
+                collector(self)
+            except Exception as e:
+                logger.error(f"Metrics collector error: {e}")
+        with self._lock:
+            return {
+                'counters': {name: [[list(k), v] for k, v in series.items()]
+                             for name, series in self._counters.items()},
+                'gauges': {name: [[list(k), v] for k, v in series.items()]
+                           for name, series in self._gauges.items()},
+                'histograms': {name: [[list(k), list(h[0]), h[1]] for k, h in series.items()]
+                               for name, series in self._histograms.items()},
+            }
+
+    def flush(self):
+        """Сохраняет снимок текущего процесса для агрегации между воркерами"""
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with self._flush_lock:
+            self._write(os.path.join(self.directory, f"worker-{os.getpid()}.json"), self.snapshot())
+
+    def start_flusher(self):
+        """Фоновый сброс снимка раз в flush_interval секунд (после fork запускается заново)"""
+        if not self.directory or self._flusher_pid == os.getpid():
+            return
+        self._flusher_pid = os.getpid()
+
+        def run():
+            while True:
+                time.sleep(self.flush_interval)
+                try:
+                    self.flush()
+                except Exception as e:
+                    logger.error(f"Metrics flush error: {e}")
+
+        self._flusher = threading.Thread(target=run, name='metrics-flush', daemon=True)
+        self._flusher.start()
+
+    def collect(self):
+        """Суммарный снимок всех воркеров (или только текущего процесса)"""
+        if not self.directory:
+            return [(None, self.snapshot())]
+
+        self.flush()
+        snapshots = []
+        retired = self._load(self._retired_path())
+        if retired is not None:
+            snapshots.append((None, retired))
+        for path in sorted(glob.glob(os.path.join(self.directory, 'worker-*.json'))):
+            pid = os.path.basename(path)[len('worker-'):-len('.json')]
+            if not pid.isdigit():
+                continue
+            if not _pid_alive(int(pid)):
+                self._drop_stale(path)
+                continue
+            snapshot = self._load(path)
+            if snapshot is not None:
+                snapshots.append((pid, snapshot))
+        return snapshots
+
+    def retire(self, pid):
+        """Переносит счетчики и гистограммы завершившегося воркера в retired.json.
+
+        Вызывается только мастером (gunicorn child_exit), поэтому retired.json
+        пишет один процесс и блокировка не нужна.
+        """
+        if not self.directory:
+            return
+        path = os.path.join(self.directory, f"worker-{pid}.json")
+        snapshot = self._load(path)
+        if snapshot is not None:
+            retired = self._load(self._retired_path()) or {'counters': {}, 'gauges': {}, 'histograms': {}}
+            for name, series in snapshot['counters'].items():
+                target = {tuple(map(tuple, key)): value for key, value in retired['counters'].get(name, [])}
+                for key, value in series:
+                    key = tuple(map(tuple, key))
+                    target[key] = target.get(key, 0) + value
+                retired['counters'][name] = [[list(map(list, k)), v] for k, v in target.items()]
+            for name, series in snapshot['histograms'].items():
+                target = {tuple(map(tuple, key)): [counts, total]
+                          for key, counts, total in retired['histograms'].get(name, [])}
+                for key, counts, total in series:
+                    key = tuple(map(tuple, key))
+                    if key in target:
+                        counts = [a + b for a, b in zip(target[key][0], counts)]
+                        total += target[key][1]
+                    target[key] = [counts, total]
+                retired['histograms'][name] = [[list(map(list, k)), c, t] for k, (c, t) in target.items()]
+            self._write(self._retired_path(), retired)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _retired_path(self):
+        return os.path.join(self.directory, 'retired.json')
+
+    def _drop_stale(self, path):
+        """Удаляет снимок мертвого воркера, если его не перенес мастер"""
+        try:
+            if time.time() - os.path.getmtime(path) > self.STALE_FLUSHES * self.flush_interval:
+                os.remove(path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _load(path):
+        try:
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _write(path, snapshot):
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, path)
+
+    def render(self):
+        """Текстовый формат экспозиции Prometheus 0.0.4"""
+        counters, gauges, histograms = {}, {}, {}
+        for pid, snapshot in self.collect():
+            for name, series in snapshot['counters'].items():
+                target = counters.setdefault(name, {})
+                for key, value in series:
+                    key = tuple(map(tuple, key))
+                    target[key] = target.get(key, 0) + value
+            for name, series in snapshot['gauges'].items():
+                # gauge не суммируются: у каждого воркера своя серия
+                target = gauges.setdefault(name, {})
+                for key, value in series:
+                    key = tuple(map(tuple, key))
+                    if pid is not None:
+                        key += (('worker', pid),)
+                    target[key] = value
+            for name, series in snapshot['histograms'].items():
+                target = histograms.setdefault(name, {})
+                for key, counts, total in series:
+                    key = tuple(map(tuple, key))
+                    if key not in target:
+                        target[key] = [[0] * len(counts), 0.0]
+                    target[key][0] = [a + b for a, b in zip(target[key][0], counts)]
+                    target[key][1] += total
+
+        lines = []
+        for kind, families in (('counter', counters), ('gauge', gauges)):
+            for name in sorted(families):
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in sorted(families[name].items()):
+                    lines.append(f"{name}{_format_labels(key)} {value}")
+
+        for name in sorted(histograms):
+            if name in self.help:
+                lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} histogram")
+            for key, (counts, total) in sorted(histograms[name].items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f"{name}_bucket{_format_labels(key, [('le', le)])} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(key)} {total}")
+                lines.append(f"{name}_count{_format_labels(key)} {cumulative}")
+
+        return '\n'.join(lines) + '\n'
@@ -1,4 +1,15 @@
 # phrases.py
+
+# Исправления переводов меток: подстрока перевода -> правильное название
+CORRECTION_DICT = {
+    "челоек": "человек",
+    "персон": "человек",
+    "авто": "автомобиль",
+    "машина": "автомобиль",
+    "бутылк": "бутылка",
+    "телефон": "смартфон"
+}
+
 PHRASES = {
             "ru": {
                 # Приветствия
@@ -153,8 +164,22 @@ PHRASES = {
             }
         }
 
+# Сценарии диалога - конечные автоматы. triggers запускают сценарий (реплика
+# enter), states описывают переходы: первый подходящий переход сохраняет команду
+# (append - в список, save - в поле), отвечает репликой reply и переводит в
+# состояние next (None - сценарий завершен). Переход с contains срабатывает,
+# только если команда содержит одно из слов.
 SCENARIOS = {
             "list_creation": {
+                "triggers": ["составь список", "создай список", "новый список"],
+                "enter": "start",
+                "initial": "collect",
+                "states": {
+                    "collect": [
+                        {"contains": ["закончи", "хватит"], "reply": "complete", "next": None},
+                        {"append": "items", "reply": "add_item", "next": "collect"}
+                    ]
+                },
                 "start": ["Хорошо, начинаем новый список. Назовите первый пункт.", 
                          "Список создан. Первый элемент?"],
                 "add_item": ["Добавил '{item}'. Что следующее?", 
@@ -163,10 +188,17 @@ SCENARIOS = {
                            "Список завершен. Всего {count} пунктов."]
             },
             "reminder": {
+                "triggers": ["напомни мне", "поставь напоминание"],
+                "enter": "what",
+                "initial": "what",
+                "states": {
+                    "what": [{"save": "text", "reply": "when", "next": "when"}],
+                    "when": [{"save": "time", "reply": "confirm", "next": None}]
+                },
                 "what": ["О чем вам напомнить?", "Напоминание о чем установить?"],
                 "when": ["На какое время установить напоминание?", 
                         "Когда вам нужно напомнить? Укажите дату и время."],
                 "confirm": ["Напоминание установлено: '{text}' на {time}.", 
                           "Хорошо, напомню вам о '{text}' в {time}."]
             }
-        }
\ No newline at end of file
+        }
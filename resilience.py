@@ -0,0 +1,175 @@
+# resilience.py
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from backends import UpstreamError
+
+logger = logging.getLogger('DeasanAI')
+
+
+class DeadlineExceeded(UpstreamError):
+    """Бюджет времени запроса исчерпан до вызова сервиса"""
+
+    def __init__(self, service):
+        super().__init__(service, message=f"Deadline exceeded before calling {service}")
+
+
+class CircuitOpenError(UpstreamError):
+    """Предохранитель сервиса разомкнут - вызов не выполняется"""
+
+    def __init__(self, service):
+        super().__init__(service, message=f"Circuit breaker for {service} is open")
+
+
+class Deadline:
+    """Срок завершения запроса, который делится между вызовами внешних сервисов.
+
+    shares задает долю оставшегося бюджета, которую может занять один вызов
+    сервиса, чтобы на следующие этапы (перевод, озвучивание) тоже осталось время.
+    """
+
+    def __init__(self, budget, shares=None):
+        self.expires_at = time.monotonic() + budget
+        self.shares = shares or {}
+
+    def remaining(self):
+        return self.expires_at - time.monotonic()
+
+    def timeout(self, service, limit):
+        return min(limit, self.remaining() * self.shares.get(service, 1.0))
+
+
+current_deadline = contextvars.ContextVar('deadline', default=None)
+
+
+@contextmanager
+def deadline_scope(budget, shares=None):
+    """Устанавливает срок для текущего запроса (None - без срока)"""
+    if budget is None:
+        yield None
+        return
+    deadline = Deadline(budget, shares)
+    token = current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        current_deadline.reset(token)
+
+
+def call_timeout(service, limit):
+    """Таймаут вызова сервиса с учетом срока запроса; DeadlineExceeded, если времени нет"""
+    deadline = current_deadline.get()
+    if deadline is None:
+        return limit
+    timeout = deadline.timeout(service, limit)
+    if timeout <= 0:
+        raise DeadlineExceeded(service)
+    return timeout
+
+
+def submit(executor, fn, *args, **kwargs):
+    """executor.submit, сохраняющий срок запроса (contextvars) в рабочем потоке"""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+class CircuitBreaker:
+    """Предохранитель внешнего сервиса.
+
+    После failure_threshold ошибок подряд размыкается и reset_timeout секунд
+    сразу отвечает CircuitOpenError, не тратя время на заведомо плохой сервис.
+    Затем пропускает один пробный вызов (half-open): успех замыкает цепь,
+    ошибка снова размыкает.
+    """
+
+    CLOSED = 'closed'
+    HALF_OPEN = 'half_open'
+    OPEN = 'open'
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, service, failure_threshold=5, reset_timeout=30):
+        self.service = service
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.opened = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Разрешает вызов или бросает CircuitOpenError"""
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.trial_in_flight = False
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.HALF_OPEN and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return
+            self.rejected += 1
+        raise CircuitOpenError(self.service)
+
+    def success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info(f"Circuit breaker for {self.service} closed")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trial_in_flight = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.opened += 1
+                    logger.warning(f"Circuit breaker for {self.service} opened after {self.failures} failures")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.trial_in_flight = False
+
+    @contextmanager
+    def guard(self):
+        """Проверяет предохранитель и учитывает исход вызова внутри блока"""
+        self.allow()
+        try:
+            yield
+        except DeadlineExceeded:
+            # Срок исчерпан до вызова - сервис не виноват
+            self._release()
+            raise
+        except Exception:
+            self.failure()
+            raise
+        except BaseException:
+            # Отмена задачи или закрытый генератор - исход неизвестен
+            self._release()
+            raise
+        self.success()
+
+    def _release(self):
+        with self._lock:
+            self.trial_in_flight = False
+
+    def call(self, fn, *args, **kwargs):
+        with self.guard():
+            return fn(*args, **kwargs)
+
+    async def acall(self, fn, *args, **kwargs):
+        with self.guard():
+            return await fn(*args, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "failures": self.failures,
+                "opened": self.opened,
+                "rejected": self.rejected
+            }
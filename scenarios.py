@@ -0,0 +1,147 @@
+# scenarios.py
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from matcher import PhraseMatcher
+
+
+class Transition:
+    __slots__ = ('contains', 'append', 'save', 'reply', 'next')
+
+    def __init__(self, contains, append, save, reply, next_state):
+        self.contains = contains
+        self.append = append
+        self.save = save
+        self.reply = reply
+        self.next = next_state
+
+    def matches(self, command_lower):
+        return not self.contains or any(word in command_lower for word in self.contains)
+
+
+class Scenario:
+    """Сценарий из SCENARIOS, проверенный и разобранный при запуске"""
+
+    def __init__(self, name, spec):
+        self.name = name
+        self.replies = {key: value for key, value in spec.items() if isinstance(value, list) and key != 'triggers'}
+        self.triggers = [trigger.lower() for trigger in spec.get('triggers', [])]
+        self.enter = spec['enter']
+        self.initial = spec['initial']
+        self.states = {
+            state: [Transition(tuple(t.get('contains', ())), t.get('append'), t.get('save'),
+                               t['reply'], t.get('next'))
+                    for t in transitions]
+            for state, transitions in spec['states'].items()
+        }
+
+        for reply in [self.enter] + [t.reply for ts in self.states.values() for t in ts]:
+            if reply not in self.replies:
+                raise ValueError(f"Scenario {name}: unknown reply '{reply}'")
+        for target in [self.initial] + [t.next for ts in self.states.values() for t in ts]:
+            if target is not None and target not in self.states:
+                raise ValueError(f"Scenario {name}: unknown state '{target}'")
+
+    def say(self, reply, data, command=''):
+        fields = dict(data, item=command, count=sum(len(v) for v in data.values() if isinstance(v, list)))
+        return random.choice(self.replies[reply]).format(**fields)
+
+
+class Dialogue:
+    """Состояние сценария одного пользователя"""
+    __slots__ = ('scenario', 'state', 'data', 'touched')
+
+    def __init__(self, scenario):
+        self.scenario = scenario
+        self.state = scenario.initial
+        self.data = {}
+        self.touched = time.monotonic()
+
+
+class ScenarioEngine:
+    """Сценарии диалога с отдельным состоянием у каждого пользователя.
+
+    Блокировка берется только на время поиска/вставки в таблицу диалогов, шаги
+    разных пользователей выполняются независимо. Диалоги, в которых пользователь
+    молчит дольше idle_timeout секунд, удаляются; при переполнении max_dialogues
+    удаляются самые давние.
+    """
+
+    def __init__(self, scenarios, idle_timeout=300, max_dialogues=10000):
+        self.scenarios = {name: Scenario(name, spec) for name, spec in scenarios.items()}
+        self.idle_timeout = idle_timeout
+        self.max_dialogues = max_dialogues
+        self._trigger_names = {}
+        for scenario in self.scenarios.values():
+            for trigger in scenario.triggers:
+                self._trigger_names.setdefault(trigger, scenario.name)
+        self._triggers = PhraseMatcher(self._trigger_names)
+        self._dialogues = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict_idle(self, now):
+        while self._dialogues:
+            user_id, dialogue = next(iter(self._dialogues.items()))
+            if now - dialogue.touched <= self.idle_timeout and len(self._dialogues) <= self.max_dialogues:
+                break
+            del self._dialogues[user_id]
+
+    def active(self, user_id):
+        """Имя текущего сценария пользователя или None"""
+        with self._lock:
+            self._evict_idle(time.monotonic())
+            dialogue = self._dialogues.get(user_id)
+        return dialogue.scenario.name if dialogue else None
+
+    def respond(self, user_id, command):
+        """Ответ сценария на команду или None, если команда к сценариям не относится"""
+        command_lower = command.lower()
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            dialogue = self._dialogues.get(user_id)
+            if dialogue is not None:
+                dialogue.touched = now
+                self._dialogues.move_to_end(user_id)
+
+        if dialogue is not None:
+            return self._step(user_id, dialogue, command, command_lower)
+        return self._start(user_id, command_lower, now)
+
+    def _start(self, user_id, command_lower, now):
+        triggers, _ = self._triggers.find_all(command_lower)
+        if not triggers:
+            return None
+        scenario = self.scenarios[self._trigger_names[triggers[0]]]
+        dialogue = Dialogue(scenario)
+        dialogue.touched = now
+        with self._lock:
+            self._dialogues[user_id] = dialogue
+            self._dialogues.move_to_end(user_id)
+            self._evict_idle(now)
+        return scenario.say(scenario.enter, dialogue.data)
+
+    def _step(self, user_id, dialogue, command, command_lower):
+        scenario = dialogue.scenario
+        for transition in scenario.states[dialogue.state]:
+            if not transition.matches(command_lower):
+                continue
+            if transition.append:
+                dialogue.data.setdefault(transition.append, []).append(command)
+            if transition.save:
+                dialogue.data[transition.save] = command
+            reply = scenario.say(transition.reply, dialogue.data, command)
+            if transition.next is None:
+                with self._lock:
+                    if self._dialogues.get(user_id) is dialogue:
+                        del self._dialogues[user_id]
+            else:
+                dialogue.state = transition.next
+            return reply
+        return None
+
+    def stats(self):
+        with self._lock:
+            return {"dialogues": len(self._dialogues)}
@@ -0,0 +1,43 @@
+# sentences.py
+import re
+
+# Конец предложения: знаки препинания с закрывающими кавычками и пробел, либо перевод строки
+SENTENCE_END = re.compile(r'[.!?…]+["»)]*\s+|\n+')
+
+
+class SentenceSplitter:
+    """Режет поток текста (фрагменты ответа модели) на законченные предложения.
+
+    Слишком короткие куски («Да.», «1.») приклеиваются к следующему
+    предложению, чтобы не озвучивать их отдельным файлом.
+    """
+
+    def __init__(self, min_length=20):
+        self.min_length = min_length
+        self.buffer = ''
+
+    def feed(self, text):
+        """Добавляет фрагмент и возвращает предложения, которые уже закончились"""
+        self.buffer += text
+        sentences = []
+        start = 0
+        for match in SENTENCE_END.finditer(self.buffer):
+            candidate = self.buffer[start:match.end()].strip()
+            if len(candidate) >= self.min_length or match.group().startswith('\n'):
+                if candidate:
+                    sentences.append(candidate)
+                start = match.end()
+        self.buffer = self.buffer[start:]
+        return sentences
+
+    def flush(self):
+        """Возвращает остаток текста после конца потока"""
+        rest = self.buffer.strip()
+        self.buffer = ''
+        return [rest] if rest else []
+
+
+def split_sentences(text, min_length=20):
+    """Делит готовый текст на предложения так же, как поток"""
+    splitter = SentenceSplitter(min_length)
+    return splitter.feed(text + ' ') + splitter.flush()
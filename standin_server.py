@@ -0,0 +1,64 @@
+"""Локальный HTTP-сервер, имитирующий Google Vision images:annotate.
+
+Позволяет нагружать настоящий GoogleVisionBackend (пул соединений, таймауты,
+повторы) без сети и ключей:
+
+    python standin_server.py --port 8900 --latency 0.3 --error-rate 0.05
+    VISION_API_URL=http://127.0.0.1:8900/v1/images:annotate gunicorn wsgi:app
+"""
+import argparse
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from backends import UpstreamError, create_fake_backend
+
+
+def make_handler(vision):
+    class VisionHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if not self.path.startswith('/v1/images:annotate'):
+                return self.respond(404, {"error": {"code": 404, "message": "Not found"}})
+            try:
+                requests = json.loads(body).get('requests', [])
+                responses = vision.annotate(requests)
+            except UpstreamError as e:
+                return self.respond(503, {"error": {"code": 503, "message": str(e)}})
+            except ValueError as e:
+                return self.respond(400, {"error": {"code": 400, "message": str(e)}})
+            self.respond(200, {"responses": responses})
+
+        def respond(self, status, payload):
+            data = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=UTF-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return VisionHandler
+
+
+def serve(host='127.0.0.1', port=8900, latency=0.0, jitter=0.0, error_rate=0.0):
+    vision = create_fake_backend('vision', latency, jitter, error_rate)
+    server = ThreadingHTTPServer((host, port), make_handler(vision))
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency', type=float, default=0.3, help='средняя задержка ответа, с')
+    parser.add_argument('--jitter', type=float, default=0.1, help='разброс задержки, с')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов 503')
+    args = parser.parse_args()
+    server = serve(args.host, args.port, args.latency, args.jitter, args.error_rate)
+    print(f"Vision stand-in listening on http://{args.host}:{args.port}/v1/images:annotate")
+    server.serve_forever()
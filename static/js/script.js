@@ -1,5 +1,6 @@
 const cameraView = document.getElementById('camera-view');
 const captureBtn = document.getElementById('capture-btn');
+const streamBtn = document.getElementById('stream-btn');
 const resultsContent = document.getElementById('results-content');
 const statusEl = document.getElementById('status');
 const statusIndicator = statusEl.querySelector('.status-indicator');
@@ -10,6 +11,18 @@ let stream = null;
 let isProcessing = false;
 let recognition = null;
 
+// Аудио приходит ссылкой на /api/audio/<id>, а не base64 внутри JSON
+const AUDIO_DELIVERY = 'url';
+
+// Непрерывное распознавание: кадры идут по WebSocket (ASGI-сервер),
+// без него - опрос /api/detect раз в FRAME_INTERVAL мс
+const FRAME_INTERVAL = 1000;
+let isStreaming = false;
+let detectSocket = null;
+let streamTimer = null;
+let isAnnouncing = false;
+let lastAnnouncement = '';
+
 async function initCamera() {
     try {
         updateStatus('Инициализация камеры...', 'processing');
@@ -95,37 +108,86 @@ function initVoiceRecognition() {
 }
 
 async function playAudioFromBase64(base64Data) {
+    return playAudioFromUrl(`data:audio/mp3;base64,${base64Data}`);
+}
+
+async function playAudioFromUrl(url) {
     return new Promise((resolve) => {
-        const audio = new Audio(`data:audio/mp3;base64,${base64Data}`);
+        // Браузер начинает воспроизведение, не дожидаясь полной загрузки файла
+        const audio = new Audio(url);
+        audio.preload = 'auto';
         audio.onended = resolve;
-        audio.play().catch(e => console.error("Audio play error:", e));
+        audio.onerror = resolve;
+        audio.play().catch(e => {
+            console.error("Audio play error:", e);
+            resolve();
+        });
     });
 }
 
+async function playAudio(data) {
+    if (data.audio_url) {
+        return playAudioFromUrl(data.audio_url);
+    }
+    if (data.audio) {
+        return playAudioFromBase64(data.audio);
+    }
+}
+
+async function readEvents(response, onEvent) {
+    // Ответ приходит построчно (NDJSON), каждое событие обрабатываем сразу
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        
+        let newline;
+        while ((newline = buffer.indexOf('\n')) >= 0) {
+            const line = buffer.slice(0, newline).trim();
+            buffer = buffer.slice(newline + 1);
+            if (line) onEvent(JSON.parse(line));
+        }
+    }
+    if (buffer.trim()) onEvent(JSON.parse(buffer));
+}
+
 async function processVoiceCommand(command) {
     try {
         updateStatus('Обработка...', 'processing');
         
-        const response = await fetch('/api/process_command', {
+        // Ответ озвучивается по предложениям, пока модель еще пишет продолжение
+        const response = await fetch('/api/process_command/stream', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
             },
-            body: JSON.stringify({ command: command })
+            body: JSON.stringify({ command: command, audio_delivery: AUDIO_DELIVERY })
         });
         
         if (!response.ok) throw new Error(`HTTP error: ${response.status}`);
         
-        const data = await response.json();
+        let playback = Promise.resolve();
+        let recognize = false;
         
-        if (data.audio) {
-            await playAudioFromBase64(data.audio);
-        }
+        await readEvents(response, (event) => {
+            if (event.type === 'sentence' || event.type === 'object_recognition') {
+                playback = playback.then(() => playAudio(event));
+            }
+            if (event.type === 'object_recognition') {
+                recognize = true;
+            } else if (event.type === 'done' && aiResponseEl) {
+                aiResponseEl.innerHTML += `<br>Deasan AI: ${event.message}`;
+            }
+        });
+        
+        await playback;
         
-        if (data.type === 'object_recognition') {
+        if (recognize) {
             setTimeout(captureAndDetect, 1000);
-        } else if (aiResponseEl) {
-            aiResponseEl.innerHTML += `<br>Deasan AI: ${data.message}`;
         }
         
     } catch (err) {
@@ -137,40 +199,43 @@ async function processVoiceCommand(command) {
     }
 }
 
+function captureFrame() {
+    const canvas = document.createElement('canvas');
+    canvas.width = cameraView.videoWidth;
+    canvas.height = cameraView.videoHeight;
+    const ctx = canvas.getContext('2d');
+    
+    ctx.translate(canvas.width, 0);
+    ctx.scale(-1, 1);
+    ctx.drawImage(cameraView, 0, 0, canvas.width, canvas.height);
+    return canvas;
+}
+
 async function captureAndDetect() {
     if (isProcessing || !stream) return;
     
     isProcessing = true;
-    captureBtn.disabled = true;
+    if (!isStreaming) captureBtn.disabled = true;
     updateStatus('Анализ изображения...', 'processing');
     
     try {
-        const canvas = document.createElement('canvas');
-        canvas.width = cameraView.videoWidth;
-        canvas.height = cameraView.videoHeight;
-        const ctx = canvas.getContext('2d');
-        
-        ctx.translate(canvas.width, 0);
-        ctx.scale(-1, 1);
-        ctx.drawImage(cameraView, 0, 0, canvas.width, canvas.height);
+        // Кадр уходит сырым JPEG без base64: тело на треть меньше
+        const blob = await new Promise(resolve => captureFrame().toBlob(resolve, 'image/jpeg', 0.8));
+        if (!blob) throw new Error('Frame capture failed');
         
-        const imageData = canvas.toDataURL('image/jpeg', 0.8).split(',')[1];
-        
-        const response = await fetch('/api/detect', {
+        const response = await fetch(`/api/detect?audio_delivery=${AUDIO_DELIVERY}`, {
             method: 'POST',
             headers: {
-                'Content-Type': 'application/json',
+                'Content-Type': 'image/jpeg',
             },
-            body: JSON.stringify({ image: imageData })
+            body: blob
         });
         
         if (!response.ok) throw new Error(`HTTP error: ${response.status}`);
         
         const results = await response.json();
         
-        if (results.audio) {
-            await playAudioFromBase64(results.audio);
-        }
+        await playAudio(results);
         
         displayResults(results.results || results);
         
@@ -180,8 +245,104 @@ async function captureAndDetect() {
     } finally {
         isProcessing = false;
         captureBtn.disabled = false;
+        updateStatus(isStreaming ? 'Непрерывное распознавание' : 'Готов к работе', 'ready');
+    }
+}
+
+function openDetectSocket() {
+    return new Promise((resolve) => {
+        if (!('WebSocket' in window)) {
+            resolve(null);
+            return;
+        }
+        const scheme = location.protocol === 'https:' ? 'wss' : 'ws';
+        const socket = new WebSocket(`${scheme}://${location.host}/ws/detect`);
+        socket.binaryType = 'arraybuffer';
+        socket.onopen = () => {
+            socket.send(JSON.stringify({ audio_delivery: AUDIO_DELIVERY }));
+            resolve(socket);
+        };
+        socket.onerror = () => resolve(null);
+        socket.onclose = () => {
+            if (detectSocket === socket) {
+                detectSocket = null;
+                // Соединение оборвалось - продолжаем опросом по HTTP
+                if (isStreaming) scheduleNextFrame();
+            }
+        };
+        socket.onmessage = (event) => handleStreamMessage(JSON.parse(event.data));
+    });
+}
+
+function handleStreamMessage(message) {
+    if (message.type === 'error') {
+        console.error("Stream error:", message.error);
+        return;
+    }
+    displayResults(message.results);
+    announceResults(message);
+}
+
+async function announceResults(data) {
+    // Озвучиваем только изменившийся состав объектов и не перебиваем текущую фразу
+    const text = (data.results || []).map(obj => `${obj.count} ${obj.name}`).join(',');
+    if (isAnnouncing || !text || text === lastAnnouncement) return;
+    
+    lastAnnouncement = text;
+    isAnnouncing = true;
+    try {
+        await playAudio(data);
+    } finally {
+        isAnnouncing = false;
+    }
+}
+
+function sendStreamFrame() {
+    if (!isStreaming || !stream) return;
+    
+    if (detectSocket && detectSocket.readyState === WebSocket.OPEN) {
+        // Не копим кадры в буфере сокета: сервер все равно отбросит лишние
+        if (detectSocket.bufferedAmount === 0) {
+            captureFrame().toBlob(blob => {
+                if (blob && detectSocket) detectSocket.send(blob);
+            }, 'image/jpeg', 0.8);
+        }
+    } else {
+        captureAndDetect();
+    }
+    scheduleNextFrame();
+}
+
+function scheduleNextFrame() {
+    clearTimeout(streamTimer);
+    streamTimer = setTimeout(sendStreamFrame, FRAME_INTERVAL);
+}
+
+async function toggleStreaming() {
+    if (isStreaming) {
+        isStreaming = false;
+        clearTimeout(streamTimer);
+        if (detectSocket) {
+            const socket = detectSocket;
+            detectSocket = null;
+            socket.close();
+        }
+        streamBtn.classList.remove('active');
         updateStatus('Готов к работе', 'ready');
+        return;
     }
+    
+    isStreaming = true;
+    lastAnnouncement = '';
+    streamBtn.classList.add('active');
+    updateStatus('Непрерывное распознавание', 'ready');
+    const socket = await openDetectSocket();
+    if (!isStreaming) {
+        if (socket) socket.close();
+        return;
+    }
+    detectSocket = socket;
+    sendStreamFrame();
 }
 
 function displayResults(objects) {
@@ -239,6 +400,7 @@ document.addEventListener('DOMContentLoaded', () => {
     initCamera();
     
     captureBtn.addEventListener('click', captureAndDetect);
+    streamBtn.addEventListener('click', toggleStreaming);
     voiceBtn.addEventListener('click', toggleVoiceInput);
     
     document.querySelectorAll('.language-switcher button').forEach(btn => {
@@ -250,6 +412,9 @@ document.addEventListener('DOMContentLoaded', () => {
 });
 
 window.addEventListener('beforeunload', () => {
+    if (detectSocket) {
+        detectSocket.close();
+    }
     if (stream) {
         stream.getTracks().forEach(track => track.stop());
     }
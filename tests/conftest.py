@@ -0,0 +1,11 @@
+# conftest.py
+import os
+import sys
+
+# Модули приложения лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Внешние сервисы - локальные заглушки, кэш озвучивания - только в памяти
+os.environ.setdefault('DEASAN_BACKENDS', 'fake')
+os.environ.setdefault('TTS_CACHE_DIR', '')
+os.environ.setdefault('METRICS_DIR', '')
@@ -0,0 +1,67 @@
+# test_command_stream.py
+import asyncio
+import json
+
+import pytest
+
+import app
+
+ANSWER = ("Квантовая механика описывает поведение частиц на малых масштабах.\n\n"
+          "Во-первых, энергия передается порциями - квантами.  Это видно в спектрах атомов.\n"
+          "Во-вторых, частица ведет себя и как волна.\n\n"
+          "Итог: классическая физика - предельный случай")
+COMMAND = "Расскажи о квантовой механике"
+
+
+class ParagraphChatBackend:
+    available = True
+
+    def complete(self, params):
+        return ANSWER
+
+    def stream(self, params):
+        for start in range(0, len(ANSWER), 7):
+            yield ANSWER[start:start + 7]
+
+    async def astream(self, params):
+        for delta in self.stream(params):
+            yield delta
+
+
+@pytest.fixture
+def chat(monkeypatch):
+    monkeypatch.setattr(app, 'chat_backend', ParagraphChatBackend())
+    monkeypatch.setattr(app, 'render_speech', lambda text, lang, delivery='inline': None)
+    # Ответ должен прийти от модели, а не из локальных сценариев
+    monkeypatch.setattr(app.deasan_ai, 'answer_locally', lambda command, lang, user_id='default': None)
+
+
+def test_done_message_matches_complete_answer(chat):
+    expected = app.deasan_ai.process_command(COMMAND, 'ru', 'stream-test', use_cache=False)
+    events = list(app.stream_command_events(COMMAND, 'ru', 'stream-test', 'url', use_cache=False))
+
+    assert events[-1] == {"type": "done", "message": expected}
+    assert expected == ANSWER
+    assert len([event for event in events if event['type'] == 'sentence']) > 1
+
+
+def test_stream_endpoint_keeps_answer_in_history(chat):
+    client = app.app.test_client()
+    response = client.post('/api/process_command/stream',
+                           json={"command": COMMAND, "user_id": "stream-history", "cache": False})
+    events = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    assert events[-1]['message'] == ANSWER
+    assert app.conversation_manager.get_context('stream-history')[-1]['content'] == ANSWER
+
+
+def test_async_transcript_matches_complete_answer(chat):
+    async def collect():
+        transcript = []
+        sentences = [sentence async for sentence in
+                     app.deasan_ai.astream_answer(COMMAND, 'ru', 'stream-test', False, transcript)]
+        return sentences, ''.join(transcript)
+
+    sentences, text = asyncio.run(collect())
+    assert text == ANSWER
+    assert len(sentences) > 1
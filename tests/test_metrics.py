@@ -0,0 +1,51 @@
+# test_metrics.py
+import json
+import os
+import threading
+
+from metrics import Metrics
+
+
+def test_concurrent_flushes_write_valid_snapshot(tmp_path):
+    metrics = Metrics(str(tmp_path))
+    metrics.inc('requests_total', path='/a')
+    errors = []
+    start = threading.Barrier(8)
+
+    def flush_many():
+        start.wait()
+        try:
+            for _ in range(50):
+                metrics.flush()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=flush_many) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert sorted(os.listdir(tmp_path)) == [f"worker-{os.getpid()}.json"]
+    with open(tmp_path / f"worker-{os.getpid()}.json", encoding='utf-8') as f:
+        assert json.load(f)['counters']['requests_total'] == [[[['path', '/a']], 1]]
+
+
+def test_collect_during_flushes(tmp_path):
+    metrics = Metrics(str(tmp_path))
+    metrics.inc('requests_total')
+    stop = threading.Event()
+
+    def flush_loop():
+        while not stop.is_set():
+            metrics.flush()
+
+    flusher = threading.Thread(target=flush_loop)
+    flusher.start()
+    try:
+        for _ in range(100):
+            assert 'requests_total 1' in metrics.render()
+    finally:
+        stop.set()
+        flusher.join()
@@ -0,0 +1,131 @@
+# translation.py
+import logging
+
+from caching import SingleFlight, TTLCache
+
+logger = logging.getLogger('DeasanAI')
+
+
+class LabelTranslator:
+    """Пакетный перевод меток объектов с TTL-кэшем и склейкой одновременных запросов
+
+    translate_batch(texts, src, dest) переводит список строк за один сетевой вызов,
+    correct_label(label) возвращает известный перевод без обращения к сети (или None),
+    correct_translation(text) применяет CORRECTION_DICT к переводу. Неудачные переводы
+    кэшируются отдельно на короткое время (негативный кэш), чтобы не повторять
+    заведомо падающие запросы на каждом кадре. Ошибки из uncached_errors (сервис
+    не вызывался: разомкнут предохранитель, исчерпан срок) не кэшируются совсем.
+    """
+
+    def __init__(self, translate_batch, correct_label, correct_translation, ttl=24 * 3600, negative_ttl=300,
+                 max_items=4096, wait_timeout=15, uncached_errors=()):
+        self.translate_batch = translate_batch
+        self.correct_label = correct_label
+        self.correct_translation = correct_translation
+        self.negative_ttl = negative_ttl
+        self.uncached_errors = uncached_errors
+        self.wait_timeout = wait_timeout
+        self.cache = TTLCache(max_items, ttl)
+        self.inflight = SingleFlight()
+
+    def translate_many(self, labels, target_lang='ru'):
+        """Возвращает словарь {метка: перевод с заглавной буквы}"""
+        if target_lang == 'en':
+            return {label: label.capitalize() for label in labels}
+
+        results = {}
+        owned = []
+        waiting = []
+        for label in dict.fromkeys(labels):
+            key = (label.lower(), target_lang)
+            cached = self.cache.get(key)
+            if cached is not None:
+                results[label] = cached
+                continue
+
+            leader, future = self.inflight.claim(key)
+            if leader:
+                owned.append((label, key))
+            else:
+                waiting.append((label, future))
+
+        if owned:
+            results.update(self._translate_owned(owned, target_lang))
+
+        for label, future in waiting:
+            try:
+                results[label] = future.result(self.wait_timeout)
+            except Exception as e:
+                logger.error(f"Translation error: {e}")
+                results[label] = label.capitalize()
+
+        return results
+
+    def _translate_owned(self, owned, target_lang):
+        """Переводит метки, за которые отвечает текущий вызов, одним пакетом"""
+        results = {}
+        pending = []
+        for label, key in owned:
+            corrected = self.correct_label(label.lower())
+            if corrected:
+                results[label] = corrected.capitalize()
+                self.cache.set(key, results[label])
+                self.inflight.resolve(key, results[label])
+            else:
+                pending.append((label, key))
+
+        if not pending:
+            return results
+
+        try:
+            translated = self.translate_batch([label.lower() for label, _ in pending], 'en', target_lang)
+        except Exception as e:
+            logger.error(f"Translation error: {e}")
+            cache_failure = not isinstance(e, self.uncached_errors)
+            for label, key in pending:
+                results[label] = label.capitalize()
+                if cache_failure:
+                    self.cache.set(key, results[label], ttl=self.negative_ttl)
+                self.inflight.resolve(key, results[label])
+            return results
+        except BaseException:
+            # Отмена или выход потока: ожидающие получают английское название, а не таймаут
+            for label, key in pending:
+                self.inflight.resolve(key, label.capitalize())
+            raise
+
+        if len(translated) != len(pending):
+            logger.warning(f"Translation returned {len(translated)} items for {len(pending)} labels")
+        # Каждая метка получает результат, даже если сервис вернул меньше строк
+        for index, (label, key) in enumerate(pending):
+            text = translated[index] if index < len(translated) else None
+            if text:
+                results[label] = self.correct_translation(text).capitalize()
+                self.cache.set(key, results[label])
+            else:
+                results[label] = label.capitalize()
+                self.cache.set(key, results[label], ttl=self.negative_ttl)
+            self.inflight.resolve(key, results[label])
+        return results
+
+
+def apply_corrections(text, corrections):
+    """Правильное название из словаря исправлений (поиск подстрокой) или None"""
+    lowered = text.lower()
+    for wrong, correct in corrections.items():
+        if wrong in lowered:
+            return correct
+    return None
+
+
+def join_batch(translate_one, texts, src, dest):
+    """Переводит список строк одним запросом, склеивая их через перевод строки"""
+    if len(texts) == 1:
+        return [translate_one(texts[0], src, dest)]
+
+    translated = translate_one('\n'.join(texts), src, dest).split('\n')
+    if len(translated) == len(texts):
+        return [line.strip() for line in translated]
+
+    # Сервис склеил или разбил строки - переводим по одной
+    return [translate_one(text, src, dest) for text in texts]
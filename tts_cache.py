@@ -0,0 +1,330 @@
+# tts_cache.py
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from caching import LRUCache
+
+logger = logging.getLogger('DeasanAI')
+
+PLACEHOLDER_RE = re.compile(r'\{\w+\}')
+
+
+def normalize_text(text):
+    """Очищает текст так же, как перед отправкой в gTTS, и схлопывает пробелы"""
+    clean_text = re.sub(r'[^\w\s.,!?-]', '', text)
+    return ' '.join(clean_text.split())
+
+
+def audio_key(text, lang):
+    """Content-addressed ключ аудио: sha256 от (нормализованный текст, язык)"""
+    payload = f"{lang}\0{normalize_text(text)}".encode('utf-8')
+    return hashlib.sha256(payload).hexdigest()
+
+
+def splice_key(audio):
+    """Ключ склеенного аудио: sha256 от самих байтов.
+
+    Не совпадает с audio_key того же текста, поэтому под одной ссылкой
+    /api/audio/<id> (immutable, ETag=id) никогда не окажутся разные байты.
+    """
+    return hashlib.sha256(b'splice\0' + audio).hexdigest()
+
+
+class TTSCache:
+    """Двухуровневый кэш синтезированной речи: LRU в памяти + файлы на диске
+
+    Размер каталога на диске ограничен max_disk_bytes: при превышении удаляются
+    файлы, которые дольше всех не читались (время изменения файла обновляется
+    при каждом чтении с диска), пока кэш не станет меньше 90% лимита. Каталог
+    общий для воркеров gunicorn: после каждых PRUNE_CHECK_FRACTION лимита,
+    записанных процессом, его размер перечитывается в фоновом потоке под
+    блокировкой файла, так что превышение не больше доли лимита на воркер.
+
+    Временные записи (store(..., transient=True)) - аудио, которое дешево
+    собрать заново, например склейки фраз распознавания. Они лежат в
+    подкаталоге transient только transient_ttl секунд: этого хватает, чтобы
+    клиент скачал их по ссылке из любого воркера. В лимит они не входят.
+    """
+
+    PRUNE_CHECK_FRACTION = 0.05
+
+    def __init__(self, cache_dir=None, max_items=256, max_disk_bytes=None, transient_ttl=600):
+        self.cache_dir = cache_dir
+        self.memory = LRUCache(max_items)
+        self.max_disk_bytes = max_disk_bytes
+        self.transient_ttl = transient_ttl
+        self._transient_pruned = time.monotonic()
+        # Размер постоянных файлов на диске по последней проверке каталога
+        self.disk_bytes = None
+        self._written_bytes = 0
+        self._lock = threading.Lock()
+        self._prune_lock = threading.Lock()
+        self.counters = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'errors': 0,
+            'evictions': 0
+        }
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.mp3')
+
+    def _transient_path(self, key):
+        return os.path.join(self.cache_dir, 'transient', key + '.mp3')
+
+    def lookup(self, key, record=True):
+        """Ищет аудио по ключу сначала в памяти, затем на диске"""
+        audio = self.memory.get(key)
+        if audio is not None:
+            if record:
+                self._count('memory_hits')
+            return audio
+
+        audio = self._read(key)
+        if audio is not None:
+            self.memory.set(key, audio)
+        else:
+            # Временные записи в память не попадают, чтобы не вытеснять синтезированное
+            audio = self._read_transient(key)
+        if audio is not None and record:
+            self._count('disk_hits')
+        return audio
+
+    def _read(self, key):
+        if not self.cache_dir:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                audio = f.read()
+        except OSError:
+            return None
+        try:
+            # Отметка использования для вытеснения давно не нужных файлов
+            os.utime(path)
+        except OSError:
+            pass
+        return audio
+
+    def _read_transient(self, key):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._transient_path(key), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def peek(self, key):
+        """Аудио из памяти или с диска без учета в счетчиках и без записи в память"""
+        audio = self.memory.get(key)
+        if audio is None:
+            audio = self._read(key)
+        return audio if audio is not None else self._read_transient(key)
+
+    def store(self, key, audio, transient=False):
+        """Сохраняет аудио в память и на диск (атомарной заменой файла).
+
+        Временные записи при заданном cache_dir хранятся только на диске.
+        """
+        if not transient or not self.cache_dir:
+            self.memory.set(key, audio)
+        if not self.cache_dir:
+            return
+
+        path = self._transient_path(key) if transient else self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(audio)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error(f"TTS cache write error: {e}")
+            return
+        if transient:
+            self._expire_transient()
+        else:
+            self._account(len(audio))
+
+    def _expire_transient(self):
+        """Удаляет временные записи старше transient_ttl (не чаще раза в полпериода)"""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._transient_pruned < self.transient_ttl / 2:
+                return
+            self._transient_pruned = now
+        directory = os.path.join(self.cache_dir, 'transient')
+        expired_before = time.time() - self.transient_ttl
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                if os.stat(path).st_mtime < expired_before:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _account(self, size):
+        """Учитывает записанный файл; каждые PRUNE_CHECK_FRACTION лимита проверяет каталог в фоне.
+
+        Каталог общий для всех воркеров, поэтому размер не считается по записям
+        одного процесса, а перечитывается с диска при каждой проверке.
+        """
+        if not self.max_disk_bytes:
+            return
+        with self._lock:
+            self._written_bytes += size
+            if self.disk_bytes is not None and self._written_bytes < self.max_disk_bytes * self.PRUNE_CHECK_FRACTION:
+                return
+            self._written_bytes = 0
+        threading.Thread(target=self.prune, name='tts-prune', daemon=True).start()
+
+    def _disk_files(self):
+        """[(mtime, размер, путь)] постоянных файлов кэша (без transient)"""
+        files = []
+        for root, dirs, names in os.walk(self.cache_dir):
+            if root == self.cache_dir and 'transient' in dirs:
+                # Временные записи удаляются по своему сроку и в лимит не входят
+                dirs.remove('transient')
+            for name in names:
+                if not name.endswith('.mp3'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    @contextmanager
+    def _directory_lock(self):
+        """Блокировка каталога между процессами: True, если получена (вытесняет один воркер)"""
+        try:
+            import fcntl
+        except ImportError:
+            yield True
+            return
+        with open(os.path.join(self.cache_dir, '.prune.lock'), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def prune(self):
+        """Удаляет давно не читавшиеся файлы, пока кэш не станет меньше 90% лимита"""
+        if not self.cache_dir or not self.max_disk_bytes:
+            return 0
+        if not self._prune_lock.acquire(blocking=False):
+            # Вытеснение уже идет в другом потоке
+            return 0
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with self._directory_lock() as locked:
+                if not locked:
+                    # Каталог сейчас проверяет другой воркер
+                    return 0
+                files = self._disk_files()
+                total = sum(size for _, size, _ in files)
+                removed = 0
+                if total > self.max_disk_bytes:
+                    target = self.max_disk_bytes * 0.9
+                    for _, size, path in sorted(files):
+                        if total <= target:
+                            break
+                        try:
+                            os.remove(path)
+                        except FileNotFoundError:
+                            pass
+                        except OSError as e:
+                            logger.error(f"TTS cache eviction error: {e}")
+                            continue
+                        total -= size
+                        removed += 1
+                    logger.info(f"TTS cache evicted {removed} files, {total} bytes left")
+            with self._lock:
+                self.disk_bytes = total
+                self.counters['evictions'] += removed
+            return removed
+        except OSError as e:
+            logger.error(f"TTS cache prune error: {e}")
+            return 0
+        finally:
+            self._prune_lock.release()
+
+    def get_or_render(self, text, lang, render):
+        """Возвращает (ключ, аудио), вызывая render(text, lang) только при промахе"""
+        key = audio_key(text, lang)
+        audio = self.lookup(key)
+        if audio is not None:
+            return key, audio
+
+        self._count('misses')
+        try:
+            audio = render(normalize_text(text), lang)
+        except Exception:
+            self._count('errors')
+            raise
+        self.store(key, audio)
+        return key, audio
+
+    def warm_up(self, texts, render):
+        """Предварительно синтезирует набор (текст, язык); пропускает шаблоны с плейсхолдерами"""
+        rendered = 0
+        for text, lang in texts:
+            if PLACEHOLDER_RE.search(text):
+                continue
+            try:
+                self.get_or_render(text, lang, render)
+                rendered += 1
+            except Exception as e:
+                logger.error(f"TTS warm-up error: {e}")
+        logger.info(f"TTS warm-up finished: {rendered} phrases ready")
+        return rendered
+
+    def preload(self, texts):
+        """Поднимает в память уже синтезированные фразы с диска, не обращаясь к gTTS"""
+        loaded = 0
+        for text, lang in texts:
+            if not PLACEHOLDER_RE.search(text) and self.lookup(audio_key(text, lang), record=False) is not None:
+                loaded += 1
+        return loaded
+
+    def stats(self):
+        """Счетчики попаданий и промахов (промах = обращение к gTTS)"""
+        with self._lock:
+            stats = dict(self.counters)
+        stats['saved_round_trips'] = stats['memory_hits'] + stats['disk_hits']
+        stats['memory_items'] = len(self.memory)
+        stats['disk_bytes'] = self.disk_bytes
+        return stats
+
+
+def static_phrases(phrases):
+    """Перечисляет все статические ответы таблицы фраз как пары (текст, язык)"""
+    for lang, table in phrases.items():
+        for answers in table.values():
+            if not isinstance(answers, list):
+                answers = [answers]
+            for answer in answers:
+                if not PLACEHOLDER_RE.search(answer):
+                    yield answer, lang
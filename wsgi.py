@@ -1,4 +1,6 @@
-from app import app
+from app import app, init_worker, warm_up
 
 if __name__ == "__main__":
-    app.run()
\ No newline at end of file
+    warm_up()
+    init_worker()
+    app.run()